@@ -1,49 +1,121 @@
 import os
+import time
+import logging
 from dotenv import load_dotenv
 import openai
 from datetime import datetime
 import json
-from simple_memory import SimpleLumiMemory
+from simple_memory import get_shared_memory
 import random
+from lumi_logging import log_user
+import metrics
+from prompt_builder import PromptBuilder, count_tokens, truncate_to_tokens
+from reply_deadline import Deadline, LLM_DEADLINE_SECONDS, trim_partial
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# 初始化簡化記憶系統
+# 取得 process 共用的記憶系統（與 app.py 共用同一個實例）
 try:
-    memory_manager = SimpleLumiMemory()
-    print(" 簡化記憶系統已啟動")
+    memory_manager = get_shared_memory()
+    logger.info("簡化記憶系統已啟動")
 except Exception as e:
-    print(f"記憶系統初始化失敗: {e}")
+    logger.error("記憶系統初始化失敗: %s", e)
     memory_manager = None
 
 user_emotion_states = {}
 
+# 依 token 預算組 prompt（各段落預算見 PROMPT_BUDGET_* 環境變數）
+prompt_builder = PromptBuilder()
+
+PROMPT_RULES = "嚴格規定：你只能根據上方記憶內容回應，沒有就誠實說不知道。禁止假裝認識用戶、禁止使用『又見到你』『再次見到你』等語句，除非你真的有記憶。不要編造用戶資訊，也不要假裝記得用戶。"
+
 # ====== 新增：日記生成邏輯 ======
+# 日記每次只整理「上次整理之後」的對話；一次整理的對話量與每輪對話長度都有 token 上限
+DIARY_FOLD_TOKENS = int(os.getenv('DIARY_FOLD_TOKENS', '1500'))
+DIARY_TURN_MAX_TOKENS = int(os.getenv('DIARY_TURN_MAX_TOKENS', '200'))
+
+DIARY_REQUIREMENTS = "請以**用戶的第一人稱視角**整理成日記，包含：\n1. 今天發生的主要事件（用「我」開頭）\n2. 我的情緒和感受\n3. 與露米聊天的收穫或感想\n4. 對未來的期待或反思\n\n重要要求：\n- 以「親愛的日記」開頭\n- 全部用**第一人稱**（我、我的），不要用第三人稱（她、他）\n- 語氣要像用戶在寫自己的日記，自然親近\n- 可以提到「跟露米聊天後覺得...」但主要是用戶的視角\n- 適當使用「啦」「欸」「喔」等語氣詞，但保持是用戶自己的語氣\n\n這是用戶的個人日記，不是露米的觀察記錄。"
+
+
+def _diary_chunks(memories):
+    """把對話切成多段，每段不超過 DIARY_FOLD_TOKENS，回傳 [(對話文字, 該段最後一筆記憶, 對話輪數)]"""
+    half = DIARY_TURN_MAX_TOKENS // 2
+    chunks = []
+    lines, used = [], 0
+    for conv in memories:
+        turn = (f"用戶: {truncate_to_tokens(conv['user_message'] or '', half)}\n"
+                f"露米: {truncate_to_tokens(conv['lumi_response'] or '', half)}")
+        tokens = count_tokens(turn)
+        if lines and used + tokens > DIARY_FOLD_TOKENS:
+            chunks.append(("\n".join(lines), last, len(lines)))
+            lines, used = [], 0
+        lines.append(turn)
+        used += tokens
+        last = conv
+    if lines:
+        chunks.append(("\n".join(lines), last, len(lines)))
+    return chunks
+
+
+def _diary_prompt(diary, conversation_text):
+    if not diary:
+        return f"根據以下我與用戶的對話記錄，請幫用戶生成一份個人日記：\n\n對話記錄：\n{conversation_text}\n\n{DIARY_REQUIREMENTS}"
+    return f"以下是用戶今天稍早的日記：\n\n{diary}\n\n之後我與用戶又有這些對話：\n{conversation_text}\n\n請把新的對話融入原本的日記，輸出更新後的完整日記（保留原本的內容，不要重複）。{DIARY_REQUIREMENTS}"
+
+
+def update_daily_diary(user_id, date_str=None):
+    """把日記（預設為用戶時區的今天）更新到最新的對話，回傳 (日記, 狀態)
+
+    狀態：cached（沒有新對話，直接回傳快取）、created（第一次生成）、updated（補上新對話）、
+    empty（當天沒有對話）、error（LLM 失敗；有快取時回傳快取或已整理到的部分）
+    """
+    if not memory_manager:
+        return None, 'empty'
+    date_str = date_str or memory_manager.get_user_today(user_id)
+    cached = memory_manager.get_daily_diary(user_id, date_str)
+    since = cached['last_memory_at'] if cached else None
+    new_memories = memory_manager.get_daily_memories(user_id, date_str, since=since)
+    if not new_memories:
+        if cached:
+            metrics.inc('diary_cache', result='hit')
+            return cached['diary'], 'cached'
+        return None, 'empty'
+
+    metrics.inc('diary_cache', result='incremental' if cached else 'miss')
+    diary = cached['diary'] if cached else None
+    turn_count = cached['turn_count'] if cached else 0
+    status = 'updated' if cached else 'created'
+    for conversation_text, last, turns in _diary_chunks(new_memories):
+        try:
+            with metrics.span('llm.daily_summary'):
+                response = openai.ChatCompletion.create(
+                    model="gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": _diary_prompt(diary, conversation_text)}]
+                )
+            diary = response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error("生成日記摘要錯誤: %s", e, extra=log_user(user_id))
+            return diary, 'error'
+        turn_count += turns
+        # 每段整理完就寫入，下次從這裡繼續
+        memory_manager.save_daily_diary(user_id, date_str, diary, last['timestamp'], turn_count)
+    metrics.inc('diary_turns_folded', len(new_memories))
+    logger.info("日記已更新 status=%s new_turns=%d turn_count=%d", status, len(new_memories), turn_count,
+                extra=log_user(user_id))
+    return diary, status
+
+
+@metrics.timed('daily_summary')
 def generate_daily_summary(user_id):
-    today = datetime.now().strftime('%Y-%m-%d')
-    if memory_manager:
-        daily_memories = memory_manager.get_daily_memories(user_id, today)
-    else:
-        daily_memories = []
-    if not daily_memories:
+    diary, status = update_daily_diary(user_id)
+    if status == 'empty':
         return "欸～今天我們還沒有聊天呢！快跟我分享你的一天吧 ✨"
-    all_messages = []
-    for conv in daily_memories:
-        all_messages.append(f"用戶: {conv['user_message']}")
-        all_messages.append(f"露米: {conv['lumi_response']}")
-    conversation_text = "\n".join(all_messages)
-    prompt = f"""根據以下我與用戶的對話記錄，請幫用戶生成一份個人日記：\n\n對話記錄：\n{conversation_text}\n\n請以**用戶的第一人稱視角**整理成日記，包含：\n1. 今天發生的主要事件（用「我」開頭）\n2. 我的情緒和感受\n3. 與露米聊天的收穫或感想\n4. 對未來的期待或反思\n\n重要要求：\n- 以「親愛的日記」開頭\n- 全部用**第一人稱**（我、我的），不要用第三人稱（她、他）\n- 語氣要像用戶在寫自己的日記，自然親近\n- 可以提到「跟露米聊天後覺得...」但主要是用戶的視角\n- 適當使用「啦」「欸」「喔」等語氣詞，但保持是用戶自己的語氣\n\n這是用戶的個人日記，不是露米的觀察記錄。"""
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        reply_message = response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"生成日記摘要錯誤: {e}")
-        reply_message = "欸～生成日記摘要時出現了問題，不過沒關係啦！我們繼續聊天吧 😅"
-    return reply_message
+    if not diary:
+        return "欸～生成日記摘要時出現了問題，不過沒關係啦！我們繼續聊天吧 😅"
+    return diary
 
 # ====== 新增：人格描述與 prompt ======
 def get_persona_prompt():
@@ -111,11 +183,50 @@ def get_persona_prompt():
 - 不帶情緒的平鋪直敘
 ⚠️ 回覆時請以露米的身份依照上方風格調性，讓使用者感受到：你是有靈魂的、有感覺的、有個性的 AI 陪伴者。'''
 
+# ====== 串流產生回覆（有期限） ======
+def stream_completion(prompt, deadline):
+    """以串流方式呼叫 LLM，期限到時停止，回傳 (回覆文字, 結果)
+
+    結果為 complete / partial（期限到或連線中斷，但已有部分內容）/ timeout / error。
+    """
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        return None, 'timeout'
+    chunks = []
+    try:
+        stream = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            request_timeout=remaining
+        )
+        for chunk in stream:
+            content = chunk['choices'][0].get('delta', {}).get('content')
+            if content:
+                chunks.append(content)
+            if deadline.expired():
+                if hasattr(stream, 'close'):
+                    stream.close()
+                text = trim_partial(''.join(chunks))
+                return (text, 'partial') if text else (None, 'timeout')
+    except Exception as e:
+        text = trim_partial(''.join(chunks))
+        if text:
+            logger.warning("LLM 串流中斷，使用部分回覆: %s", e)
+            return text, 'partial'
+        if deadline.expired() or isinstance(e, openai.error.Timeout):
+            return None, 'timeout'
+        logger.error("AI 回應生成錯誤: %s", e)
+        return None, 'error'
+    return ''.join(chunks).strip() or None, 'complete'
+
 # ====== 主回覆邏輯 ======
-def get_lumi_response(message, user_id, persona_type=None):
-    print(f"\n=== 記憶流程開始 ===")
-    print(f"[記憶] 收到訊息: {message}")
-    print(f"[記憶] 用戶ID: {user_id}")
+@metrics.timed('lumi_response')
+def get_lumi_response(message, user_id, persona_type=None, received_at=None):
+    """received_at：收到 webhook 的 time.monotonic()，LLM 的期限從這個時間點開始計算"""
+    started = time.monotonic()
+    deadline = Deadline(LLM_DEADLINE_SECONDS, started_at=received_at)
+    logger.debug("收到訊息: %r", message, extra=log_user(user_id))
 
     # 日期/時間問句判斷
     date_keywords = ["今天幾號", "今天日期", "現在幾點", "今天是什麼時候", "現在時間"]
@@ -131,11 +242,12 @@ def get_lumi_response(message, user_id, persona_type=None):
     if any(keyword in message for keyword in summary_keywords):
         return generate_daily_summary(user_id)
 
-    # 查詢 profile name
-    profile_name = None
-    if hasattr(memory_manager, 'get_user_profile_name'):
-        profile_name = memory_manager.get_user_profile_name(user_id)
-        print(f"[記憶] 查詢到的用戶名稱: {profile_name}")
+    # 並行取回用戶名稱、最近 / 相似 / 個人資料記憶（慢的分支超時就只用其他結果）
+    memory_context_data = {'profile_name': None, 'recent_memories': [], 'similar_memories': [], 'profile_memories': []}
+    if memory_manager:
+        with metrics.span('retrieval'):
+            memory_context_data = memory_manager.get_context(user_id, message, recent_limit=3, similar_limit=3, profile_limit=5)
+    profile_name = memory_context_data['profile_name']
 
     # 多樣化誠實回應模板
     honest_templates = [
@@ -146,81 +258,51 @@ def get_lumi_response(message, user_id, persona_type=None):
         "我目前記憶功能有限，只能記錄當下這次對話。"
     ]
 
-    prompt = get_persona_prompt()
-    memory_context = ""
+    # 各段落去重、排序後在預算內組成 prompt
+    prompt, prompt_report = prompt_builder.build(get_persona_prompt(), {
+        'recent': memory_context_data['recent_memories'],
+        'profile': memory_context_data['profile_memories'],
+        'similar': memory_context_data['similar_memories'],
+    }, message, PROMPT_RULES)
+    for section, tokens in prompt_report['tokens'].items():
+        metrics.inc('prompt_tokens', tokens, section=section)
+    logger.debug("prompt: %r", prompt, extra=log_user(user_id))
 
-    if memory_manager:
-        try:
-            print(f"[記憶] 開始查詢用戶 {user_id} 的記憶...")
-            recent_memories = memory_manager.get_recent_memories(user_id, limit=3)
-            print(f"[記憶] 最近記憶數量: {len(recent_memories)}")
-            if recent_memories:
-                print(f"[記憶] 最近記憶內容: {recent_memories}")
-            similar_memories_list = memory_manager.get_similar_memories(user_id, message, limit=3)
-            print(f"[記憶] 相似記憶數量: {len(similar_memories_list)}")
-            if similar_memories_list:
-                print(f"[記憶] 相似記憶內容: {similar_memories_list}")
-            profile_memories_list = memory_manager.get_user_profile_memories(user_id, limit=5)
-            print(f"[記憶] 個人資料記憶數量: {len(profile_memories_list)}")
-            if profile_memories_list:
-                print(f"[記憶] 個人資料記憶內容: {profile_memories_list}")
-            if recent_memories:
-                memory_context += "\n\n【最近的對話歷史】\n"
-                for m in recent_memories:
-                    memory_context += f"用戶: {m.get('user_message', '')}\nLumi: {m.get('lumi_response', '')}\n"
-            if profile_memories_list:
-                memory_context += "\n\n【用戶個人資料】\n"
-                for m in profile_memories_list:
-                    memory_context += f"{m.get('user_message', '')} → {m.get('lumi_response', '')}\n"
-            if similar_memories_list:
-                memory_context += "\n\n【相關歷史對話】\n"
-                for m in similar_memories_list:
-                    memory_context += f"{m.get('user_message', '')} → {m.get('lumi_response', '')}\n"
-            print(f"[記憶] 記憶上下文長度: {len(memory_context)}")
-            if memory_context:
-                print(f"[記憶] 記憶上下文內容: {memory_context[:200]}...")
-            else:
-                print("[記憶] 沒有找到任何記憶內容")
-        except Exception as e:
-            print(f"[記憶] 記憶檢索失敗: {e}")
-
-    prompt += memory_context
-    prompt += f"\n\n用戶訊息：{message}"
-    prompt += "\n\n嚴格規定：你只能根據上方記憶內容回應，沒有就誠實說不知道。禁止假裝認識用戶、禁止使用『又見到你』『再次見到你』等語句，除非你真的有記憶。不要編造用戶資訊，也不要假裝記得用戶。"
-
-    print(f"[記憶] 最終 prompt 長度: {len(prompt)}")
-    print(f"[記憶] 最終 prompt 前200字: {prompt[:200]}...")
 
     # 處理「你記得我是誰嗎」等問題
     if any(kw in message for kw in ["你記得我是誰", "你知道我是誰", "我是誰"]):
         if profile_name:
             response = f"你是{profile_name}，我有記住你的名字喔！很高興再次和你聊天。"
-            print(f"[記憶] 回覆用戶身份問題: {response}")
             return response
         else:
             response = random.choice(honest_templates)
-            print(f"[記憶] 回覆身份問題(無記憶): {response}")
             return response
 
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        reply_message = response.choices[0].message.content.strip()
-        print(f"[記憶] AI 生成回覆: {reply_message}")
-    except Exception as e:
-        print(f"[記憶] AI 回應生成錯誤: {e}")
+    with metrics.span('llm') as llm_span:
+        reply_message, llm_outcome = stream_completion(prompt, deadline)
+    metrics.inc('llm_outcome', outcome=llm_outcome)
+    if reply_message:
+        logger.debug("AI 生成回覆: %r", reply_message, extra=log_user(user_id))
+    else:
         reply_message = "嗨！我是Lumi，不好意思剛剛恍神了一下，可以再說一次嗎？"
 
     # 儲存對話記憶
     if memory_manager and reply_message:
         try:
-            print(f"[記憶] 開始儲存對話記憶...")
-            memory_manager.store_conversation_memory(user_id, message, reply_message, persona_type)
-            print(f"[記憶] 對話記憶儲存成功: user_id={user_id}")
+            with metrics.span('store_memory'):
+                memory_manager.store_conversation_memory(user_id, message, reply_message, persona_type)
         except Exception as e:
-            print(f"[記憶] 記憶儲存失敗: {e}")
+            logger.error("記憶儲存失敗: %s", e, extra=log_user(user_id))
 
-    print(f"=== 記憶流程結束 ===\n")
+    # 正式環境預設只記錄耗時與筆數，不含對話內容
+    logger.info(
+        "回覆完成 total_ms=%.2f llm_ms=%.2f retrieval_ms=%s entries=%s prompt_tokens=%s "
+        "duplicates=%d over_budget=%d reply_chars=%d timed_out=%s llm_outcome=%s deadline_remaining_ms=%.0f",
+        (time.monotonic() - started) * 1000, llm_span.ms,
+        memory_context_data.get('stage_ms', {}).get('total'),
+        prompt_report['entries'], prompt_report['tokens'],
+        prompt_report['duplicates'], prompt_report['over_budget'], len(reply_message),
+        memory_context_data.get('timed_out', []), llm_outcome, deadline.remaining() * 1000,
+        extra=log_user(user_id)
+    )
     return reply_message
@@ -1,8 +1,10 @@
 import os
+import time
+import atexit
 import logging
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
-from linebot.v3.messaging.models import ReplyMessageRequest, TextMessage
+from linebot.v3.messaging.models import ReplyMessageRequest, PushMessageRequest, TextMessage
 from linebot.v3.webhook import WebhookHandler
 from linebot.v3.webhooks import (
     MessageEvent,
@@ -11,13 +13,21 @@ from linebot.v3.webhooks import (
 from linebot.v3.exceptions import (
     InvalidSignatureError
 )
-import ai_logic
-import simple_memory
+from lumi_logging import setup_logging, log_user
 
-# 設定日誌
-logging.basicConfig(level=logging.INFO)
+# 設定日誌（要在載入記憶系統之前，啟動過程的日誌才有 handler）
+setup_logging()
 logger = logging.getLogger(__name__)
 
+import ai_logic
+import simple_memory
+import metrics
+from reply_deadline import reply_token_usable
+from webhook_queue import WebhookWorkerPool
+from diary_scheduler import DiaryPrecomputeScheduler, parse_window
+from memory_partitions import PartitionMaintainer
+from memory_consolidation import MemoryConsolidator
+
 app = Flask(__name__)
 
 # 啟動確認
@@ -31,12 +41,83 @@ if not channel_access_token or not channel_secret:
     logger.error("❌ LINE Bot 環境變數未設定")
     raise ValueError("LINE_CHANNEL_ACCESS_TOKEN 和 LINE_CHANNEL_SECRET 必須設定")
 
-# 初始化 LINE Bot API - 使用 context manager
-configuration = Configuration(access_token=channel_access_token)
+# 初始化 LINE Bot API - 使用 context manager（LINE_API_HOST 只在壓測時指向本地的假 LINE API）
+configuration = Configuration(access_token=channel_access_token, host=os.getenv('LINE_API_HOST') or None)
 handler = WebhookHandler(channel_secret)
 
-# 初始化記憶系統
-memory_system = simple_memory.SimpleLumiMemory()
+# 記憶系統（與 ai_logic 共用同一個實例）
+memory_system = simple_memory.get_shared_memory()
+
+# 非同步 webhook 模式：驗證簽名後放入佇列，立即回覆 200，由背景 worker 處理
+webhook_async_mode = os.getenv('WEBHOOK_ASYNC_MODE', 'false').lower() in ('1', 'true', 'yes')
+webhook_pool = None
+if webhook_async_mode:
+    webhook_pool = WebhookWorkerPool(
+        lambda item: dispatch_event(*item),
+        num_workers=int(os.getenv('WEBHOOK_WORKERS', '4')),
+        max_queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '100'))
+    )
+    webhook_pool.start()
+    atexit.register(webhook_pool.stop)
+    metrics.register_gauge('webhook_queue_depth', lambda: webhook_pool.get_stats()['queue_depth'],
+                           'webhook 佇列中等待處理的事件數')
+    metrics.register_gauge('webhook_busy_workers', lambda: webhook_pool.get_stats()['busy_workers'],
+                           '正在處理事件的 worker 數')
+
+metrics.register_gauge('db_pool_in_use', lambda: memory_system.get_pool_stats().get('in_use', 0),
+                       '使用中的資料庫連線數')
+metrics.register_gauge('write_behind_pending', lambda: memory_system.get_write_behind_stats().get('pending', 0),
+                       '尚未寫入資料庫的記憶筆數')
+metrics.register_gauge('hot_index_bytes', lambda: memory_system.get_hot_index_stats().get('bytes', 0),
+                       '記憶體向量索引佔用的 bytes')
+
+# lumi_memories 每月分區：定期建立未來月份的分區，設定保留月數時封存過期分區
+partition_maintainer = PartitionMaintainer(
+    lambda: memory_system.pool,
+    months_ahead=memory_system.partition_months_ahead,
+    retention_months=int(os.getenv('MEMORY_RETENTION_MONTHS', '0')),
+    archive_dir=os.getenv('MEMORY_ARCHIVE_DIR', 'archive'),
+    interval=float(os.getenv('MEMORY_PARTITION_MAINTENANCE_INTERVAL', '21600'))
+)
+partition_maintainer.start()
+atexit.register(partition_maintainer.stop)
+
+# 日記預先產生：離峰時段先整理好當天有聊天的用戶日記，晚上要求日記時直接回傳
+diary_scheduler = None
+if os.getenv('DIARY_PRECOMPUTE_ENABLED', 'false').lower() in ('1', 'true', 'yes'):
+    min_new_turns = int(os.getenv('DIARY_PRECOMPUTE_MIN_TURNS', '3'))
+    diary_scheduler = DiaryPrecomputeScheduler(
+        ai_logic.update_daily_diary,
+        lambda date_str, limit: memory_system.get_stale_diary_users(date_str, limit, min_new_turns),
+        window=parse_window(os.getenv('DIARY_PRECOMPUTE_WINDOW', '16:00-19:00')),
+        interval=float(os.getenv('DIARY_PRECOMPUTE_INTERVAL', '600')),
+        max_concurrency=int(os.getenv('DIARY_PRECOMPUTE_CONCURRENCY', '2')),
+        rate_per_minute=float(os.getenv('DIARY_PRECOMPUTE_RATE', '30')),
+        batch_limit=int(os.getenv('DIARY_PRECOMPUTE_BATCH', '200')),
+        # webhook 佇列有積壓時暫停，優先處理即時訊息
+        busy_func=lambda: bool(webhook_pool and webhook_pool.get_stats()['queue_depth'] > 0),
+        lock=memory_system.diary_precompute_lock
+    )
+    diary_scheduler.start()
+    atexit.register(diary_scheduler.stop)
+
+# 記憶整併：把老用戶重複的舊對話合併成摘要，相似度搜尋先找摘要
+memory_consolidator = None
+if os.getenv('MEMORY_CONSOLIDATION_ENABLED', 'false').lower() in ('1', 'true', 'yes'):
+    memory_consolidator = MemoryConsolidator(
+        lambda: memory_system.pool,
+        min_age_days=float(os.getenv('MEMORY_CONSOLIDATION_MIN_AGE_DAYS', '30')),
+        threshold=float(os.getenv('MEMORY_CONSOLIDATION_THRESHOLD', '0.9')),
+        min_cluster_size=int(os.getenv('MEMORY_CONSOLIDATION_MIN_CLUSTER', '3')),
+        min_new_turns=int(os.getenv('MEMORY_CONSOLIDATION_MIN_TURNS', '20')),
+        batch_limit=int(os.getenv('MEMORY_CONSOLIDATION_BATCH', '2000')),
+        users_per_run=int(os.getenv('MEMORY_CONSOLIDATION_USERS', '50')),
+        interval=float(os.getenv('MEMORY_CONSOLIDATION_INTERVAL', '3600')),
+        busy_func=lambda: bool(webhook_pool and webhook_pool.get_stats()['queue_depth'] > 0),
+        settle_days=float(os.getenv('MEMORY_CONSOLIDATION_SETTLE_DAYS', '30'))
+    )
+    memory_consolidator.start()
+    atexit.register(memory_consolidator.stop)
 
 logger.info("✅ Flask app 啟動完成，所有服務已就緒")
 
@@ -48,66 +129,162 @@ def home():
 def health_check():
     return "OK", 200
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus 格式的各階段延遲直方圖與計數器"""
+    return metrics.REGISTRY.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route("/metrics/summary")
+def metrics_summary():
+    """各階段的 p50 / p95 / p99（毫秒）"""
+    return jsonify(metrics.REGISTRY.get_summary())
+
+@app.route("/webhook/stats")
+def webhook_stats():
+    if not webhook_pool:
+        return jsonify({'async_mode': False})
+    stats = webhook_pool.get_stats()
+    stats['async_mode'] = True
+    return jsonify(stats)
+
+@app.route("/db/stats")
+def db_stats():
+    return jsonify(memory_system.get_pool_stats())
+
+@app.route("/embedding/stats")
+def embedding_stats():
+    stats = memory_system.get_embedding_cache_stats()
+    stats['batcher'] = memory_system.get_embedding_batcher_stats()
+    return jsonify(stats)
+
+@app.route("/hot_index/stats")
+def hot_index_stats():
+    return jsonify(memory_system.get_hot_index_stats())
+
+@app.route("/write_behind/stats")
+def write_behind_stats():
+    return jsonify(memory_system.get_write_behind_stats())
+
+@app.route("/profile/stats")
+def profile_stats():
+    return jsonify(memory_system.get_profile_cache_stats())
+
+@app.route("/partitions/stats")
+def partition_stats():
+    return jsonify(partition_maintainer.get_stats())
+
+@app.route("/consolidation/stats")
+def consolidation_stats():
+    if not memory_consolidator:
+        return jsonify({'enabled': False})
+    stats = memory_consolidator.get_stats()
+    stats['enabled'] = True
+    return jsonify(stats)
+
+@app.route("/diary/stats")
+def diary_stats():
+    if not diary_scheduler:
+        return jsonify({'precompute_enabled': False})
+    stats = diary_scheduler.get_stats()
+    stats['precompute_enabled'] = True
+    return jsonify(stats)
+
 @app.route("/callback", methods=['POST'])
 def callback():
     # 獲取 X-Line-Signature header
     signature = request.headers['X-Line-Signature']
 
+    # 回覆期限從收到 webhook 開始計算
+    received_at = time.monotonic()
+
     # 獲取 request body
     body = request.get_data(as_text=True)
-    logger.info("✅ LINE webhook 收到請求")
-    logger.info(f"📝 請求內容長度: {len(body)}")
+    metrics.inc('webhook_requests')
+    logger.debug("LINE webhook 收到請求，內容長度: %d", len(body))
 
     try:
-        handler.handle(body, signature)
-        logger.info("✅ webhook 處理成功")
+        if webhook_pool:
+            payload = handler.parser.parse(body, signature, as_payload=True)
+            metrics.inc('webhook_events', len(payload.events))
+            for event in payload.events:
+                if not webhook_pool.submit((event, received_at)):
+                    # 佇列已滿時退回同步處理，避免事件遺失
+                    logger.warning("⚠️ webhook 佇列已滿，改為同步處理")
+                    dispatch_event(event, received_at)
+            logger.debug("webhook 已排入佇列: %d 個事件", len(payload.events))
+        else:
+            handler.handle(body, signature)
+            logger.debug("webhook 處理成功")
     except InvalidSignatureError:
         logger.error("❌ 簽名驗證失敗")
         abort(400)
     except Exception as e:
-        logger.error(f"❌ webhook 處理失敗: {e}")
+        logger.error("❌ webhook 處理失敗: %s", e)
         abort(500)
 
     return 'OK'
 
+def dispatch_event(event, received_at=None):
+    """背景 worker 使用：只處理文字訊息事件"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        handle_message(event, received_at)
+    else:
+        logger.debug("略過未處理的事件類型: %s", type(event).__name__)
+
 @handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
-    logger.info("=== 開始處理訊息 ===")
+def on_text_message(event):
+    """同步模式的 handler（WebhookHandler 依參數數量決定傳入的引數，這裡只收 event）"""
+    handle_message(event)
+
+@metrics.timed('handle_message')
+def handle_message(event, received_at=None):
+    # 同步模式下由 handler.handle 直接呼叫，收到 webhook 的時間就是現在
+    if received_at is None:
+        received_at = time.monotonic()
+    user_id = None
     try:
         user_id = event.source.user_id
         user_message = event.message.text
         
-        logger.info(f"📨 收到用戶 {user_id} 的訊息: {user_message}")
-        logger.info(f"🔑 reply_token: {event.reply_token}")
-        
-        # 使用 AI 邏輯生成回應
-        logger.info("🤖 開始生成 AI 回應...")
-        lumi_response = ai_logic.get_lumi_response(user_message, user_id)
-        
-        logger.info(f"🤖 Lumi 回覆內容： {lumi_response}")
-        
-        # 使用 context manager 發送回應 - 正確的 v3 寫法
-        logger.info("📤 開始發送回應...")
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                reply_msg = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=lumi_response)]
-                )
-                line_bot_api.reply_message(reply_msg)
-                logger.info("✅ 訊息發送成功")
-        except Exception as e:
-            logger.error(f"❌ 發送失敗：{e}")
-            logger.error(f"❌ 錯誤類型：{type(e)}")
-            logger.error(f"❌ 詳細錯誤：{e}")
+        # 使用 AI 邏輯生成回應（LLM 期限從收到 webhook 開始計算）
+        lumi_response = ai_logic.get_lumi_response(user_message, user_id, received_at=received_at)
+        send_response(event, user_id, lumi_response, received_at)
             
-    except Exception as e:
-        logger.error(f"❌ 處理訊息時發生錯誤: {e}")
-        import traceback
-        logger.error(f"❌ 詳細錯誤堆疊: {traceback.format_exc()}")
-    
-    logger.info("=== 訊息處理結束 ===")
+    except Exception:
+        logger.exception("❌ 處理訊息時發生錯誤", extra=log_user(user_id))
+
+def send_response(event, user_id, text, received_at):
+    """reply token 還有效時用 reply_message，太晚或回覆失敗時改用 push_message"""
+    usable, remaining = reply_token_usable(received_at)
+    metrics.observe('reply_token_age', time.monotonic() - received_at)
+    path = 'reply' if usable else 'push'
+    # 使用 context manager 發送回應 - 正確的 v3 寫法
+    with ApiClient(configuration) as api_client:
+        line_bot_api = MessagingApi(api_client)
+        if usable:
+            try:
+                with metrics.span('line_reply'):
+                    line_bot_api.reply_message(ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[TextMessage(text=text)]
+                    ))
+            except Exception as e:
+                logger.warning("reply_message 失敗（%s），改用 push_message：%s", type(e).__name__, e,
+                               extra=log_user(user_id))
+                path = 'push_after_reply_failed'
+        if path != 'reply':
+            try:
+                with metrics.span('line_push'):
+                    line_bot_api.push_message(PushMessageRequest(
+                        to=user_id,
+                        messages=[TextMessage(text=text)]
+                    ))
+            except Exception as e:
+                logger.error("❌ 發送失敗（%s）：%s", type(e).__name__, e, extra=log_user(user_id))
+                path = 'failed'
+    metrics.inc('reply_path', path=path)
+    logger.info("回覆已送出 path=%s token_remaining_ms=%.0f", path, remaining * 1000, extra=log_user(user_id))
+    return path
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
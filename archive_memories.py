@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+手動執行分區維護：建立未來月份的分區，並封存超過保留期限的分區
+
+封存的分區會匯出成 <archive-dir>/lumi_memories_pYYYYMM.csv.gz（附 .json manifest），
+確認筆數一致後才從資料庫移除。可以先用 --dry-run 查看會封存哪些分區。
+
+用法：
+    DATABASE_URL=postgresql://... python archive_memories.py --retention-months 12 --archive-dir /data/archive
+"""
+
+import os
+import sys
+import argparse
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import schema
+import memory_partitions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="lumi_memories 分區維護與封存")
+    parser.add_argument('--retention-months', type=int,
+                        default=int(os.getenv('MEMORY_RETENTION_MONTHS', '0')))
+    parser.add_argument('--archive-dir', default=os.getenv('MEMORY_ARCHIVE_DIR', 'archive'))
+    parser.add_argument('--months-ahead', type=int,
+                        default=int(os.getenv('MEMORY_PARTITION_MONTHS_AHEAD', '3')))
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        print("❌ 請設定 DATABASE_URL")
+        sys.exit(1)
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    schema.apply_migrations(conn)
+
+    partitions = memory_partitions.list_partitions(conn)
+    print(f"📦 目前有 {len(partitions)} 個分區：{', '.join(name for name, _ in partitions)}")
+    expired = memory_partitions.expired_partitions(partitions, args.retention_months) \
+        if args.retention_months > 0 else []
+    if args.dry_run:
+        print(f"🔍 將會封存：{', '.join(name for name, _ in expired) or '（無）'}")
+        conn.close()
+        return
+
+    with memory_partitions.maintenance_lock(conn) as locked:
+        if not locked:
+            print("⚠️ 其他 process 正在進行分區維護，請稍後再試")
+            sys.exit(1)
+        created = memory_partitions.ensure_partitions(conn, args.months_ahead)
+        print(f"✅ 新建立 {len(created)} 個分區")
+        for name, _ in expired:
+            manifest = memory_partitions.archive_partition(conn, name, args.archive_dir)
+            print(f"✅ 已封存 {name}：{manifest['rows']} 筆 → {manifest['file']}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+一次性回填：依目前的個人資料關鍵詞重新標記 lumi_memories.profile_tags
+
+以 id 分批處理，每批一個 UPDATE，可以在服務運行中執行；
+調整 PROFILE_KEYWORDS / PROFILE_KEYWORDS_FILE 之後也可以再跑一次。
+
+用法：
+    DATABASE_URL=postgresql://... python backfill_profile_tags.py --batch-size 1000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import schema
+from profile_tags import load_profile_keywords, extract_profile_tags
+
+
+def backfill(conn, keyword_sets, batch_size=1000, start_id=0):
+    """回傳 (處理筆數, 有標籤的筆數)"""
+    last_id = start_id
+    scanned = 0
+    tagged = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, user_message, profile_tags
+                FROM lumi_memories
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s;
+            """, (last_id, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                return scanned, tagged
+
+            updates = []
+            for row_id, user_message, current in rows:
+                tags = extract_profile_tags(user_message, keyword_sets)
+                if tags:
+                    tagged += 1
+                if tags != sorted(current or []):
+                    updates.append((row_id, tags))
+            if updates:
+                execute_values(cur, """
+                    UPDATE lumi_memories AS m
+                    SET profile_tags = v.tags
+                    FROM (VALUES %s) AS v(id, tags)
+                    WHERE m.id = v.id;
+                """, updates, template="(%s, %s::text[])")
+        scanned += len(rows)
+        last_id = rows[-1][0]
+        print(f"  已處理到 id={last_id}（累計 {scanned} 筆，本批更新 {len(updates)} 筆）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回填 lumi_memories.profile_tags")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--start-id', type=int, default=0)
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        print("❌ 請設定 DATABASE_URL")
+        sys.exit(1)
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    schema.apply_migrations(conn)
+
+    keyword_sets = load_profile_keywords()
+    print(f"🏷️ 使用 {len(keyword_sets)} 個個人資料標籤開始回填...")
+    started = time.time()
+    scanned, tagged = backfill(conn, keyword_sets, args.batch_size, args.start_id)
+    print(f"✅ 回填完成：{scanned} 筆記憶，其中 {tagged} 筆為個人資料，耗時 {time.time() - started:.1f}s")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+嵌入量化報告：float32 vector 與 int8 + 正負號位元（EMBEDDING_STORAGE=int8）的大小 / recall / 延遲
+
+用同一份合成資料建立兩張暫存資料表：
+- lumi_quant_report_float：VECTOR 欄位 + HNSW 索引（目前的預設）
+- lumi_quant_report_int8：BYTEA int8 + REAL scale + BIT VARYING，查詢方式與 SimpleLumiMemory 相同
+  （資料庫以 hamming 距離挑 k * factor 筆候選，NumPy 還原 int8 後精確重新排序）
+以 float32 精確搜尋為 ground truth，比較各 rerank factor 的 recall@k 與延遲，以及資料表 / 索引大小。
+
+用法：
+    DATABASE_URL=postgresql://... python benchmarks/quantization_report.py --output quantization.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_utils import quantize_int8, dequantize_int8, binary_signature, cosine_distances
+
+FLOAT_TABLE = 'lumi_quant_report_float'
+INT8_TABLE = 'lumi_quant_report_int8'
+
+FLOAT_QUERY = f"""
+    SELECT id, embedding <=> %s::vector AS distance
+    FROM {FLOAT_TABLE}
+    WHERE user_id = %s
+    ORDER BY distance
+    LIMIT %s;
+"""
+
+INT8_QUERY = f"""
+    SELECT id, embedding_i8, embedding_scale
+    FROM {INT8_TABLE}
+    WHERE user_id = %s
+    ORDER BY bit_count(embedding_bits # %s::varbit)
+    LIMIT %s;
+"""
+
+
+def make_dataset(rng, n_users, rows_per_user, dim, topics=20):
+    """每位用戶有數個話題中心，訊息是中心附近的雜訊向量（與 vector_index_report.py 相同）"""
+    for u in range(n_users):
+        centers = rng.standard_normal((topics, dim)).astype(np.float32)
+        picks = rng.integers(0, topics, rows_per_user)
+        vecs = centers[picks] + 0.6 * rng.standard_normal((rows_per_user, dim)).astype(np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        yield f"bench_user_{u}", vecs
+
+
+def setup_tables(conn, args, rng):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {FLOAT_TABLE}, {INT8_TABLE};")
+        cur.execute(f"""
+            CREATE TABLE {FLOAT_TABLE} (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                embedding VECTOR({args.dim})
+            );
+        """)
+        cur.execute(f"""
+            CREATE TABLE {INT8_TABLE} (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                embedding_i8 BYTEA,
+                embedding_scale REAL,
+                embedding_bits BIT VARYING
+            );
+        """)
+        samples = {}
+        next_id = 1
+        for user_id, vecs in make_dataset(rng, args.users, args.rows_per_user, args.dim):
+            ids = range(next_id, next_id + len(vecs))
+            next_id += len(vecs)
+            quantized, scales = quantize_int8(vecs)
+            execute_values(cur, f"INSERT INTO {FLOAT_TABLE} (id, user_id, embedding) VALUES %s",
+                           [(i, user_id, v) for i, v in zip(ids, vecs)], page_size=500)
+            execute_values(cur, f"""
+                INSERT INTO {INT8_TABLE} (id, user_id, embedding_i8, embedding_scale, embedding_bits) VALUES %s
+            """, [(i, user_id, q.tobytes(), float(s), binary_signature(v))
+                  for i, q, s, v in zip(ids, quantized, scales, vecs)],
+                template="(%s, %s, %s, %s, %s::varbit)", page_size=500)
+            samples[user_id] = vecs[rng.integers(0, len(vecs), args.queries_per_user)]
+        cur.execute(f"CREATE INDEX ON {FLOAT_TABLE}(user_id);")
+        cur.execute(f"CREATE INDEX ON {INT8_TABLE}(user_id);")
+
+        started = time.perf_counter()
+        cur.execute(f"""
+            CREATE INDEX {FLOAT_TABLE}_hnsw ON {FLOAT_TABLE}
+            USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+        """)
+        build_seconds = time.perf_counter() - started
+        cur.execute(f"VACUUM ANALYZE {FLOAT_TABLE};")
+        cur.execute(f"VACUUM ANALYZE {INT8_TABLE};")
+    return samples, build_seconds
+
+
+def table_sizes(conn, table):
+    """資料表本體（含 TOAST）與索引的大小（bytes）"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_table_size(%s), pg_indexes_size(%s);", (table, table))
+        table_bytes, index_bytes = cur.fetchone()
+    return {'table_bytes': table_bytes, 'index_bytes': index_bytes}
+
+
+def queries(samples, seed=7):
+    """查詢向量：在既有訊息附近加一點雜訊（每次產生相同的序列）"""
+    rng = np.random.default_rng(seed)
+    for user_id, vecs in samples.items():
+        for v in vecs:
+            q = v + 0.2 * rng.standard_normal(v.shape).astype(np.float32)
+            yield user_id, q / np.linalg.norm(q)
+
+
+def run_float(conn, samples, k, settings):
+    latencies, results = [], []
+    with conn.cursor() as cur:
+        for user_id, q in queries(samples):
+            started = time.perf_counter()
+            cur.execute(settings + FLOAT_QUERY, (q, user_id, k))
+            rows = cur.fetchall()
+            latencies.append((time.perf_counter() - started) * 1000)
+            results.append([r[0] for r in rows])
+    return results, latencies
+
+
+def run_int8(conn, samples, k, factor):
+    latencies, results = [], []
+    with conn.cursor() as cur:
+        for user_id, q in queries(samples):
+            started = time.perf_counter()
+            cur.execute(INT8_QUERY, (user_id, binary_signature(q), k * factor))
+            rows = cur.fetchall()
+            vectors = np.stack([dequantize_int8(r[1], r[2]) for r in rows])
+            order = np.argsort(cosine_distances(q, vectors))[:k]
+            latencies.append((time.perf_counter() - started) * 1000)
+            results.append([rows[i][0] for i in order])
+    return results, latencies
+
+
+def recall(results, exact):
+    hits = sum(len(set(a) & set(e)) for a, e in zip(results, exact))
+    total = sum(len(e) for e in exact)
+    return round(hits / total, 4) if total else 0.0
+
+
+def percentile(values, p):
+    return round(float(np.percentile(values, p)), 3) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="嵌入量化 大小 / recall / 延遲報告")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rows-per-user', type=int, default=2000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries-per-user', type=int, default=10)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='int8 模式每次取 k * factor 筆候選重新排序')
+    parser.add_argument('--ef-search', type=int, default=100)
+    parser.add_argument('--output', help='把報告寫成 JSON 檔')
+    parser.add_argument('--keep-table', action='store_true')
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        print("❌ 請設定 DATABASE_URL")
+        sys.exit(1)
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    register_vector(conn)
+
+    rng = np.random.default_rng(42)
+    print(f"🧪 產生資料: {args.users} 位用戶 x {args.rows_per_user} 筆, dim={args.dim}")
+    samples, build_seconds = setup_tables(conn, args, rng)
+
+    exact, exact_latency = run_float(conn, samples, args.k, "SET LOCAL enable_indexscan = off;")
+    hnsw, hnsw_latency = run_float(conn, samples, args.k, f"SET LOCAL hnsw.ef_search = {args.ef_search};")
+    report = {
+        'users': args.users,
+        'rows_per_user': args.rows_per_user,
+        'dim': args.dim,
+        'k': args.k,
+        'vector': {
+            **table_sizes(conn, FLOAT_TABLE),
+            'hnsw_build_seconds': round(build_seconds, 3),
+            'exact': {'p50_ms': percentile(exact_latency, 50), 'p95_ms': percentile(exact_latency, 95)},
+            'hnsw': {'ef_search': args.ef_search, 'recall_at_k': recall(hnsw, exact),
+                     'p50_ms': percentile(hnsw_latency, 50), 'p95_ms': percentile(hnsw_latency, 95)},
+        },
+        'int8': {**table_sizes(conn, INT8_TABLE), 'rerank': []},
+    }
+    for factor in args.factors:
+        results, latency = run_int8(conn, samples, args.k, factor)
+        report['int8']['rerank'].append({
+            'factor': factor,
+            'recall_at_k': recall(results, exact),
+            'p50_ms': percentile(latency, 50),
+            'p95_ms': percentile(latency, 95),
+        })
+
+    mb = 1024 * 1024
+    vector, int8 = report['vector'], report['int8']
+    print(f"\n📦 vector: 資料表 {vector['table_bytes'] / mb:.1f} MB、索引 {vector['index_bytes'] / mb:.1f} MB"
+          f"（HNSW 建立 {vector['hnsw_build_seconds']}s）")
+    print(f"📦 int8:   資料表 {int8['table_bytes'] / mb:.1f} MB、索引 {int8['index_bytes'] / mb:.1f} MB")
+    print(f"\n{'方式':>16} | recall@{args.k} | p50 ms | p95 ms")
+    print(f"{'vector 精確':>16} | {1.0:>8} | {vector['exact']['p50_ms']:>6} | {vector['exact']['p95_ms']:>6}")
+    print(f"{'vector hnsw':>16} | {vector['hnsw']['recall_at_k']:>8} | "
+          f"{vector['hnsw']['p50_ms']:>6} | {vector['hnsw']['p95_ms']:>6}")
+    for row in int8['rerank']:
+        print(f"{'int8 x' + str(row['factor']):>16} | {row['recall_at_k']:>8} | {row['p50_ms']:>6} | {row['p95_ms']:>6}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 報告已寫入 {args.output}")
+
+    if not args.keep_table:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {FLOAT_TABLE}, {INT8_TABLE};")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量索引 recall / 延遲報告
+
+在暫存資料表 lumi_vector_report 產生合成資料（模擬多位用戶、每位用戶多個話題），
+用與 SimpleLumiMemory.get_similar_memories 相同的查詢，比較精確搜尋與 HNSW / IVFFlat
+在不同 ef_search / probes 下的 recall@k 與延遲。
+
+用法：
+    DATABASE_URL=postgresql://... python benchmarks/vector_index_report.py --index hnsw
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
+
+TABLE = 'lumi_vector_report'
+
+SEARCH_QUERY = f"""
+    SELECT id, embedding <=> %s::vector AS distance
+    FROM {TABLE}
+    WHERE user_id = %s
+    ORDER BY distance
+    LIMIT %s;
+"""
+
+
+def make_dataset(rng, n_users, rows_per_user, dim, topics=20):
+    """每位用戶有數個話題中心，訊息是中心附近的雜訊向量（類似「好累」「今天好累喔」）"""
+    for u in range(n_users):
+        centers = rng.standard_normal((topics, dim)).astype(np.float32)
+        picks = rng.integers(0, topics, rows_per_user)
+        vecs = centers[picks] + 0.6 * rng.standard_normal((rows_per_user, dim)).astype(np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        yield f"bench_user_{u}", vecs
+
+
+def setup_table(conn, args, rng):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+        cur.execute(f"""
+            CREATE TABLE {TABLE} (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                embedding VECTOR({args.dim})
+            );
+        """)
+        samples = {}
+        for user_id, vecs in make_dataset(rng, args.users, args.rows_per_user, args.dim):
+            execute_values(cur, f"INSERT INTO {TABLE} (user_id, embedding) VALUES %s",
+                           [(user_id, v) for v in vecs], page_size=500)
+            samples[user_id] = vecs[rng.integers(0, len(vecs), args.queries_per_user)]
+        cur.execute(f"CREATE INDEX ON {TABLE}(user_id);")
+
+        started = time.perf_counter()
+        if args.index == 'hnsw':
+            cur.execute(f"CREATE INDEX ON {TABLE} USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);")
+        else:
+            lists = max(10, args.users * args.rows_per_user // 1000)
+            cur.execute(f"CREATE INDEX ON {TABLE} USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists});")
+        build_seconds = time.perf_counter() - started
+        cur.execute(f"ANALYZE {TABLE};")
+    return samples, build_seconds
+
+
+def run_queries(conn, samples, k, settings, rng):
+    latencies = []
+    results = []
+    with conn.cursor() as cur:
+        for user_id, queries in samples.items():
+            for q in queries:
+                # 查詢向量：在既有訊息附近加一點雜訊
+                q = q + 0.2 * rng.standard_normal(q.shape).astype(np.float32)
+                q /= np.linalg.norm(q)
+                started = time.perf_counter()
+                cur.execute(settings + SEARCH_QUERY, (q, user_id, k))
+                rows = cur.fetchall()
+                latencies.append((time.perf_counter() - started) * 1000)
+                results.append([r[0] for r in rows])
+    return results, latencies
+
+
+def plan_indexes(conn, samples, k, settings):
+    """用 EXPLAIN 看查詢實際走哪個索引"""
+    user_id, queries = next(iter(samples.items()))
+    with conn.cursor() as cur:
+        cur.execute(settings + "EXPLAIN (FORMAT JSON) " + SEARCH_QUERY, (queries[0], user_id, k))
+        plan = cur.fetchone()[0]
+    found = []
+
+    def walk(node):
+        if 'Index Name' in node:
+            found.append(node['Index Name'])
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan[0]['Plan'])
+    return found
+
+
+def percentile(values, p):
+    return round(float(np.percentile(values, p)), 3) if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量索引 recall / 延遲報告")
+    parser.add_argument('--index', choices=['hnsw', 'ivfflat'], default='hnsw')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rows-per-user', type=int, default=2000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries-per-user', type=int, default=10)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--sweep', type=int, nargs='+', default=None,
+                        help='HNSW 的 ef_search 或 IVFFlat 的 probes 清單')
+    parser.add_argument('--output', help='把報告寫成 JSON 檔')
+    parser.add_argument('--keep-table', action='store_true')
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        print("❌ 請設定 DATABASE_URL")
+        sys.exit(1)
+
+    sweep = args.sweep or ([40, 100, 200, 400] if args.index == 'hnsw' else [1, 5, 10, 20])
+    setting_name = 'hnsw.ef_search' if args.index == 'hnsw' else 'ivfflat.probes'
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    register_vector(conn)
+
+    rng = np.random.default_rng(42)
+    print(f"🧪 產生資料: {args.users} 位用戶 x {args.rows_per_user} 筆, dim={args.dim}")
+    samples, build_seconds = setup_table(conn, args, rng)
+    print(f"🏗️ {args.index} 索引建立時間: {build_seconds:.2f}s")
+
+    # 精確搜尋作為 ground truth（關掉 index scan，走 user_id bitmap + 排序）
+    exact, exact_latency = run_queries(conn, samples, args.k, "SET LOCAL enable_indexscan = off;",
+                                       np.random.default_rng(7))
+    report = {
+        'index': args.index,
+        'users': args.users,
+        'rows_per_user': args.rows_per_user,
+        'dim': args.dim,
+        'k': args.k,
+        'build_seconds': round(build_seconds, 3),
+        'exact': {'p50_ms': percentile(exact_latency, 50), 'p95_ms': percentile(exact_latency, 95),
+                  'plan_indexes': plan_indexes(conn, samples, args.k, "SET LOCAL enable_indexscan = off;")},
+        'ann': [],
+    }
+
+    for value in sweep:
+        ann, latency = run_queries(conn, samples, args.k, f"SET LOCAL {setting_name} = {value};",
+                                   np.random.default_rng(7))
+        hits = sum(len(set(a) & set(e)) for a, e in zip(ann, exact))
+        total = sum(len(e) for e in exact)
+        short = sum(1 for a, e in zip(ann, exact) if len(a) < len(e))
+        report['ann'].append({
+            setting_name: value,
+            'plan_indexes': plan_indexes(conn, samples, args.k, f"SET LOCAL {setting_name} = {value};"),
+            'recall_at_k': round(hits / total, 4) if total else 0.0,
+            'short_results': short,
+            'p50_ms': percentile(latency, 50),
+            'p95_ms': percentile(latency, 95),
+        })
+
+    print(f"\n📊 精確搜尋: p50={report['exact']['p50_ms']}ms p95={report['exact']['p95_ms']}ms")
+    print(f"{setting_name:>16} | recall@{args.k} | 結果不足 | p50 ms | p95 ms | 索引")
+    for row in report['ann']:
+        print(f"{row[setting_name]:>16} | {row['recall_at_k']:>8} | {row['short_results']:>8} | "
+              f"{row['p50_ms']:>6} | {row['p95_ms']:>6} | {','.join(row['plan_indexes'])}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 報告已寫入 {args.output}")
+
+    if not args.keep_table:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+webhook 端到端壓測：以本地替身啟動完整的 Flask app，重播簽名過的 LINE webhook
+
+- 假 OpenAI（/v1/chat/completions 串流 / 非串流、/v1/embeddings）：延遲與錯誤率可調，
+  嵌入使用 HashingEmbeddingBackend，相似的訊息會得到相似的向量
+- 假 LINE Messaging API（/v2/bot/message/reply、/v2/bot/message/push）：記錄每個 reply token 的回覆時間
+- 資料庫：DATABASE_URL 指向的本地 Postgres 中重新建立的 lumi_webhook_bench（或 --engine sqlite 使用暫存目錄）
+- app 以與 Dockerfile 相同的 gunicorn 設定啟動（worker / thread 數可調），OPENAI_API_BASE 與 LINE_API_HOST 指向替身
+
+依 --rate 排程送出請求（open loop，不會因為 app 變慢而少送），用戶依 Zipf 分布挑選。延遲從排定的送出時間起算，
+送不出去（--concurrency 用完）的等待也算在內。報告包含：
+- 吞吐量、webhook HTTP 延遲與端到端延遲（收到 webhook 到假 LINE 收到回覆）的 p50 / p95 / p99
+- HTTP 狀態碼、錯誤與逾時次數，reply / push 次數與沒有收到回覆的請求數
+- app 的 /metrics/summary（各階段 p50 / p95 / p99，最近 1024 筆樣本）與 /hot_index/stats 等統計
+
+--output 寫成 JSON，下次以 --compare 比較兩個版本；--max-regression 超過時以 exit code 1 結束（可放進 CI）。
+
+用法：
+    DATABASE_URL=postgresql://postgres@localhost/postgres python benchmarks/webhook_load.py \\
+        --rate 5 --duration 60 --users 50 --output webhook_baseline.json
+    python benchmarks/webhook_load.py --engine sqlite --rate 5 --duration 60 --env WEBHOOK_ASYNC_MODE=true \\
+        --compare webhook_baseline.json --max-regression 20
+"""
+
+import os
+import sys
+import json
+import hmac
+import time
+import base64
+import random
+import shutil
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import psycopg2
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from embedding_backends import HashingEmbeddingBackend, OPENAI_MODEL_DIMS
+
+BENCH_DATABASE = 'lumi_webhook_bench'
+CHANNEL_SECRET = 'bench-channel-secret'
+
+MESSAGES = [
+    "今天上班好累", "晚餐想吃拉麵", "我喜歡貓", "週末想去爬山", "明天要考試好緊張",
+    "最近睡不太好", "剛剛跟朋友吵架了", "下雨天好想待在家", "我叫小明", "工作做不完怎麼辦",
+    "今天被老闆稱讚了！", "好想出國玩", "肚子好餓喔", "你記得我是誰嗎", "最近在學吉他",
+]
+DIARY_MESSAGE = "幫我總結今天"
+REPLY_TEXT = "嗯嗯，我懂你的感覺。今天真的辛苦了！要不要跟我多說一點？我一直都在這裡陪你喔。"
+
+# 報告中比較的項目：(路徑, 數值變大是否代表變差)
+COMPARE_KEYS = [
+    (('throughput', 'http_rps'), False),
+    (('throughput', 'reply_rps'), False),
+    (('http_ms', 'p50'), True), (('http_ms', 'p95'), True), (('http_ms', 'p99'), True),
+    (('end_to_end_ms', 'p50'), True), (('end_to_end_ms', 'p95'), True), (('end_to_end_ms', 'p99'), True),
+    (('requests', 'errors'), True), (('requests', 'timeouts'), True), (('line', 'missing'), True),
+]
+# --max-regression 檢查的項目
+GATE_KEYS = [('throughput', 'reply_rps'), ('http_ms', 'p95'), ('end_to_end_ms', 'p95')]
+
+
+# ====== 本地替身 ======
+
+class StubServer:
+    """在背景執行緒執行的 ThreadingHTTPServer，handler 透過 self.server.stub 取得狀態"""
+
+    def __init__(self, handler_class):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.lock = threading.Lock()
+        self.counts = {}
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeOpenAI(StubServer):
+    def __init__(self, llm_latency=0.5, token_interval=0.02, embedding_latency=0.05, error_rate=0.0, seed=0):
+        super().__init__(FakeOpenAIHandler)
+        self.llm_latency = llm_latency
+        self.token_interval = token_interval
+        self.embedding_latency = embedding_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._backends = {}
+
+    def embed(self, texts, dim):
+        backend = self._backends.get(dim)
+        if backend is None:
+            backend = self._backends[dim] = HashingEmbeddingBackend(dim=dim)
+        return backend.embed(texts)
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+class FakeOpenAIHandler(StubHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.read_json()
+        if self.path.endswith('/embeddings'):
+            texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+            stub.count('embedding_requests')
+            stub.count('embedding_inputs', len(texts))
+            time.sleep(stub.embedding_latency)
+            dim = body.get('dimensions') or OPENAI_MODEL_DIMS.get(body.get('model'), 1536)
+            self.send_json({
+                'object': 'list', 'model': body.get('model'),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': v}
+                         for i, v in enumerate(stub.embed(texts, dim))],
+                'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+            })
+        elif self.path.endswith('/chat/completions'):
+            stream = bool(body.get('stream'))
+            stub.count('chat_stream' if stream else 'chat')
+            time.sleep(stub.llm_latency)
+            if stub.should_fail():
+                stub.count('chat_errors_injected')
+                self.send_json({'error': {'message': 'injected error', 'type': 'server_error'}}, status=500)
+            elif stream:
+                self.stream_reply()
+            else:
+                self.send_json({
+                    'id': 'chatcmpl-bench', 'object': 'chat.completion', 'model': body.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': REPLY_TEXT},
+                                 'finish_reason': 'stop'}],
+                    'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+                })
+        else:
+            self.send_json({'error': {'message': 'not found'}}, status=404)
+
+    def stream_reply(self):
+        stub = self.server.stub
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i in range(0, len(REPLY_TEXT), 4):
+                chunk = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk',
+                         'choices': [{'index': 0, 'delta': {'content': REPLY_TEXT[i:i + 4]}, 'finish_reason': None}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(stub.token_interval)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # app 的期限到了就會關閉串流
+            stub.count('chat_stream_closed_early')
+
+
+class FakeLine(StubServer):
+    def __init__(self, latency=0.05):
+        super().__init__(FakeLineHandler)
+        self.latency = latency
+        self.replied_at = {}
+        self.pushes = {}
+
+    def answered(self):
+        with self.lock:
+            return len(self.replied_at) + sum(self.pushes.values())
+
+
+class FakeLineHandler(StubHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.read_json()
+        received = time.monotonic()
+        time.sleep(stub.latency)
+        if self.path == '/v2/bot/message/reply':
+            with stub.lock:
+                stub.replied_at[body['replyToken']] = received
+        elif self.path == '/v2/bot/message/push':
+            with stub.lock:
+                stub.pushes[body['to']] = stub.pushes.get(body['to'], 0) + 1
+        else:
+            self.send_json({'message': 'not found'}, status=404)
+            return
+        self.send_json({'sentMessages': [{'id': '1', 'quoteToken': 'bench'}]})
+
+
+# ====== 資料庫與 app ======
+
+def scratch_database(dsn, name):
+    """重新建立空的壓測資料庫（含 vector 擴展），回傳連線字串"""
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE);")
+        cur.execute(f"CREATE DATABASE {name};")
+    admin.close()
+    bench_dsn = psycopg2.extensions.make_dsn(dsn, dbname=name)
+    conn = psycopg2.connect(bench_dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    conn.close()
+    return bench_dsn
+
+
+def drop_database(dsn, name):
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE);")
+    admin.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(env, port, args, log_file):
+    """與 Dockerfile 相同的 gunicorn 啟動方式，等 /health 回應後回傳 process"""
+    cmd = [sys.executable, '-m', 'gunicorn', '--bind', f"127.0.0.1:{port}",
+           f"--workers={args.workers}", f"--threads={args.threads}", '--timeout=120',
+           '--log-level=warning', 'app:app']
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app 啟動失敗（exit code {process.returncode}），請查看 {log_file.name}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).ok:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"app 在 {args.startup_timeout} 秒內沒有回應 /health，請查看 {log_file.name}")
+
+
+def parse_env(pairs):
+    env = {}
+    for pair in pairs or []:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit(f"--env 格式應為 KEY=VALUE：{pair}")
+        env[key] = value
+    return env
+
+
+# ====== 產生負載 ======
+
+def make_schedule(args, rng):
+    """(送出時間偏移秒數, user_id, 訊息)；用戶依 Zipf(s) 分布，s=0 為平均分布"""
+    total = args.requests or int(args.rate * args.duration)
+    users = [f"Ubench{i:05d}" for i in range(args.users)]
+    weights = 1.0 / np.arange(1, args.users + 1) ** args.zipf
+    picks = rng.choice(args.users, size=total, p=weights / weights.sum())
+    diary = rng.random(total) < args.diary_ratio
+    messages = rng.integers(0, len(MESSAGES), total)
+    return [(i / args.rate, users[picks[i]], DIARY_MESSAGE if diary[i] else MESSAGES[messages[i]])
+            for i in range(total)]
+
+
+def webhook_body(user_id, text, reply_token, index):
+    return json.dumps({
+        'destination': 'Ubenchbot',
+        'events': [{
+            'type': 'message', 'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'user', 'userId': user_id},
+            'webhookEventId': f"bench{index:08d}",
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': reply_token,
+            'message': {'type': 'text', 'id': str(index), 'quoteToken': f"q{index}", 'text': text},
+        }],
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def sign(body, secret=CHANNEL_SECRET):
+    return base64.b64encode(hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()).decode('ascii')
+
+
+def run_load(url, schedule, args, run_id):
+    """依排程送出 webhook，回傳每個請求的結果"""
+    local = threading.local()
+    results = [None] * len(schedule)
+
+    def send(index, scheduled, user_id, text):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        reply_token = f"{run_id}-{index}"
+        body = webhook_body(user_id, text, reply_token, index)
+        result = {'reply_token': reply_token, 'scheduled': scheduled, 'sent': time.monotonic(),
+                  'status': None, 'error': None}
+        try:
+            response = session.post(url, data=body, timeout=args.timeout, headers={
+                'Content-Type': 'application/json', 'X-Line-Signature': sign(body)})
+            result['status'] = response.status_code
+        except requests.Timeout:
+            result['error'] = 'timeout'
+        except requests.RequestException as e:
+            result['error'] = type(e).__name__
+        result['done'] = time.monotonic()
+        results[index] = result
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        started = time.monotonic()
+        for index, (offset, user_id, text) in enumerate(schedule):
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, index, started + offset, user_id, text)
+    return started, results
+
+
+def wait_for_replies(line, expected, timeout):
+    """非同步模式下 HTTP 回應時訊息還沒處理完，等假 LINE 收到全部回覆"""
+    deadline = time.monotonic() + timeout
+    while line.answered() < expected and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+# ====== 報告 ======
+
+def latency_summary(seconds):
+    values = [s * 1000 for s in seconds]
+    if not values:
+        return {'count': 0, 'avg': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'avg': round(float(np.mean(values)), 2), 'p50': round(float(p50), 2),
+            'p95': round(float(p95), 2), 'p99': round(float(p99), 2), 'max': round(float(max(values)), 2)}
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def fetch_json(base_url, path):
+    try:
+        return requests.get(base_url + path, timeout=10).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def build_report(args, env_overrides, started, results, line, openai_stub, base_url):
+    ok = [r for r in results if r['status'] == 200]
+    statuses = {}
+    for r in results:
+        key = str(r['status']) if r['status'] is not None else r['error']
+        statuses[key] = statuses.get(key, 0) + 1
+    replied = [line.replied_at[r['reply_token']] - r['scheduled'] for r in ok if r['reply_token'] in line.replied_at]
+    pushes = sum(line.pushes.values())
+    last_done = max((r['done'] for r in results), default=started)
+    last_reply = max(line.replied_at.values(), default=started)
+    summary = fetch_json(base_url, '/metrics/summary') or {}
+
+    return {
+        'version': git_version(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            'engine': args.engine, 'rate': args.rate, 'requests': len(results), 'users': args.users,
+            'zipf': args.zipf, 'diary_ratio': args.diary_ratio, 'concurrency': args.concurrency,
+            'timeout': args.timeout, 'workers': args.workers, 'threads': args.threads,
+            'llm_latency': args.llm_latency, 'token_interval': args.token_interval,
+            'embedding_latency': args.embedding_latency, 'line_latency': args.line_latency,
+            'llm_error_rate': args.llm_error_rate, 'seed': args.seed, 'env': env_overrides,
+        },
+        'throughput': {
+            'offered_rps': args.rate,
+            'http_rps': round(len(ok) / (last_done - started), 2) if ok else 0.0,
+            'reply_rps': round(len(replied) / (last_reply - started), 2) if replied else 0.0,
+            'elapsed_s': round(max(last_done, last_reply) - started, 2),
+        },
+        'requests': {
+            'sent': len(results), 'ok': len(ok),
+            'errors': sum(1 for r in results if r['status'] != 200 and r['error'] != 'timeout'),
+            'timeouts': sum(1 for r in results if r['error'] == 'timeout'),
+            'status': statuses,
+        },
+        'http_ms': latency_summary([r['done'] - r['scheduled'] for r in ok]),
+        'start_lag_ms': latency_summary([r['sent'] - r['scheduled'] for r in results]),
+        'end_to_end_ms': latency_summary(replied),
+        'line': {'replies': len(line.replied_at), 'pushes': pushes,
+                 'missing': max(0, len(ok) - len(line.replied_at) - pushes)},
+        'openai': dict(sorted(openai_stub.counts.items())),
+        'stages': summary.get('stages', {}),
+        'counters': summary.get('counters', {}),
+        'server': {path.strip('/').replace('/stats', ''): fetch_json(base_url, path)
+                   for path in ('/webhook/stats', '/db/stats', '/embedding/stats', '/hot_index/stats',
+                                '/write_behind/stats')},
+    }
+
+
+def print_report(report):
+    t, r = report['throughput'], report['requests']
+    print(f"\n📊 吞吐量: {t['http_rps']} req/s（HTTP）/ {t['reply_rps']} 回覆/s，目標 {t['offered_rps']} req/s")
+    print(f"   請求 {r['sent']} 筆：成功 {r['ok']}、錯誤 {r['errors']}、逾時 {r['timeouts']}  狀態 {r['status']}")
+    print(f"   LINE：reply {report['line']['replies']}、push {report['line']['pushes']}、"
+          f"沒有回覆 {report['line']['missing']}")
+    print(f"{'':>24} | {'p50 ms':>9} | {'p95 ms':>9} | {'p99 ms':>9} | 次數")
+    for name in ('http_ms', 'end_to_end_ms', 'start_lag_ms'):
+        s = report[name]
+        print(f"{name:>24} | {s['p50']:>9} | {s['p95']:>9} | {s['p99']:>9} | {s['count']}")
+    for stage, s in report['stages'].items():
+        errors = f"（錯誤 {s['errors']}）" if s['errors'] else ''
+        print(f"{stage:>24} | {s['p50_ms']:>9} | {s['p95_ms']:>9} | {s['p99_ms']:>9} | {s['count']}{errors}")
+
+
+def lookup(report, path):
+    value = report
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(report, baseline, max_regression=None):
+    """印出與 baseline 的差異，回傳超過 max_regression（%）的項目"""
+    keys = list(COMPARE_KEYS)
+    for stage in sorted(set(report['stages']) | set(baseline.get('stages', {}))):
+        keys += [(('stages', stage, f"{p}_ms"), True) for p in ('p50', 'p95', 'p99')]
+    print(f"\n🔍 與 baseline 比較（{baseline.get('version')} → {report.get('version')}）")
+    print(f"{'項目':>32} | {'baseline':>10} | {'目前':>10} | 變化")
+    regressions = []
+    for path, higher_is_worse in keys:
+        old, new = lookup(baseline, path), lookup(report, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change > 0 if higher_is_worse else change < 0
+        mark = '⚠️' if worse and abs(change) >= 10 else ''
+        print(f"{'.'.join(path):>32} | {old:>10} | {new:>10} | {change:+.1f}% {mark}")
+        if max_regression is not None and path in GATE_KEYS and worse and abs(change) > max_regression:
+            regressions.append('.'.join(path))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webhook 端到端壓測（假 OpenAI / 假 LINE / 本地資料庫）")
+    parser.add_argument('--engine', choices=['postgres', 'sqlite'], default='postgres',
+                        help='postgres 需要 --database-url 或 DATABASE_URL（會建立 lumi_webhook_bench 資料庫）')
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    parser.add_argument('--keep-database', action='store_true', help='結束後保留壓測資料庫 / 資料目錄')
+    parser.add_argument('--rate', type=float, default=5.0, help='每秒送出的 webhook 數')
+    parser.add_argument('--duration', type=float, default=30.0, help='送出的秒數（與 --requests 擇一）')
+    parser.add_argument('--requests', type=int, default=None, help='總請求數')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--zipf', type=float, default=1.1, help='用戶分布的 Zipf 參數，0 為平均分布')
+    parser.add_argument('--diary-ratio', type=float, default=0.02, help='觸發日記的訊息比例')
+    parser.add_argument('--concurrency', type=int, default=64, help='同時送出中的請求上限')
+    parser.add_argument('--timeout', type=float, default=60.0, help='webhook 請求逾時秒數')
+    parser.add_argument('--drain-timeout', type=float, default=60.0, help='送完後等待回覆的秒數')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker 數（Dockerfile 為 1）')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn 每個 worker 的 thread 數')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='假 OpenAI 第一個 token 前的延遲（秒）')
+    parser.add_argument('--token-interval', type=float, default=0.02, help='串流每段之間的延遲（秒）')
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--line-latency', type=float, default=0.05)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='假 OpenAI 回傳 500 的比例')
+    parser.add_argument('--env', action='append', metavar='KEY=VALUE', help='傳給 app 的環境變數（可重複）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--app-log', default=None, help='app 輸出的日誌檔（預設為暫存檔）')
+    parser.add_argument('--output', help='把報告寫成 JSON 檔')
+    parser.add_argument('--compare', help='要比較的 baseline JSON')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='回覆吞吐量或 HTTP / 端到端 p95 比 baseline 差超過這個百分比時 exit code 為 1')
+    args = parser.parse_args()
+
+    if args.engine == 'postgres' and not args.database_url:
+        print("❌ 請設定 DATABASE_URL（本地 Postgres）或使用 --engine sqlite")
+        sys.exit(1)
+    env_overrides = parse_env(args.env)
+    rng = np.random.default_rng(args.seed)
+    schedule = make_schedule(args, rng)
+    run_id = f"bench{int(time.time())}"
+
+    openai_stub = FakeOpenAI(args.llm_latency, args.token_interval, args.embedding_latency,
+                             args.llm_error_rate, args.seed).start()
+    line = FakeLine(args.line_latency).start()
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'LINE_CHANNEL_ACCESS_TOKEN': 'bench-access-token',
+        'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+        'LINE_API_HOST': line.url,
+        'OPENAI_API_KEY': 'bench-key',
+        'OPENAI_API_BASE': f"{openai_stub.url}/v1",
+        'LOG_LEVEL': 'WARNING',
+    })
+    data_dir = None
+    if args.engine == 'postgres':
+        env['DATABASE_URL'] = scratch_database(args.database_url, BENCH_DATABASE)
+        env['MEMORY_ENGINE'] = 'postgres'
+    else:
+        data_dir = tempfile.mkdtemp(prefix='lumi_webhook_bench_')
+        env.pop('DATABASE_URL', None)
+        env.update({'MEMORY_ENGINE': 'sqlite', 'LOCAL_MEMORY_DIR': data_dir})
+    env.update(env_overrides)
+
+    log_file = open(args.app_log, 'w') if args.app_log else tempfile.NamedTemporaryFile(
+        'w', prefix='lumi_webhook_bench_', suffix='.log', delete=False)
+    base_url = f"http://127.0.0.1:{port}"
+    process = None
+    try:
+        print(f"🚀 啟動 app（{args.engine}，gunicorn {args.workers} worker x {args.threads} thread），日誌：{log_file.name}")
+        process = start_app(env, port, args, log_file)
+        print(f"🧪 送出 {len(schedule)} 個 webhook：{args.rate} req/s，{args.users} 位用戶（zipf={args.zipf}）")
+        started, results = run_load(f"{base_url}/callback", schedule, args, run_id)
+        wait_for_replies(line, sum(1 for r in results if r['status'] == 200), args.drain_timeout)
+        report = build_report(args, env_overrides, started, results, line, openai_stub, base_url)
+    finally:
+        if process:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        log_file.close()
+        openai_stub.stop()
+        line.stop()
+        if not args.keep_database:
+            if args.engine == 'postgres':
+                drop_database(args.database_url, BENCH_DATABASE)
+            elif data_dir:
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 報告已寫入 {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.max_regression)
+        if regressions:
+            print(f"\n❌ 超過 {args.max_regression}% 的退步：{', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
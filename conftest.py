@@ -0,0 +1,19 @@
+"""
+pytest 共用設定：測試不寫入 repo 目錄，也不在程式結束時呼叫外部 API
+
+ai_logic 在 import 時就會建立共用的記憶系統（沒有 DATABASE_URL 時是本地儲存引擎），
+所以在收集測試之前先把本地資料目錄指到暫存目錄、關閉 write-behind，嵌入改用本地雜湊。
+個別測試仍可用 monkeypatch 覆寫這些設定。
+"""
+import os
+import shutil
+import tempfile
+
+_local_dir = tempfile.mkdtemp(prefix='lumi_test_')
+os.environ['LOCAL_MEMORY_DIR'] = _local_dir
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+os.environ['EMBEDDING_BACKEND'] = 'hashing'
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_local_dir, ignore_errors=True)
@@ -0,0 +1,208 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeoutError(Exception):
+    """在 checkout timeout 內拿不到連線"""
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'last_used', 'suspect')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.last_used = time.monotonic()
+        self.suspect = False
+
+
+class PgConnectionPool:
+    """執行緒安全的 psycopg2 連線池
+
+    - 連線以 autocommit 模式建立，單句讀寫不會留下 idle-in-transaction
+    - 只有在連線閒置超過 health_check_idle 秒或上次使用出錯時，checkout 才會做 SELECT 1
+    - 壞掉的連線會被丟棄並自動重建
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=5, checkout_timeout=5.0,
+                 health_check_idle=30.0, on_connect=None):
+        self.dsn = dsn
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size), self.min_size)
+        self.checkout_timeout = float(checkout_timeout)
+        self.health_check_idle = float(health_check_idle)
+        self.on_connect = on_connect
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._total = 0
+        self._closed = False
+
+        self._stats = {
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+        }
+
+        # 預先建立最小連線數，第一次建立失敗會直接拋出例外
+        for _ in range(self.min_size):
+            pooled = self._create()
+            with self._cond:
+                self._total += 1
+                self._idle.append(pooled)
+
+    def _create(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.autocommit = True
+            if self.on_connect:
+                self.on_connect(conn)
+        except Exception:
+            conn.close()
+            raise
+        with self._cond:
+            self._stats['connections_created'] += 1
+        return _PooledConnection(conn)
+
+    def _discard(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._total -= 1
+            self._stats['connections_discarded'] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, pooled):
+        if pooled.conn.closed:
+            return False
+        idle_for = time.monotonic() - pooled.last_used
+        if not pooled.suspect and idle_for < self.health_check_idle:
+            return True
+        with self._cond:
+            self._stats['health_checks'] += 1
+        try:
+            with pooled.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            pooled.suspect = False
+            return True
+        except Exception:
+            with self._cond:
+                self._stats['health_check_failures'] += 1
+            return False
+
+    def _checkout(self):
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        while True:
+            pooled = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError("連線池已關閉")
+                    if self._idle:
+                        pooled = self._idle.pop()
+                        break
+                    if self._total < self.max_size:
+                        self._total += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['checkout_timeouts'] += 1
+                        raise PoolTimeoutError(f"{self.checkout_timeout:.1f} 秒內無法取得資料庫連線")
+                    self._cond.wait(remaining)
+
+            if create:
+                try:
+                    pooled = self._create()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(pooled):
+                self._discard(pooled)
+                continue
+
+            waited = time.monotonic() - start
+            with self._cond:
+                self._stats['checkouts'] += 1
+                self._stats['wait_seconds_total'] += waited
+                if waited > self._stats['wait_seconds_max']:
+                    self._stats['wait_seconds_max'] = waited
+            return pooled
+
+    def _checkin(self, pooled, error=None):
+        conn = pooled.conn
+        if conn.closed or isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            self._discard(pooled)
+            return
+        if error is not None:
+            pooled.suspect = True
+        try:
+            # 呼叫端若關掉 autocommit 或留下未結束的交易，歸還前先還原
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if not conn.autocommit:
+                conn.autocommit = True
+        except Exception:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        with self._cond:
+            if self._closed:
+                self._total -= 1
+                conn.close()
+                return
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as conn: ..."""
+        pooled = self._checkout()
+        try:
+            yield pooled.conn
+        except Exception as e:
+            self._checkin(pooled, e)
+            raise
+        else:
+            self._checkin(pooled)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            try:
+                pooled.conn.close()
+            except Exception:
+                pass
+
+    def get_stats(self):
+        """連線池等待時間與 checkout 次數"""
+        with self._cond:
+            stats = dict(self._stats)
+            checkouts = stats['checkouts']
+            stats['avg_wait_ms'] = round(stats['wait_seconds_total'] / checkouts * 1000, 3) if checkouts else 0.0
+            stats['wait_seconds_total'] = round(stats['wait_seconds_total'], 4)
+            stats['wait_seconds_max'] = round(stats['wait_seconds_max'], 4)
+            stats['size'] = self._total
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._total - len(self._idle)
+            stats['min_size'] = self.min_size
+            stats['max_size'] = self.max_size
+            return stats
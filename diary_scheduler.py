@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+
+import metrics
+from lumi_logging import log_user
+from user_time import get_zone
+
+logger = logging.getLogger(__name__)
+
+
+def parse_window(text):
+    """'16:00-19:00' → ((16, 0), (19, 0))；結束早於開始表示跨過午夜"""
+    start, end = (part.strip() for part in text.split('-'))
+
+    def hm(value):
+        hour, _, minute = value.partition(':')
+        return int(hour), int(minute or 0)
+    return hm(start), hm(end)
+
+
+def in_window(window, now):
+    start, end = window
+    current = (now.hour, now.minute)
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+class DiaryPrecomputeScheduler:
+    """在離峰時段預先把當天有聊天的用戶日記整理好
+
+    - 只在 window 時段內執行，每 interval 秒掃一次「日記落後於對話」的用戶
+    - 同時最多 max_concurrency 位用戶、每分鐘最多 rate_per_minute 位（LLM 呼叫的速率上限）
+    - busy_func() 為 True 時（例如 webhook 佇列有積壓）暫停，讓出資源給即時回覆
+    - lock 是 context manager，回傳 False 時表示其他 process 正在執行，本輪略過
+
+    precompute_func(user_id, date_str) 就是觸發日記時的同一條路徑，結果寫入同一份日記快取；
+    之後用戶要求日記時，若沒有新對話就直接回傳。
+    """
+
+    def __init__(self, precompute_func, list_users_func, window=((16, 0), (19, 0)), interval=600,
+                 max_concurrency=2, rate_per_minute=30, batch_limit=200, busy_func=None, lock=None,
+                 clock=None):
+        self.precompute_func = precompute_func
+        self.list_users_func = list_users_func
+        self.window = window
+        self.interval = float(interval)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_gap = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.batch_limit = max(1, int(batch_limit))
+        self.busy_func = busy_func or (lambda: False)
+        self.lock = lock or nullcontext
+        # 時段與日期以 USER_TIMEZONE 計算
+        self.clock = clock or (lambda: datetime.now(get_zone()))
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'runs': 0, 'skipped_locked': 0, 'users': 0, 'failed': 0, 'paused_seconds': 0.0,
+                       'statuses': {}, 'last_run_at': None, 'last_run_seconds': 0.0}
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="diary-precompute", daemon=True)
+        self._thread.start()
+        logger.info("✅ 日記預先產生排程已啟動: window=%02d:%02d-%02d:%02d concurrency=%d",
+                    *self.window[0], *self.window[1], self.max_concurrency)
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            if in_window(self.window, self.clock()):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error("❌ 日記預先產生失敗: %s", e)
+            self._stop.wait(self.interval)
+
+    def _wait_turn(self, next_start):
+        """等到速率限制允許、且服務不忙碌時回傳 True；停止或離開時段時回傳 False"""
+        paused_at = None
+        while not self._stop.is_set():
+            if not in_window(self.window, self.clock()):
+                return False
+            if self.busy_func():
+                paused_at = paused_at or time.monotonic()
+                self._stop.wait(1.0)
+                continue
+            delay = next_start - time.monotonic()
+            if delay <= 0:
+                break
+            self._stop.wait(delay)
+        if paused_at:
+            with self._stats_lock:
+                self._stats['paused_seconds'] += time.monotonic() - paused_at
+        return not self._stop.is_set()
+
+    def _precompute(self, user_id, date_str, slots):
+        try:
+            _, status = self.precompute_func(user_id, date_str)
+        except Exception as e:
+            status = 'failed'
+            logger.error("❌ 預先產生日記失敗: %s", e, extra=log_user(user_id))
+        finally:
+            slots.release()
+        metrics.inc('diary_precompute', status=status)
+        with self._stats_lock:
+            self._stats['users'] += 1
+            if status in ('failed', 'error'):
+                self._stats['failed'] += 1
+            self._stats['statuses'][status] = self._stats['statuses'].get(status, 0) + 1
+
+    def run_once(self):
+        """掃一次並整理落後的日記，回傳處理的用戶數"""
+        started = time.monotonic()
+        date_str = self.clock().strftime('%Y-%m-%d')
+        with self.lock() as locked:
+            if locked is False:
+                with self._stats_lock:
+                    self._stats['skipped_locked'] += 1
+                return 0
+            user_ids = self.list_users_func(date_str, self.batch_limit)
+            slots = threading.Semaphore(self.max_concurrency)
+            submitted = 0
+            next_start = time.monotonic()
+            with metrics.span('diary_precompute'), \
+                    ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="diary-precompute") as executor:
+                for user_id in user_ids:
+                    if not self._wait_turn(next_start):
+                        break
+                    slots.acquire()
+                    next_start = time.monotonic() + self.min_gap
+                    executor.submit(self._precompute, user_id, date_str, slots)
+                    submitted += 1
+        elapsed = time.monotonic() - started
+        with self._stats_lock:
+            self._stats['runs'] += 1
+            self._stats['last_run_at'] = self.clock().isoformat()
+            self._stats['last_run_seconds'] = round(elapsed, 3)
+        logger.info("日記預先產生完成: users=%d/%d elapsed=%.1fs", submitted, len(user_ids), elapsed)
+        return submitted
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats, statuses=dict(self._stats['statuses']))
+        stats['running'] = self._thread is not None
+        stats['in_window'] = in_window(self.window, self.clock())
+        stats['window'] = '%02d:%02d-%02d:%02d' % (*self.window[0], *self.window[1])
+        stats['paused_seconds'] = round(stats['paused_seconds'], 3)
+        return stats
@@ -0,0 +1,42 @@
+import metrics
+
+
+class DiaryStore:
+    """lumi_daily_diaries 資料表：每位用戶每天一份日記，以及已整理到哪一筆對話
+
+    last_memory_at 是日記已包含的最後一筆對話的時間，下次只需要整理這之後的對話。
+    多個 worker 同時更新同一天的日記時，只保留整理得比較新的版本。
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def get(self, user_id, date_str):
+        """回傳 {'diary', 'last_memory_at', 'turn_count'}，沒有資料時回傳 None"""
+        if not self.pool:
+            return None
+        with metrics.span('db.daily_diary'), self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT diary, last_memory_at, turn_count
+                FROM lumi_daily_diaries
+                WHERE user_id = %s AND diary_date = %s;
+            """, (user_id, date_str))
+            row = cur.fetchone()
+        if not row:
+            return None
+        return {'diary': row[0], 'last_memory_at': row[1].isoformat(), 'turn_count': row[2]}
+
+    def save(self, user_id, date_str, diary, last_memory_at, turn_count):
+        """寫入日記；資料庫中已有整理到更新對話的版本時不覆蓋，回傳是否寫入"""
+        with metrics.span('db.daily_diary_upsert'), self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO lumi_daily_diaries (user_id, diary_date, diary, last_memory_at, turn_count, updated_at)
+                VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id, diary_date) DO UPDATE SET
+                    diary = EXCLUDED.diary,
+                    last_memory_at = EXCLUDED.last_memory_at,
+                    turn_count = EXCLUDED.turn_count,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE lumi_daily_diaries.last_memory_at < EXCLUDED.last_memory_at;
+            """, (user_id, date_str, diary, last_memory_at, turn_count))
+            return cur.rowcount > 0
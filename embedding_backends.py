@@ -0,0 +1,102 @@
+"""
+嵌入後端：由 EMBEDDING_BACKEND 選擇
+
+- openai（預設）：呼叫 OpenAI embedding API（EMBEDDING_MODEL，預設 text-embedding-ada-002，1536 維）
+- hashing：本地的字元 n-gram 雜湊嵌入（NumPy），不需要網路也不花 API 費用，短訊息只要幾十微秒；
+  適合低延遲部署、離線開發、測試與效能基準。語意能力不如 OpenAI，只能抓到字面上的相似
+  （「今天好累」與「好累喔」相近，「好累」與「好疲倦」則不會）
+
+每個後端都有：
+- model：模型名稱，用於嵌入快取的 key，也會記錄在 lumi_embedding_config
+- dim：向量維度，必須與資料庫欄位的維度相同（見 schema.ensure_embedding_config）
+- local：True 表示在 process 內計算，不需要快取與微批次
+- embed(texts)：回傳與 texts 對應的 list[float]，失敗時拋出例外
+"""
+import os
+import re
+import zlib
+
+import numpy as np
+import openai
+
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+DEFAULT_OPENAI_MODEL = "text-embedding-ada-002"
+# OpenAI 各模型的原生維度；text-embedding-3 系列可以用 dimensions 參數縮短
+OPENAI_MODEL_DIMS = {
+    'text-embedding-ada-002': 1536,
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+}
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class OpenAIEmbeddingBackend:
+    local = False
+
+    def __init__(self, model=DEFAULT_OPENAI_MODEL, dim=None):
+        self.model = model
+        self.native_dim = OPENAI_MODEL_DIMS.get(model)
+        self.dim = int(dim or self.native_dim or 1536)
+
+    def embed(self, texts):
+        """呼叫 OpenAI embedding API（input 可以是多段文字）"""
+        kwargs = {}
+        if self.native_dim and self.dim != self.native_dim:
+            kwargs['dimensions'] = self.dim
+        result = openai.Embedding.create(input=texts, model=self.model, **kwargs)
+        embeddings = [None] * len(texts)
+        for item in result['data']:
+            embeddings[item['index']] = item['embedding']
+        return embeddings
+
+
+class HashingEmbeddingBackend:
+    """字元 n-gram 雜湊到固定維度（feature hashing），結果為單位向量
+
+    每個 n-gram 以 crc32 決定落在哪一維與正負號，與 Python 的 hash seed 無關，
+    不同 process、不同機器算出來的向量都一樣。
+    """
+    local = True
+
+    def __init__(self, dim=1536, ngram_range=(1, 3)):
+        self.dim = int(dim)
+        self.ngram_range = tuple(ngram_range)
+        self.model = f"hashing-char{self.ngram_range[0]}{self.ngram_range[1]}-{self.dim}"
+
+    def _embed_one(self, text):
+        text = _WHITESPACE.sub(' ', text.strip().lower())
+        indexes = []
+        signs = []
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(text) - n + 1):
+                digest = zlib.crc32(text[i:i + n].encode('utf-8'))
+                indexes.append(digest % self.dim)
+                # 最高位元決定正負號，與取餘數用到的低位元無關
+                signs.append(1.0 if digest & 0x80000000 else -1.0)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if indexes:
+            np.add.at(vector, indexes, signs)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed(self, texts):
+        return [self._embed_one(text) for text in texts]
+
+
+BACKENDS = ('openai', 'hashing')
+
+
+def get_backend(name=None, model=None, dim=None):
+    """依參數或環境變數（EMBEDDING_BACKEND / EMBEDDING_MODEL / EMBEDDING_DIM）建立嵌入後端"""
+    name = (name or os.getenv('EMBEDDING_BACKEND', 'openai')).lower()
+    dim = dim or (int(os.getenv('EMBEDDING_DIM')) if os.getenv('EMBEDDING_DIM') else None)
+    if name == 'openai':
+        return OpenAIEmbeddingBackend(model or os.getenv('EMBEDDING_MODEL', DEFAULT_OPENAI_MODEL), dim)
+    if name == 'hashing':
+        return HashingEmbeddingBackend(dim or 1536)
+    raise ValueError(f"不支援的嵌入後端: {name}（可用：{', '.join(BACKENDS)}）")
@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import openai
+
+# 只有單筆輸入本身有問題時才值得拆開重送；限流、逾時、連線錯誤拆開只會送出更多請求
+SPLIT_ERRORS = (openai.error.InvalidRequestError,)
+
+
+class EmbeddingBatcher:
+    """把多個執行緒同時送來的嵌入請求，在短暫的等待視窗內合併成一次 API 呼叫
+
+    - request_many(texts) 需回傳與 texts 對應的嵌入 list，失敗時拋出例外
+    - 整批因 split_errors（某筆輸入有問題）失敗時拆半重送，只有真正有問題的那筆會拿到錯誤；
+      其他錯誤（限流、逾時、連線中斷）整批的請求都拿到同一個錯誤，不重送
+    """
+
+    def __init__(self, request_many, max_batch_size=64, max_wait_ms=5, max_concurrent_batches=4,
+                 split_errors=SPLIT_ERRORS):
+        self.request_many = request_many
+        self.split_errors = tuple(split_errors)
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms) / 1000.0)
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_concurrent_batches)),
+                                            thread_name_prefix="embedding-batch")
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'batches': 0,
+            'batched_items': 0,
+            'deduplicated': 0,
+            'batch_failures': 0,
+            'item_failures': 0,
+            'split_retries': 0,
+            'batch_seconds_total': 0.0,
+            'batch_seconds_max': 0.0,
+            'wait_seconds_total': 0.0,
+            'max_batch_size_seen': 0,
+        }
+        self._thread = threading.Thread(target=self._collect_loop, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """送出一筆請求，回傳 Future"""
+        future = Future()
+        with self._lock:
+            self._stats['requests'] += 1
+        self._queue.put((text, future, time.monotonic()))
+        return future
+
+    def embed(self, text, timeout=30.0):
+        """取得單筆嵌入（會和其他執行緒的請求合併送出）"""
+        return self.submit(text).result(timeout=timeout)
+
+    def _collect_loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._executor.submit(self._send_batch, batch)
+
+    def _send_batch(self, batch):
+        sent_at = time.monotonic()
+        # 同一批裡相同的文字只送一次
+        futures_by_text = {}
+        for text, future, enqueued_at in batch:
+            futures_by_text.setdefault(text, []).append(future)
+        texts = list(futures_by_text)
+
+        started = time.monotonic()
+        try:
+            embeddings = self.request_many(texts)
+            failed = False
+        except Exception as e:
+            failed = True
+            batch_error = e
+        elapsed = time.monotonic() - started
+
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['batched_items'] += len(texts)
+            self._stats['deduplicated'] += len(batch) - len(texts)
+            self._stats['batch_seconds_total'] += elapsed
+            self._stats['batch_seconds_max'] = max(self._stats['batch_seconds_max'], elapsed)
+            self._stats['wait_seconds_total'] += sum(sent_at - enqueued_at for _, _, enqueued_at in batch)
+            self._stats['max_batch_size_seen'] = max(self._stats['max_batch_size_seen'], len(texts))
+            if failed:
+                self._stats['batch_failures'] += 1
+
+        if not failed:
+            for text, embedding in zip(texts, embeddings):
+                for future in futures_by_text[text]:
+                    future.set_result(embedding)
+            return
+
+        self._split_or_fail(texts, futures_by_text, batch_error)
+
+    def _split_or_fail(self, texts, futures_by_text, error):
+        """某筆輸入有問題時對半拆開重送，把錯誤限縮在那幾筆；其他錯誤整批失敗"""
+        if len(texts) == 1 or not isinstance(error, self.split_errors):
+            self._fail([future for text in texts for future in futures_by_text[text]], error)
+            return
+        half = len(texts) // 2
+        self._send_isolated(texts[:half], futures_by_text)
+        self._send_isolated(texts[half:], futures_by_text)
+
+    def _send_isolated(self, texts, futures_by_text):
+        with self._lock:
+            self._stats['split_retries'] += 1
+        try:
+            embeddings = self.request_many(texts)
+        except Exception as e:
+            self._split_or_fail(texts, futures_by_text, e)
+            return
+        for text, embedding in zip(texts, embeddings):
+            for future in futures_by_text[text]:
+                future.set_result(embedding)
+
+    def _fail(self, futures, error):
+        with self._lock:
+            self._stats['item_failures'] += len(futures)
+        for future in futures:
+            future.set_exception(error)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self._executor.shutdown(wait=True)
+
+    def get_stats(self):
+        """批次大小、等待視窗與每批延遲"""
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats['batches']
+        stats['max_batch_size'] = self.max_batch_size
+        stats['max_wait_ms'] = round(self.max_wait * 1000, 3)
+        stats['avg_batch_size'] = round(stats['batched_items'] / batches, 2) if batches else 0.0
+        stats['avg_batch_ms'] = round(stats['batch_seconds_total'] / batches * 1000, 2) if batches else 0.0
+        stats['max_batch_ms'] = round(stats['batch_seconds_max'] * 1000, 2)
+        requests = stats['requests']
+        stats['avg_wait_ms'] = round(stats['wait_seconds_total'] / requests * 1000, 3) if requests else 0.0
+        for key in ('batch_seconds_total', 'batch_seconds_max', 'wait_seconds_total'):
+            stats[key] = round(stats[key], 4)
+        return stats
@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+from vector_utils import as_float_array
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model, text):
+    """以模型 + 文字內容的雜湊作為快取 key"""
+    return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """兩層嵌入快取：process 內 LRU（大小 / TTL 淘汰）+ Postgres 持久化資料表
+
+    同一段文字（例如「哈哈」「早安」）只要算過一次，就不會再呼叫 embedding API。
+    """
+
+    def __init__(self, pool=None, max_size=2048, ttl_seconds=86400, persist=True):
+        self.pool = pool
+        self.max_size = max(1, int(max_size))
+        self.ttl_seconds = float(ttl_seconds)
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'memory_hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'api_calls': 0,
+            'api_seconds_total': 0.0,
+            'saved_api_seconds': 0.0,
+        }
+
+    def _avg_api_seconds(self):
+        calls = self._stats['api_calls']
+        return self._stats['api_seconds_total'] / calls if calls else 0.0
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            embedding, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return embedding
+
+    def _memory_put(self, key, embedding):
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _db_get(self, key):
+        if not (self.persist and self.pool):
+            return None
+        try:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT embedding FROM lumi_embedding_cache WHERE cache_key = %s;", (key,))
+                row = cur.fetchone()
+        except Exception as e:
+            logger.error("❌ 讀取嵌入快取失敗: %s", e)
+            return None
+        if not row or row[0] is None:
+            return None
+        return as_float_array(row[0], dtype=float).tolist()
+
+    def _db_put(self, key, model, embedding):
+        if not (self.persist and self.pool):
+            return
+        try:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO lumi_embedding_cache (cache_key, model, embedding)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (cache_key) DO NOTHING;
+                """, (key, model, np.asarray(embedding, dtype=np.float32)))
+        except Exception as e:
+            logger.error("❌ 寫入嵌入快取失敗: %s", e)
+
+    def get_or_compute(self, model, text, compute):
+        """先查記憶體、再查資料庫，都沒有才呼叫 compute(text)"""
+        key = make_cache_key(model, text)
+
+        embedding = self._memory_get(key)
+        if embedding is not None:
+            with self._lock:
+                self._stats['memory_hits'] += 1
+                self._stats['saved_api_seconds'] += self._avg_api_seconds()
+            return embedding
+
+        started = time.monotonic()
+        embedding = self._db_get(key)
+        if embedding is not None:
+            lookup_seconds = time.monotonic() - started
+            with self._lock:
+                self._stats['db_hits'] += 1
+                self._stats['saved_api_seconds'] += max(0.0, self._avg_api_seconds() - lookup_seconds)
+            self._memory_put(key, embedding)
+            return embedding
+
+        started = time.monotonic()
+        embedding = compute(text)
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._stats['misses'] += 1
+            self._stats['api_calls'] += 1
+            self._stats['api_seconds_total'] += elapsed
+        if embedding is None:
+            return None
+        self._memory_put(key, embedding)
+        self._db_put(key, model, embedding)
+        return embedding
+
+    def get_or_compute_many(self, model, texts, compute_many):
+        """批次版本：未命中的文字合併成一次 compute_many(texts) 呼叫，回傳與 texts 對應的 list"""
+        keys = [make_cache_key(model, text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        memory_hits = 0
+        for i, key in enumerate(keys):
+            embedding = self._memory_get(key)
+            if embedding is not None:
+                results[i] = embedding
+                memory_hits += 1
+            else:
+                missing.setdefault(key, []).append(i)
+
+        db_hits = 0
+        if missing and self.persist and self.pool:
+            try:
+                with self.pool.connection() as conn, conn.cursor() as cur:
+                    cur.execute("SELECT cache_key, embedding FROM lumi_embedding_cache WHERE cache_key = ANY(%s);",
+                                (list(missing),))
+                    rows = cur.fetchall()
+            except Exception as e:
+                logger.error("❌ 讀取嵌入快取失敗: %s", e)
+                rows = []
+            for key, value in rows:
+                embedding = as_float_array(value, dtype=float).tolist()
+                self._memory_put(key, embedding)
+                for i in missing.pop(key):
+                    results[i] = embedding
+                    db_hits += 1
+
+        computed = 0
+        if missing:
+            pending_keys = list(missing)
+            pending_texts = [texts[missing[key][0]] for key in pending_keys]
+            started = time.monotonic()
+            embeddings = compute_many(pending_texts)
+            elapsed = time.monotonic() - started
+            computed = len(pending_texts)
+            new_rows = []
+            for key, embedding in zip(pending_keys, embeddings):
+                if embedding is None:
+                    continue
+                self._memory_put(key, embedding)
+                new_rows.append((key, model, np.asarray(embedding, dtype=np.float32)))
+                for i in missing[key]:
+                    results[i] = embedding
+            with self._lock:
+                self._stats['api_calls'] += 1
+                self._stats['api_seconds_total'] += elapsed
+            self._db_put_many(new_rows)
+
+        with self._lock:
+            avg = self._avg_api_seconds()
+            self._stats['memory_hits'] += memory_hits
+            self._stats['db_hits'] += db_hits
+            self._stats['misses'] += computed
+            self._stats['saved_api_seconds'] += avg * (memory_hits + db_hits)
+        return results
+
+    def _db_put_many(self, rows):
+        if not (rows and self.persist and self.pool):
+            return
+        try:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                execute_values(cur, """
+                    INSERT INTO lumi_embedding_cache (cache_key, model, embedding)
+                    VALUES %s
+                    ON CONFLICT (cache_key) DO NOTHING;
+                """, rows)
+        except Exception as e:
+            logger.error("❌ 寫入嵌入快取失敗: %s", e)
+
+    def get_stats(self):
+        """命中率與省下的 API 延遲"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        hits = stats['memory_hits'] + stats['db_hits']
+        lookups = hits + stats['misses']
+        stats['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        stats['avg_api_ms'] = round(stats['api_seconds_total'] / stats['api_calls'] * 1000, 2) if stats['api_calls'] else 0.0
+        stats['api_seconds_total'] = round(stats['api_seconds_total'], 4)
+        stats['saved_api_seconds'] = round(stats['saved_api_seconds'], 4)
+        return stats
@@ -0,0 +1,247 @@
+"""
+活躍用戶的 process 內向量索引
+
+聊天是一段一段的：同一位用戶幾分鐘內會連續傳好幾則訊息，每則都要做一次相似度搜尋。
+第一次搜尋（未命中）時照常查 pgvector，同時在背景把這位用戶的嵌入載入記憶體；之後的搜尋
+只要一次矩陣乘向量加上 argpartition，不需要資料庫。
+
+- 每位用戶一個連續的 float32 矩陣，每列先正規化成單位向量，cosine 相似度就是內積
+- 新對話寫入資料庫後（_insert_memories）直接 append，容量不足時倍增
+- 依最近使用順序（LRU）與總記憶體上限淘汰；超過 TTL 的項目仍可使用，但會在背景重新載入
+  （其他 process 寫入的對話、記憶整併的結果在 TTL 內會反映進來）
+- 搜尋結果與 SIMILAR_SEARCH_SQL 相同：摘要優先，其次是尚未整併的對話，各自依距離排序
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+from vector_utils import as_float_array, dequantize_int8
+
+# 摘要與尚未整併的對話；int8 儲存時 embedding 為 NULL，改用 embedding_i8 還原
+LOAD_SQL = """
+    SELECT id, user_message, lumi_response, emotion_tag, last_at, source_count,
+           embedding, NULL::bytea, NULL::real
+    FROM lumi_memory_summaries
+    WHERE user_id = %(user_id)s
+    UNION ALL
+    SELECT id, user_message, lumi_response, emotion_tag, timestamp, NULL::integer,
+           embedding, embedding_i8, embedding_scale
+    FROM lumi_memories
+    WHERE user_id = %(user_id)s AND summary_id IS NULL
+      AND (embedding IS NOT NULL OR embedding_i8 IS NOT NULL);
+"""
+
+# 每列文字與 tuple 的大約額外開銷（bytes），計入記憶體上限
+_ROW_OVERHEAD = 200
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _row_bytes(row):
+    return _ROW_OVERHEAD + sys.getsizeof(row[1] or '') + sys.getsizeof(row[2] or '')
+
+
+class _UserVectors:
+    """一位用戶的矩陣（前 size 列有效）與對應的列 (id, user_message, lumi_response, emotion_tag, timestamp, source_count)"""
+
+    def __init__(self, rows, vectors, dim):
+        capacity = max(16, len(rows))
+        self.dim = dim
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.summary = np.zeros(capacity, dtype=bool)
+        self.rows = []
+        self.size = 0
+        self.text_bytes = 0
+        self.loaded_at = time.monotonic()
+        self.add(rows, vectors)
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.summary.nbytes + self.text_bytes
+
+    def add(self, rows, vectors):
+        needed = self.size + len(rows)
+        if needed > len(self.matrix):
+            # 搜尋中的執行緒拿的是舊矩陣的切片，不會受影響
+            capacity = max(needed, len(self.matrix) * 2)
+            matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            summary = np.zeros(capacity, dtype=bool)
+            summary[:self.size] = self.summary[:self.size]
+            self.matrix, self.summary = matrix, summary
+        if rows:
+            self.matrix[self.size:needed] = _normalize(vectors)
+            self.summary[self.size:needed] = [row[5] is not None for row in rows]
+        self.rows.extend(rows)
+        self.text_bytes += sum(_row_bytes(row) for row in rows)
+        self.size = needed
+
+
+class HotVectorIndex:
+    def __init__(self, pool=None, max_bytes=128 * 1024 * 1024, ttl_seconds=600, load_workers=1, loader=None):
+        # loader(user_id) 回傳 (rows, vectors)；沒有指定時以 LOAD_SQL 從 pool 讀取
+        self.pool = pool
+        self.loader = loader
+        self.max_bytes = int(max_bytes)
+        self.ttl_seconds = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=load_workers, thread_name_prefix="hot-index-load")
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'load_errors': 0, 'evictions': 0,
+                       'too_large': 0, 'appended': 0, 'load_ms_total': 0.0}
+
+    def search(self, user_id, query_embedding, limit, max_distance):
+        """回傳 SIMILAR_SEARCH_SQL 格式的列；這位用戶還不在記憶體中時回傳 None（並在背景載入）"""
+        query = _normalize(query_embedding)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.dim != len(query):
+                # 嵌入維度換過了（reembed_memories.py），舊矩陣不能再用
+                self._remove(user_id)
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+                self._entries.move_to_end(user_id)
+                matrix, summary, rows = entry.matrix[:entry.size], entry.summary[:entry.size], entry.rows
+                expired = time.monotonic() - entry.loaded_at > self.ttl_seconds
+        if entry is None or expired:
+            self.schedule_load(user_id)
+        if entry is None:
+            return None
+        with metrics.span('memory.hot_index'):
+            return self._top_rows(matrix, summary, rows, query, limit, max_distance)
+
+    @staticmethod
+    def _top_rows(matrix, summary, rows, query, limit, max_distance):
+        if not len(matrix) or limit <= 0:
+            return []
+        distances = 1.0 - matrix @ query
+        # 摘要排在對話前面：對話的排序鍵加上 3（cosine 距離介於 0 ~ 2），超過門檻的設為無限大
+        keys = np.where(distances < max_distance, distances + np.where(summary, 0.0, 3.0), np.inf)
+        k = min(limit, len(keys))
+        top = np.argpartition(keys, k - 1)[:k]
+        top = top[np.argsort(keys[top])]
+        return [rows[i][:5] + (float(distances[i]), rows[i][5]) for i in top if np.isfinite(keys[i])]
+
+    def schedule_load(self, user_id):
+        """在背景載入（同一位用戶同時只會有一個載入）"""
+        if not self.pool and not self.loader:
+            return
+        with self._lock:
+            if user_id in self._loading:
+                return
+            self._loading[user_id] = []
+        self._executor.submit(self._load_safely, user_id)
+
+    def _load_safely(self, user_id):
+        try:
+            self.load(user_id)
+        except Exception:
+            with self._lock:
+                self._stats['load_errors'] += 1
+                self._loading.pop(user_id, None)
+
+    def load(self, user_id):
+        """從資料庫載入一位用戶的全部嵌入，回傳筆數（超過記憶體上限時不放進索引）"""
+        with self._lock:
+            self._loading.setdefault(user_id, [])
+        started = time.monotonic()
+        rows, vectors = (self.loader or self._load_from_pool)(user_id)
+        rows, vectors = list(rows), list(vectors)
+
+        with self._lock:
+            # 載入期間寫入的對話：查詢沒看到的才補上
+            loaded_ids = {row[0] for row in rows if row[5] is None}
+            for pending_rows, pending_vectors in self._loading.pop(user_id, []):
+                for row, vector in zip(pending_rows, pending_vectors):
+                    if row[0] not in loaded_ids:
+                        rows.append(row)
+                        vectors.append(vector)
+            self._stats['loads'] += 1
+            self._stats['load_ms_total'] += (time.monotonic() - started) * 1000
+            self._remove(user_id)
+            if not vectors:
+                return 0
+            entry = _UserVectors(rows, np.stack(vectors), len(vectors[0]))
+            if entry.nbytes > self.max_bytes:
+                self._stats['too_large'] += 1
+                return 0
+            self._entries[user_id] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+        return len(rows)
+
+    def _load_from_pool(self, user_id):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(LOAD_SQL, {'user_id': user_id})
+            fetched = cur.fetchall()
+        rows = [row[:6] for row in fetched]
+        vectors = [as_float_array(row[6]) if row[6] is not None else dequantize_int8(row[7], row[8])
+                   for row in fetched]
+        return rows, vectors
+
+    def append(self, user_id, rows, vectors):
+        """新寫入資料庫的對話；不在記憶體中的用戶不處理（下次搜尋時才載入）"""
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id].append((rows, vectors))
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if len(vectors[0]) != entry.dim:
+                self._remove(user_id)
+                return
+            before = entry.nbytes
+            entry.add(rows, vectors)
+            self._bytes += entry.nbytes - before
+            self._stats['appended'] += len(rows)
+            self._evict()
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                self._remove(user_id)
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+
+    def _evict(self):
+        """超過記憶體上限時從最久沒用的用戶開始淘汰"""
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.nbytes
+            self._stats['evictions'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._entries)
+            stats['rows'] = sum(entry.size for entry in self._entries.values())
+            stats['bytes'] = self._bytes
+            stats['max_bytes'] = self.max_bytes
+            stats['loading'] = len(self._loading)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['avg_load_ms'] = round(stats['load_ms_total'] / stats['loads'], 2) if stats['loads'] else 0.0
+        return stats
+
+    def stop(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,560 @@
+"""
+本地儲存引擎：沒有 DATABASE_URL 時使用（小型部署、CI、離線開發），不需要 pgvector 服務
+
+- 對話、用戶資料與日記存在 SQLite（WAL 模式，讀寫不互相阻擋）
+- 嵌入存在 memory-mapped 的 NumPy float32 檔案，每列先正規化成單位向量；第 id 筆對話放在第 id - 1 列
+  （AUTOINCREMENT 的 id 不會重複使用）。寫入時在同一個 SQLite 寫入交易中寫好嵌入才 COMMIT，
+  其他 process 看到的對話一定已經有嵌入
+- 相似度搜尋：取出用戶的列做一次矩陣乘向量加上 argpartition；活躍用戶經過 HotVectorIndex 直接在記憶體中搜尋
+
+LocalLumiMemory 繼承 SimpleLumiMemory，對外方法相同（嵌入後端、快取、write-behind、get_context 的並行檢索都共用），
+只有存取資料的部分改為本地實作。記憶整併與每月分區只在 Postgres 上執行。
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import metrics
+import user_time
+from diary_store import DiaryStore
+from lumi_logging import log_user
+from simple_memory import SimpleLumiMemory
+from user_profiles import UserProfileStore
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    user_message TEXT,
+    lumi_response TEXT,
+    emotion_tag TEXT,
+    timestamp TEXT NOT NULL,
+    profile_tags TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_memories_user_time ON memories(user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_memories_time ON memories(timestamp);
+CREATE TABLE IF NOT EXISTS user_profiles (
+    user_id TEXT PRIMARY KEY,
+    name TEXT,
+    attributes TEXT NOT NULL DEFAULT '{}',
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS daily_diaries (
+    user_id TEXT NOT NULL,
+    diary_date TEXT NOT NULL,
+    diary TEXT NOT NULL,
+    last_memory_at TEXT NOT NULL,
+    turn_count INTEGER NOT NULL,
+    updated_at TEXT,
+    PRIMARY KEY (user_id, diary_date)
+);
+CREATE TABLE IF NOT EXISTS embedding_config (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    model TEXT NOT NULL,
+    dim INTEGER NOT NULL
+);
+"""
+
+# 嵌入檔一開始的列數，之後不足時倍增
+INITIAL_ROWS = 1024
+
+MEMORY_COLUMNS = "id, user_message, lumi_response, emotion_tag, timestamp"
+
+
+def to_db_time(value):
+    """時間一律存成固定寬度的 UTC ISO 字串，字串排序就是時間排序"""
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+
+def from_db_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+class LocalMemoryStore:
+    """SQLite（WAL）+ memory-mapped 嵌入檔；每個執行緒各用一個 SQLite 連線"""
+
+    def __init__(self, directory, model, dim):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.db_path = os.path.join(directory, 'lumi_memory.sqlite3')
+        self.vectors_path = os.path.join(directory, 'embeddings.f32')
+        self.dim = int(dim)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._vectors = None
+
+        conn = self.connection()
+        conn.executescript(SCHEMA)
+        self._check_embedding_config(conn, model)
+        if not os.path.exists(self.vectors_path):
+            with open(self.vectors_path, 'wb') as f:
+                f.truncate(INITIAL_ROWS * self.dim * 4)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None：自動提交，寫入時自己下 BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """寫入交易：BEGIN IMMEDIATE 一開始就拿到寫入鎖，多個 process 的寫入依序進行"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield conn
+            conn.execute("COMMIT;")
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+
+    def _check_embedding_config(self, conn, model):
+        """嵌入模型 / 維度與既有資料不同時拒絕開啟（與 schema.ensure_embedding_config 相同的原則）"""
+        row = conn.execute("SELECT model, dim FROM embedding_config;").fetchone()
+        if row == (model, self.dim):
+            return
+        if row and conn.execute("SELECT EXISTS (SELECT 1 FROM memories);").fetchone()[0]:
+            raise RuntimeError(
+                f"{self.directory} 中的嵌入是 {row[0]}（{row[1]} 維），與目前的設定 {model}（{self.dim} 維）不同；"
+                f"請改用新的 LOCAL_MEMORY_DIR 或恢復原本的嵌入設定")
+        # 還沒有對話：直接換設定，嵌入檔依新維度重建
+        conn.execute("INSERT OR REPLACE INTO embedding_config (id, model, dim) VALUES (1, ?, ?);", (model, self.dim))
+        if os.path.exists(self.vectors_path):
+            os.remove(self.vectors_path)
+
+    def vectors(self, min_rows=0):
+        """目前的嵌入矩陣（檔案被其他寫入擴充過時重新 mmap）"""
+        with self._lock:
+            if self._vectors is None or len(self._vectors) < min_rows:
+                rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+                self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(rows, self.dim))
+            return self._vectors
+
+    def _grow(self, rows_needed):
+        """檔案只會變大；在寫入交易中呼叫，同一時間只有一個 process 在擴充"""
+        current = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        if rows_needed > current:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(max(rows_needed, current * 2) * self.dim * 4)
+
+    @metrics.timed('local.insert_memories')
+    def insert(self, rows, vectors):
+        """rows 為 (user_id, user_message, lumi_response, emotion_tag, timestamp, profile_tags)，回傳 id"""
+        vectors = _normalize(vectors)
+        with self.transaction() as conn:
+            ids = [conn.execute("""
+                INSERT INTO memories (user_id, user_message, lumi_response, emotion_tag, timestamp, profile_tags)
+                VALUES (?, ?, ?, ?, ?, ?);
+            """, (user_id, user_message, lumi_response, emotion_tag, to_db_time(ts), json.dumps(tags or [])))
+                .lastrowid for user_id, user_message, lumi_response, emotion_tag, ts, tags in rows]
+            self._grow(max(ids))
+            matrix = self.vectors(max(ids))
+            matrix[np.asarray(ids) - 1] = vectors
+            matrix.flush()
+        return ids
+
+    def user_ids(self, user_id):
+        rows = self.query("SELECT id FROM memories WHERE user_id = ?;", (user_id,))
+        return np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+
+    def rows_by_id(self, ids):
+        placeholders = ','.join('?' * len(ids))
+        rows = self.query(f"SELECT {MEMORY_COLUMNS} FROM memories WHERE id IN ({placeholders});",
+                          [int(i) for i in ids])
+        return {row[0]: row[:4] + (from_db_time(row[4]),) for row in rows}
+
+    @metrics.timed('local.similar_memories')
+    def search(self, user_id, query_embedding, limit, max_distance):
+        """精確的 cosine 搜尋，回傳 SIMILAR_SEARCH_SQL 格式的列（本地沒有整併摘要）"""
+        ids = self.user_ids(user_id)
+        if not len(ids) or limit <= 0:
+            return []
+        matrix = self.vectors(int(ids.max()))
+        distances = 1.0 - matrix[ids - 1] @ _normalize(query_embedding)
+        keys = np.where(distances < max_distance, distances, np.inf)
+        k = min(limit, len(keys))
+        top = np.argpartition(keys, k - 1)[:k]
+        top = [i for i in top[np.argsort(keys[top])] if np.isfinite(keys[i])]
+        if not top:
+            return []
+        rows = self.rows_by_id(ids[top])
+        return [rows[ids[i]] + (float(distances[i]), None) for i in top]
+
+    def load_user(self, user_id):
+        """HotVectorIndex 的 loader：用戶全部對話的 (rows, vectors)"""
+        rows = self.query(f"SELECT {MEMORY_COLUMNS} FROM memories WHERE user_id = ? ORDER BY id;", (user_id,))
+        if not rows:
+            return [], []
+        ids = np.asarray([row[0] for row in rows], dtype=np.int64)
+        matrix = self.vectors(int(ids.max()))
+        return [row[:4] + (from_db_time(row[4]), None) for row in rows], np.array(matrix[ids - 1])
+
+    def get_stats(self):
+        count = self.query("SELECT COUNT(*) FROM memories;")[0][0]
+        return {
+            'engine': 'sqlite',
+            'memories': count,
+            'dim': self.dim,
+            'db_bytes': os.path.getsize(self.db_path),
+            'vectors_bytes': os.path.getsize(self.vectors_path),
+        }
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._vectors = None
+        self._local = threading.local()
+
+
+class LocalProfileStore(UserProfileStore):
+    """user_profiles 存在 SQLite（快取邏輯與 UserProfileStore 相同；pool 欄位放本地 store）"""
+
+    def _fetch(self, user_id):
+        rows = self.pool.query("SELECT name, attributes FROM user_profiles WHERE user_id = ?;", (user_id,))
+        return {'name': rows[0][0], 'attributes': json.loads(rows[0][1])} if rows else None
+
+    def _write(self, user_id, name, attributes):
+        with self.pool.transaction() as conn:
+            row = conn.execute("""
+                INSERT INTO user_profiles (user_id, name, attributes, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    name = COALESCE(excluded.name, user_profiles.name),
+                    attributes = json_patch(user_profiles.attributes, excluded.attributes),
+                    updated_at = excluded.updated_at
+                RETURNING name, attributes;
+            """, (user_id, name, json.dumps(attributes), to_db_time(datetime.now(timezone.utc)))).fetchone()
+        return {'name': row[0], 'attributes': json.loads(row[1])}
+
+
+class LocalDiaryStore(DiaryStore):
+    """daily_diaries 存在 SQLite；與 DiaryStore 相同，只保留整理得比較新的版本"""
+
+    def get(self, user_id, date_str):
+        if not self.pool:
+            return None
+        rows = self.pool.query("""
+            SELECT diary, last_memory_at, turn_count FROM daily_diaries WHERE user_id = ? AND diary_date = ?;
+        """, (user_id, date_str))
+        if not rows:
+            return None
+        return {'diary': rows[0][0], 'last_memory_at': rows[0][1], 'turn_count': rows[0][2]}
+
+    def save(self, user_id, date_str, diary, last_memory_at, turn_count):
+        with self.pool.transaction() as conn:
+            cur = conn.execute("""
+                INSERT INTO daily_diaries (user_id, diary_date, diary, last_memory_at, turn_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, diary_date) DO UPDATE SET
+                    diary = excluded.diary,
+                    last_memory_at = excluded.last_memory_at,
+                    turn_count = excluded.turn_count,
+                    updated_at = excluded.updated_at
+                WHERE daily_diaries.last_memory_at < excluded.last_memory_at;
+            """, (user_id, date_str, diary, to_db_time(last_memory_at), turn_count,
+                  to_db_time(datetime.now(timezone.utc))))
+            return cur.rowcount > 0
+
+
+def _memory(row):
+    """(id, user_message, lumi_response, emotion_tag, timestamp 字串) → 記憶 dict"""
+    return {
+        'user_message': row[1],
+        'lumi_response': row[2],
+        'emotion_tag': row[3],
+        'timestamp': from_db_time(row[4]).isoformat() if row[4] else None
+    }
+
+
+class LocalLumiMemory(SimpleLumiMemory):
+    def __init__(self, directory=None):
+        self.local_dir = directory or os.getenv('LOCAL_MEMORY_DIR', 'lumi_data')
+        self.store = None
+        super().__init__()
+
+    def _initialize_railway_pgvector(self):
+        """不連 Postgres：開啟 LOCAL_MEMORY_DIR 中的 SQLite 與嵌入檔"""
+        try:
+            self.store = LocalMemoryStore(self.local_dir, self.embedding_backend.model, self.embedding_backend.dim)
+        except Exception as e:
+            logger.error("❌ 本地記憶儲存開啟失敗: %s", e)
+            self.store = None
+            return
+        self.profiles = LocalProfileStore(self.store, ttl_seconds=self.profiles.ttl_seconds,
+                                          max_size=self.profiles.max_size)
+        self.diaries = LocalDiaryStore(self.store)
+        if self.hot_index:
+            self.hot_index.loader = self.store.load_user
+        logger.info("✅ 使用本地記憶儲存: %s", self.local_dir)
+
+    def _ensure_connection(self):
+        if self.store:
+            return True
+        logger.error("❌ 本地記憶儲存未開啟")
+        return False
+
+    def get_pool_stats(self):
+        """本地儲存的筆數與檔案大小（沒有連線池）"""
+        if not self.store:
+            return {}
+        return self.store.get_stats()
+
+    @metrics.timed('db.insert_memories')
+    def _insert_memories(self, records):
+        """批次產生嵌入後寫入 SQLite 與嵌入檔（write-behind 的 flush 也用這個）"""
+        if not records:
+            return []
+        if not self._ensure_connection():
+            raise RuntimeError("本地記憶儲存未開啟")
+        records, embeddings, failed = self._embed_records(records)
+        if not records:
+            return failed
+        ids = self.store.insert([(r['user_id'], r['user_message'], r['lumi_response'], r['emotion_tag'],
+                                  r['timestamp'], r['profile_tags']) for r in records], embeddings)
+        logger.info("已批次寫入 %d 筆記憶", len(ids))
+        self._after_insert(records, ids, embeddings)
+        return failed
+
+    def _select_memories(self, where, params, order='DESC', limit=None):
+        sql = f"SELECT {MEMORY_COLUMNS} FROM memories WHERE {where} ORDER BY timestamp {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = tuple(params) + (limit,)
+        return self.store.query(sql + ";", params)
+
+    @metrics.timed('db.recent_memories')
+    def get_recent_memories(self, user_id, limit=5):
+        if not self._ensure_connection():
+            return []
+        try:
+            memories = [_memory(row) for row in self._select_memories("user_id = ?", (user_id,), limit=limit)]
+            return self._merge_memories(memories[::-1], self._pending_memories(user_id), limit)
+        except Exception as e:
+            logger.error("❌ 從本地儲存檢索記憶失敗: %s", e, extra=log_user(user_id))
+            return []
+
+    def _local_similar_rows(self, user_id, query_embedding, limit, similarity_threshold):
+        rows = self._hot_similar_rows(user_id, query_embedding, limit, similarity_threshold)
+        if rows is None:
+            rows = self.store.search(user_id, query_embedding, limit, 1 - similarity_threshold)
+        return rows
+
+    @metrics.timed('memory.similar_memories')
+    def get_similar_memories(self, user_id, query_message, limit=5, similarity_threshold=0.7,
+                             ef_search=None, probes=None):
+        """精確的相似度搜尋（ef_search / probes 只是為了與 SimpleLumiMemory 相同的參數）"""
+        if not self._ensure_connection():
+            return []
+        query_embedding = self._get_embedding(query_message)
+        if query_embedding is None:
+            logger.warning("無法生成查詢嵌入，使用時間排序檢索")
+            return self.get_recent_memories(user_id, limit)
+        try:
+            rows = self._local_similar_rows(user_id, query_embedding, limit, similarity_threshold)
+            return [self._similar_row_to_memory(row) for row in rows]
+        except Exception as e:
+            logger.error("相似度搜尋失敗: %s", e, extra=log_user(user_id))
+            return self.get_recent_memories(user_id, limit)
+
+    @metrics.timed('db.recent_context')
+    def _fetch_recent_context(self, user_id, recent_limit, profile_limit, timeout=None):
+        """與 SimpleLumiMemory 相同的 (section, id, ...) 列；本地查詢很快，不需要 statement_timeout"""
+        recent = self._select_memories("user_id = ?", (user_id,), limit=recent_limit)
+        recent_ids = [row[0] for row in recent]
+        placeholders = ','.join('?' * len(recent_ids))
+        exclude = f" AND id NOT IN ({placeholders})" if recent_ids else ""
+        profile = self._select_memories("user_id = ? AND profile_tags <> '[]'" + exclude,
+                                        (user_id, *recent_ids), limit=profile_limit)
+        return [('recent', *row[:4], from_db_time(row[4])) for row in recent] + \
+               [('profile', *row[:4], from_db_time(row[4])) for row in profile]
+
+    def _fetch_similar_context(self, user_id, message, limit, similarity_threshold, timeout=None):
+        query_embedding = self._get_embedding(message)
+        if query_embedding is None:
+            logger.warning("無法生成查詢嵌入，略過相似記憶")
+            return []
+        return self._local_similar_rows(user_id, query_embedding, limit, similarity_threshold)
+
+    @metrics.timed('db.profile_memories')
+    def get_user_profile_memories(self, user_id, limit=10, tags=None):
+        if not self._ensure_connection():
+            return []
+        where, params = "user_id = ? AND profile_tags <> '[]'", (user_id,)
+        if tags:
+            where += f" AND EXISTS (SELECT 1 FROM json_each(profile_tags) WHERE value IN ({','.join('?' * len(tags))}))"
+            params += tuple(tags)
+        try:
+            return [_memory(row) for row in self._select_memories(where, params, limit=limit)]
+        except Exception as e:
+            logger.error("獲取用戶資料記憶失敗: %s", e)
+            return []
+
+    @metrics.timed('db.emotional_memories')
+    def get_emotional_memories(self, user_id, emotion_type=None, limit=5):
+        if not self._ensure_connection():
+            return []
+        if emotion_type:
+            where, params = "user_id = ? AND emotion_tag = ?", (user_id, emotion_type)
+        else:
+            where, params = "user_id = ? AND emotion_tag IS NOT NULL", (user_id,)
+        try:
+            return [_memory(row) for row in self._select_memories(where, params, limit=limit)]
+        except Exception as e:
+            logger.error("獲取情緒記憶失敗: %s", e)
+            return []
+
+    @metrics.timed('db.long_term_memories')
+    def get_long_term_memories(self, user_id, days_back=30, limit=20):
+        if not self._ensure_connection():
+            return []
+        start, end = user_time.recent_days_range(days_back, self.get_user_timezone(user_id))
+        try:
+            return [_memory(row) for row in self._select_memories(
+                "user_id = ? AND timestamp >= ? AND timestamp < ?",
+                (user_id, to_db_time(start), to_db_time(end)), limit=limit)]
+        except Exception as e:
+            logger.error("獲取長期記憶失敗: %s", e)
+            return []
+
+    @metrics.timed('db.memory_statistics')
+    def get_memory_statistics(self, user_id):
+        if not self._ensure_connection():
+            return {}
+        week_start, week_end = user_time.recent_days_range(7, self.get_user_timezone(user_id))
+        try:
+            total_conversations, last_interaction, weekly_interactions = self.store.query("""
+                SELECT COUNT(*), MAX(timestamp), COUNT(*) FILTER (WHERE timestamp >= ? AND timestamp < ?)
+                FROM memories WHERE user_id = ?;
+            """, (to_db_time(week_start), to_db_time(week_end), user_id))[0]
+            emotion_distribution = dict(self.store.query("""
+                SELECT emotion_tag, COUNT(*) FROM memories
+                WHERE user_id = ? AND emotion_tag IS NOT NULL
+                GROUP BY emotion_tag ORDER BY COUNT(*) DESC;
+            """, (user_id,)))
+            return {
+                'total_conversations': total_conversations,
+                'emotion_distribution': emotion_distribution,
+                'last_interaction': from_db_time(last_interaction).isoformat() if last_interaction else None,
+                'weekly_interactions': weekly_interactions,
+                'memory_strength': 'strong' if total_conversations > 50 else 'medium' if total_conversations > 20 else 'weak'
+            }
+        except Exception as e:
+            logger.error("獲取記憶統計失敗: %s", e)
+            return {}
+
+    @metrics.timed('db.daily_memories')
+    def get_daily_memories(self, user_id, date_str, since=None):
+        if not self._ensure_connection():
+            return []
+        start, end = user_time.day_range(date_str, self.get_user_timezone(user_id))
+        since_dt = datetime.fromisoformat(since) if since else None
+        where, params = "user_id = ? AND timestamp >= ? AND timestamp < ?", (user_id, to_db_time(start), to_db_time(end))
+        if since_dt:
+            where, params = where + " AND timestamp > ?", params + (to_db_time(since_dt),)
+        try:
+            memories = [_memory(row) for row in self._select_memories(where, params, order='ASC')]
+            pending = [m for m in self._pending_memories(user_id)
+                       if start <= datetime.fromisoformat(m['timestamp']) < end
+                       and (since_dt is None or datetime.fromisoformat(m['timestamp']) > since_dt)]
+            return self._merge_memories(memories, pending)
+        except Exception as e:
+            logger.error("從本地儲存檢索每日記憶失敗: %s", e)
+            return []
+
+    @metrics.timed('db.stale_diary_users')
+    def get_stale_diary_users(self, date_str, limit=200, min_new_turns=1):
+        """「當天」以每位用戶的時區計算：先取預設時區前後各放寬一天的新對話，再依用戶時區計數"""
+        if not self._ensure_connection():
+            return []
+        start, end = user_time.day_range(date_str, user_time.get_zone())
+        try:
+            rows = self.store.query("""
+                SELECT m.user_id, m.timestamp
+                FROM memories m
+                LEFT JOIN daily_diaries d ON d.user_id = m.user_id AND d.diary_date = ?
+                WHERE m.timestamp >= ? AND m.timestamp < ?
+                  AND (d.last_memory_at IS NULL OR m.timestamp > d.last_memory_at);
+            """, (date_str, to_db_time(start - timedelta(days=1)), to_db_time(end + timedelta(days=1))))
+            counts, ranges = {}, {}
+            for user_id, timestamp in rows:
+                if user_id not in ranges:
+                    ranges[user_id] = user_time.day_range(date_str, self.get_user_timezone(user_id))
+                day_start, day_end = ranges[user_id]
+                if day_start <= from_db_time(timestamp) < day_end:
+                    counts[user_id] = counts.get(user_id, 0) + 1
+            stale = sorted((user_id for user_id, count in counts.items() if count >= min_new_turns),
+                           key=lambda user_id: -counts[user_id])
+            return stale[:limit]
+        except Exception as e:
+            logger.error("查詢待更新日記的用戶失敗: %s", e)
+            return []
+
+    @contextmanager
+    def diary_precompute_lock(self):
+        """檔案鎖：同一台機器上的多個 process 只有一個會預先產生日記"""
+        if not self._ensure_connection():
+            yield False
+            return
+        with open(os.path.join(self.local_dir, 'diary_precompute.lock'), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @metrics.timed('db.memory_summary')
+    def get_memory_summary(self, user_id):
+        if not self._ensure_connection():
+            return {'total_memories': 0, 'last_interaction': 'N/A'}
+        count, last_ts = self.store.query(
+            "SELECT COUNT(*), MAX(timestamp) FROM memories WHERE user_id = ?;", (user_id,))[0]
+        return {'total_memories': count, 'last_interaction': from_db_time(last_ts).isoformat() if last_ts else 'N/A'}
+
+    @metrics.timed('db.emotion_patterns')
+    def get_user_emotion_patterns(self, user_id):
+        if not self._ensure_connection():
+            return {'dominant_emotion': 'friend', 'total_interactions': 0}
+        dominant = self.store.query("""
+            SELECT emotion_tag FROM memories
+            WHERE user_id = ? AND emotion_tag IS NOT NULL
+            GROUP BY emotion_tag ORDER BY COUNT(*) DESC LIMIT 1;
+        """, (user_id,))
+        total = self.store.query("SELECT COUNT(*) FROM memories WHERE user_id = ?;", (user_id,))[0][0]
+        return {'dominant_emotion': dominant[0][0] if dominant else 'friend', 'total_interactions': total}
+
+    def close(self):
+        """寫完緩衝區後關閉 SQLite 連線（測試與程式結束時用）"""
+        self.flush_pending_writes()
+        if self.store:
+            self.store.close()
@@ -0,0 +1,125 @@
+"""
+日誌設定：等級、per-user 取樣與 JSON 輸出
+
+環境變數：
+- LOG_LEVEL：預設 INFO，只記錄耗時、筆數與錯誤；DEBUG 才會記錄對話內容與每個查詢步驟
+- LOG_FORMAT：text（預設）或 json（每行一個 JSON 物件，方便日誌平台解析）
+- LOG_USER_SAMPLE_RATE：0~1，帶 user_id 的 DEBUG / INFO 日誌只保留這個比例的用戶
+  （依 user_id 雜湊決定，同一位用戶的日誌會完整保留或完整略過）；WARNING 以上一律保留
+
+寫日誌時請用 logger.debug("... %s", value) 的參數形式，等級沒開時不會格式化字串；
+需要帶 user_id 時傳 extra=log_user(user_id)，輸出時只會顯示雜湊後的代號。
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+
+_HANDLER_NAME = 'lumi'
+
+# LogRecord 本身的屬性，其餘的都是 extra 帶進來的欄位
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _user_hash(user_id):
+    return hashlib.sha1(str(user_id).encode('utf-8')).hexdigest()
+
+
+def mask_user(user_id):
+    """日誌中顯示的用戶代號（不輸出原始 user_id）"""
+    if user_id is None:
+        return None
+    return 'u_' + _user_hash(user_id)[:10]
+
+
+def log_user(user_id, **fields):
+    """給 logger 的 extra：帶上 user_id（供取樣與遮蔽）與其他結構化欄位"""
+    return dict(fields, user_id=user_id)
+
+
+def user_sampled(user_id, rate):
+    """同一個 user_id 永遠得到相同的取樣結果"""
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    return int(_user_hash(user_id)[:8], 16) / 0x100000000 < rate
+
+
+class UserSamplingFilter(logging.Filter):
+    """只保留部分用戶的 DEBUG / INFO 日誌"""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        user_id = getattr(record, 'user_id', None)
+        if user_id is None or record.levelno >= logging.WARNING:
+            return True
+        return user_sampled(user_id, self.rate)
+
+
+class TextFormatter(logging.Formatter):
+    """一般文字格式，extra 欄位以 key=value 附在訊息後面"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """每筆日誌輸出成一行 JSON"""
+
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        payload.update(_extra_fields(record))
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def _extra_fields(record):
+    fields = {}
+    for key, value in vars(record).items():
+        if key in _RECORD_FIELDS:
+            continue
+        if key == 'user_id':
+            fields['user'] = mask_user(value)
+        else:
+            fields[key] = value
+    return fields
+
+
+def setup_logging(level=None, fmt=None, sample_rate=None, stream=None):
+    """設定 root logger（重複呼叫只會替換本模組加上的 handler）"""
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    fmt = (fmt or os.getenv('LOG_FORMAT', 'text')).lower()
+    if sample_rate is None:
+        sample_rate = float(os.getenv('LOG_USER_SAMPLE_RATE', '1.0'))
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.set_name(_HANDLER_NAME)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    handler.addFilter(UserSamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        if existing.get_name() == _HANDLER_NAME:
+            root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
@@ -0,0 +1,376 @@
+"""
+記憶整併：把用戶較舊的相似對話（「今天好累」「好累喔」）合併成一筆摘要記憶
+
+每位用戶的流程：
+1. 取出超過 min_age_days、尚未整併、也不是個人資料的對話（每次最多 batch_limit 筆，由舊到新）
+2. 以餘弦相似度做貪婪分群（NumPy）：已有的摘要是既有的群，每筆對話加入最相近且超過門檻的群，
+   否則自成一群
+3. 加入既有摘要的對話更新該摘要的中心向量與次數；新的群達到 min_cluster_size 筆才建立摘要，
+   以最接近中心的那一輪對話作為代表
+4. 來源對話標記 summary_id，並記錄這位用戶已整併到的時間；這些都在同一個交易中完成
+
+沒有成群的對話維持原樣，相似度搜尋仍找得到。整併進度只會越過已成群、或超過沉澱期（settle_days）
+的對話：還在沉澱期的單筆對話下一輪會和新的對話一起重新分群，不同輪才出現的相似對話也能合併；
+超過沉澱期仍沒有成群的就不再處理（之後的對話還是可以加入既有的摘要）。
+摘要不呼叫 LLM，整併本身不產生 API 費用。
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+import metrics
+from lumi_logging import log_user
+from vector_utils import as_float_array, dequantize_int8
+
+logger = logging.getLogger(__name__)
+
+# 多個 process 同時開啟整併時只讓一個執行
+CONSOLIDATION_LOCK_KEY = 7315004
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def greedy_clusters(vectors, threshold, centroids=None, counts=None):
+    """依序把每個向量放進餘弦相似度最高且 >= threshold 的群，否則開新群
+
+    centroids / counts 是既有的群（中心向量與筆數），編號在前面。
+    回傳 (labels, sums, counts)：每個向量所屬的群、各群的單位向量總和與筆數。
+    """
+    vectors = _normalize(vectors)
+    dim = vectors.shape[1] if vectors.ndim == 2 else 0
+    existing = 0 if centroids is None else len(centroids)
+    capacity = existing + len(vectors)
+    sums = np.zeros((capacity, dim), dtype=np.float32)
+    unit = np.zeros((capacity, dim), dtype=np.float32)
+    sizes = np.zeros(capacity, dtype=np.int64)
+    if existing:
+        # 中心向量是各筆單位向量的平均，乘回筆數就是總和
+        sizes[:existing] = counts
+        sums[:existing] = np.asarray(centroids, dtype=np.float32) * sizes[:existing, None]
+        unit[:existing] = _normalize(sums[:existing])
+    clusters = existing
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for i, vector in enumerate(vectors):
+        best = -1
+        if clusters:
+            similarities = unit[:clusters] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                best = -1
+        if best < 0:
+            best = clusters
+            clusters += 1
+        labels[i] = best
+        sums[best] += vector
+        sizes[best] += 1
+        unit[best] = _normalize(sums[best])
+    return labels, sums[:clusters], sizes[:clusters]
+
+
+def plan_consolidation(turns, summaries, threshold=0.9, min_cluster_size=3):
+    """分群並決定要寫入的內容（不碰資料庫）
+
+    turns: [{'id', 'timestamp', 'user_message', 'lumi_response', 'emotion_tag', 'embedding'}]（時間正序）
+    summaries: [{'id', 'embedding', 'source_count', 'first_at', 'last_at'}]
+    回傳 {'created': [...], 'updated': [...], 'consolidated': 筆數}；
+    created / updated 的每一項都帶有 'members'：[(id, timestamp)]
+    """
+    if not turns:
+        return {'created': [], 'updated': [], 'consolidated': 0}
+    vectors = np.stack([as_float_array(t['embedding']) for t in turns])
+    centroids = np.stack([as_float_array(s['embedding']) for s in summaries]) if summaries else None
+    labels, sums, sizes = greedy_clusters(vectors, threshold, centroids,
+                                          [s['source_count'] for s in summaries])
+
+    members = {}
+    for index, label in enumerate(labels):
+        members.setdefault(int(label), []).append(index)
+
+    created, updated = [], []
+    normalized = _normalize(vectors)
+    for label, indexes in members.items():
+        group = [turns[i] for i in indexes]
+        centroid = sums[label] / sizes[label]
+        timestamps = [t['timestamp'] for t in group]
+        if label < len(summaries):
+            summary = summaries[label]
+            updated.append({
+                'id': summary['id'],
+                'embedding': centroid,
+                'source_count': int(sizes[label]),
+                'first_at': min([summary['first_at']] + timestamps),
+                'last_at': max([summary['last_at']] + timestamps),
+                'members': [(t['id'], t['timestamp']) for t in group],
+            })
+            continue
+        if len(group) < min_cluster_size:
+            continue
+        # 最接近中心的那一輪對話作為代表
+        representative = group[int(np.argmax(normalized[indexes] @ _normalize(centroid)))]
+        emotions = Counter(t['emotion_tag'] for t in group if t['emotion_tag'])
+        created.append({
+            'user_message': representative['user_message'],
+            'lumi_response': representative['lumi_response'],
+            'emotion_tag': emotions.most_common(1)[0][0] if emotions else None,
+            'embedding': centroid,
+            'source_count': len(group),
+            'first_at': min(timestamps),
+            'last_at': max(timestamps),
+            'members': [(t['id'], t['timestamp']) for t in group],
+        })
+    consolidated = sum(len(item['members']) for item in created + updated)
+    return {'created': created, 'updated': updated, 'consolidated': consolidated}
+
+
+def next_watermark(turns, plan, settle_before):
+    """整併進度可以前進到哪裡：第一筆沒有成群、又還在沉澱期的對話之前（全部可越過時為最後一筆）
+
+    回傳 None 表示進度不變。
+    """
+    clustered = {memory_id for item in plan['created'] + plan['updated'] for memory_id, _ in item['members']}
+    for turn in turns:
+        if turn['id'] not in clustered and turn['timestamp'] >= settle_before:
+            # 同一時間的對話要一起留下，進度停在比它早的最後一筆
+            earlier = [t['timestamp'] for t in turns if t['timestamp'] < turn['timestamp']]
+            return max(earlier) if earlier else None
+    return turns[-1]['timestamp'] if turns else None
+
+
+def candidate_users(conn, before, min_new_turns=20, limit=50):
+    """上次檢查之後有至少 min_new_turns 筆尚未整併的舊對話的用戶（多的優先）"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT m.user_id
+            FROM lumi_memories m
+            LEFT JOIN lumi_consolidation_state s ON s.user_id = m.user_id
+            WHERE m.timestamp < %s
+              AND m.timestamp > COALESCE(s.checked_until, s.consolidated_until, '-infinity')
+              AND m.summary_id IS NULL AND m.profile_tags = '{}'
+              AND (m.embedding IS NOT NULL OR m.embedding_i8 IS NOT NULL)
+            GROUP BY m.user_id
+            HAVING COUNT(*) >= %s
+            ORDER BY COUNT(*) DESC
+            LIMIT %s;
+        """, (before, min_new_turns, limit))
+        return [row[0] for row in cur.fetchall()]
+
+
+def load_turns(conn, user_id, before, limit=2000):
+    """這位用戶尚未整併的舊對話（時間正序），從上次整併到的時間之後開始
+
+    以 int8 儲存的對話（EMBEDDING_STORAGE=int8）還原成 float 向量後一起分群。
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, timestamp, user_message, lumi_response, emotion_tag, embedding, embedding_i8, embedding_scale
+            FROM lumi_memories
+            WHERE user_id = %s
+              AND timestamp > COALESCE((SELECT consolidated_until FROM lumi_consolidation_state
+                                        WHERE user_id = %s), '-infinity')
+              AND timestamp < %s
+              AND summary_id IS NULL AND profile_tags = '{}'
+              AND (embedding IS NOT NULL OR embedding_i8 IS NOT NULL)
+            ORDER BY timestamp ASC
+            LIMIT %s;
+        """, (user_id, user_id, before, limit))
+        columns = ('id', 'timestamp', 'user_message', 'lumi_response', 'emotion_tag', 'embedding')
+        turns = []
+        for row in cur.fetchall():
+            turn = dict(zip(columns, row[:6]))
+            if turn['embedding'] is None:
+                turn['embedding'] = dequantize_int8(row[6], row[7])
+            turns.append(turn)
+        return turns
+
+
+def load_summaries(conn, user_id):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, embedding, source_count, first_at, last_at
+            FROM lumi_memory_summaries
+            WHERE user_id = %s
+            ORDER BY id;
+        """, (user_id,))
+        columns = ('id', 'embedding', 'source_count', 'first_at', 'last_at')
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def save_consolidation(conn, user_id, plan, consolidated_until, checked_until):
+    """在一個交易中寫入摘要、標記來源對話並前進整併進度（consolidated_until 為 None 時進度不變）"""
+    with conn.cursor() as cur:
+        cur.execute("BEGIN;")
+        try:
+            marks = []
+            for item in plan['created']:
+                cur.execute("""
+                    INSERT INTO lumi_memory_summaries
+                        (user_id, user_message, lumi_response, emotion_tag, source_count, first_at, last_at, embedding)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id;
+                """, (user_id, item['user_message'], item['lumi_response'], item['emotion_tag'],
+                      item['source_count'], item['first_at'], item['last_at'],
+                      np.asarray(item['embedding'], dtype=np.float32)))
+                summary_id = cur.fetchone()[0]
+                marks += [(memory_id, ts, summary_id) for memory_id, ts in item['members']]
+            for item in plan['updated']:
+                cur.execute("""
+                    UPDATE lumi_memory_summaries
+                    SET embedding = %s, source_count = %s, first_at = %s, last_at = %s,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s;
+                """, (np.asarray(item['embedding'], dtype=np.float32), item['source_count'],
+                      item['first_at'], item['last_at'], item['id']))
+                marks += [(memory_id, ts, item['id']) for memory_id, ts in item['members']]
+            if marks:
+                # 帶上 timestamp，每筆只會落在一個分區
+                execute_values(cur, """
+                    UPDATE lumi_memories m SET summary_id = v.summary_id
+                    FROM (VALUES %s) AS v(id, timestamp, summary_id)
+                    WHERE m.id = v.id AND m.timestamp = v.timestamp;
+                """, marks, template="(%s, %s::timestamptz, %s)")
+            cur.execute("""
+                INSERT INTO lumi_consolidation_state (user_id, consolidated_until, checked_until)
+                VALUES (%(user_id)s, COALESCE(%(until)s::timestamptz, '-infinity'), %(checked)s)
+                ON CONFLICT (user_id) DO UPDATE
+                SET consolidated_until = COALESCE(%(until)s::timestamptz, lumi_consolidation_state.consolidated_until),
+                    checked_until = EXCLUDED.checked_until, updated_at = CURRENT_TIMESTAMP;
+            """, {'user_id': user_id, 'until': consolidated_until, 'checked': checked_until})
+            cur.execute("COMMIT;")
+        except Exception:
+            cur.execute("ROLLBACK;")
+            raise
+
+
+def consolidate_user(conn, user_id, before, threshold=0.9, min_cluster_size=3, batch_limit=2000, settle_days=30):
+    """整併一位用戶的一批舊對話，回傳 plan（沒有可整併的對話時回傳 None）
+
+    比 before 再早 settle_days 天的對話即使沒有成群，整併進度也會越過它。
+    """
+    turns = load_turns(conn, user_id, before, batch_limit)
+    if not turns:
+        return None
+    with metrics.span('memory_consolidation.cluster'):
+        plan = plan_consolidation(turns, load_summaries(conn, user_id), threshold, min_cluster_size)
+    settle_before = before - timedelta(days=settle_days)
+    save_consolidation(conn, user_id, plan, next_watermark(turns, plan, settle_before), turns[-1]['timestamp'])
+    logger.info("記憶整併: %d 筆對話，新增 %d 筆摘要、更新 %d 筆", plan['consolidated'],
+                len(plan['created']), len(plan['updated']), extra=log_user(user_id))
+    return plan
+
+
+@contextmanager
+def consolidation_lock(conn):
+    """advisory lock：拿到時 yield True，其他 process 正在整併時 yield False"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (CONSOLIDATION_LOCK_KEY,))
+        locked = cur.fetchone()[0]
+        try:
+            yield locked
+        finally:
+            if locked:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (CONSOLIDATION_LOCK_KEY,))
+
+
+class MemoryConsolidator:
+    """背景整併：每 interval 秒挑出舊對話累積最多的用戶逐一整併
+
+    get_pool() 回傳目前的連線池；busy_func() 為 True 時（例如 webhook 佇列有積壓）暫停。
+    """
+
+    def __init__(self, get_pool, min_age_days=30, threshold=0.9, min_cluster_size=3, min_new_turns=20,
+                 batch_limit=2000, users_per_run=50, interval=3600, busy_func=None, settle_days=30):
+        self.get_pool = get_pool
+        self.min_age_days = float(min_age_days)
+        self.settle_days = max(0.0, float(settle_days))
+        self.threshold = float(threshold)
+        self.min_cluster_size = max(2, int(min_cluster_size))
+        self.min_new_turns = max(1, int(min_new_turns))
+        self.batch_limit = max(1, int(batch_limit))
+        self.users_per_run = max(1, int(users_per_run))
+        self.interval = float(interval)
+        self.busy_func = busy_func or (lambda: False)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'failures': 0, 'skipped_locked': 0, 'users': 0, 'turns_consolidated': 0,
+                       'summaries_created': 0, 'summaries_updated': 0, 'last_run_at': None}
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="memory-consolidation", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self._stats['failures'] += 1
+                logger.error("❌ 記憶整併失敗: %s", e)
+            self._stop.wait(self.interval)
+
+    def run_once(self, now=None):
+        """整併一輪，回傳處理的用戶數；其他 process 正在整併時回傳 None"""
+        pool = self.get_pool()
+        if not pool:
+            return None
+        before = (now or datetime.now(timezone.utc)) - timedelta(days=self.min_age_days)
+        users = 0
+        with pool.connection() as conn, consolidation_lock(conn) as locked:
+            if not locked:
+                with self._lock:
+                    self._stats['skipped_locked'] += 1
+                return None
+            for user_id in candidate_users(conn, before, self.min_new_turns, self.users_per_run):
+                while self.busy_func() and not self._stop.is_set():
+                    self._stop.wait(1.0)
+                if self._stop.is_set():
+                    break
+                started = time.monotonic()
+                try:
+                    plan = consolidate_user(conn, user_id, before, self.threshold, self.min_cluster_size,
+                                            self.batch_limit, self.settle_days)
+                except Exception as e:
+                    with self._lock:
+                        self._stats['failures'] += 1
+                    logger.error("❌ 記憶整併失敗: %s", e, extra=log_user(user_id))
+                    continue
+                metrics.observe('memory_consolidation', time.monotonic() - started)
+                users += 1
+                if plan:
+                    metrics.inc('memory_turns_consolidated', plan['consolidated'])
+                    with self._lock:
+                        self._stats['turns_consolidated'] += plan['consolidated']
+                        self._stats['summaries_created'] += len(plan['created'])
+                        self._stats['summaries_updated'] += len(plan['updated'])
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['users'] += users
+            self._stats['last_run_at'] = datetime.now(timezone.utc).isoformat()
+        return users
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(min_age_days=self.min_age_days, settle_days=self.settle_days, threshold=self.threshold,
+                     min_cluster_size=self.min_cluster_size)
+        return stats
@@ -0,0 +1,251 @@
+"""
+lumi_memories 的每月分區維護：提前建立分區，以及把過期的分區匯出封存後移除
+
+分區名稱為 lumi_memories_pYYYYMM，範圍是 UTC 的整個月份。
+沒有 DEFAULT 分區：依時間排序的查詢才能逐一分區讀取（最新的分區讀夠了就停），
+因此寫入前一定要先有分區——啟動時與背景維護會建立到未來 months_ahead 個月。
+
+封存流程（每個過期分區）：
+1. COPY 匯出成 gzip 壓縮的 CSV（先寫 .tmp，完成後改名），並寫一份 manifest（筆數、sha256）
+2. 確認匯出的筆數與分區筆數相同
+3. DETACH 並 DROP 分區
+任何一步失敗都保留分區，下次重新匯出。
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PARTITION_PREFIX = 'lumi_memories_p'
+_PARTITION_NAME = re.compile(r'^lumi_memories_p(\d{4})(\d{2})$')
+
+# 多個 process 同時維護時只讓一個執行
+PARTITION_LOCK_KEY = 7315003
+
+
+def month_start(value):
+    """datetime / date → 該月第一天（UTC）"""
+    if isinstance(value, datetime):
+        value = value.astimezone(timezone.utc).date()
+    return value.replace(day=1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month.year:04d}{month.month:02d}"
+
+
+def _bound(month):
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def list_partitions(conn):
+    """目前掛在 lumi_memories 底下的分區，依月份排序：[(名稱, 月份第一天)]"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'lumi_memories'::regclass;
+        """)
+        names = [row[0] for row in cur.fetchall()]
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda item: item[1])
+
+
+def ensure_partitions(conn, months_ahead=3, now=None, months=None, lock_timeout='5s'):
+    """建立本月到未來 months_ahead 個月（或指定 months）的分區，回傳新建立的分區名稱
+
+    conn 需為 autocommit 連線；每個分區在自己的交易中建立，等不到鎖時放棄這一輪。
+    """
+    if months is None:
+        current = month_start(now or datetime.now(timezone.utc))
+        months = [add_months(current, i) for i in range(months_ahead + 1)]
+    existing = {name for name, _ in list_partitions(conn)}
+    created = []
+    with conn.cursor() as cur:
+        for month in sorted(set(months)):
+            name = partition_name(month)
+            if name in existing:
+                continue
+            cur.execute("BEGIN;")
+            try:
+                cur.execute(f"SET LOCAL lock_timeout = '{lock_timeout}';")
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {name} PARTITION OF lumi_memories
+                    FOR VALUES FROM (%s) TO (%s);
+                """, (_bound(month), _bound(add_months(month, 1))))
+                cur.execute("COMMIT;")
+            except Exception:
+                cur.execute("ROLLBACK;")
+                raise
+            created.append(name)
+            logger.info("✅ 已建立分區 %s", name)
+    return created
+
+
+def archive_partition(conn, name, archive_dir):
+    """匯出分區到 archive_dir/<name>.csv.gz 後移除分區，回傳 manifest"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    tmp_path = path + '.tmp'
+    started = time.monotonic()
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {name};")
+        expected = cur.fetchone()[0]
+        with gzip.open(tmp_path, 'wb') as out:
+            cur.copy_expert(f"COPY (SELECT * FROM {name} ORDER BY timestamp, id) TO STDOUT WITH (FORMAT csv, HEADER)",
+                            out)
+            exported = cur.rowcount
+        if exported != expected:
+            os.remove(tmp_path)
+            raise RuntimeError(f"{name} 匯出筆數 {exported} 與分區筆數 {expected} 不符")
+
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        os.replace(tmp_path, path)
+        manifest = {
+            'partition': name,
+            'file': os.path.basename(path),
+            'rows': exported,
+            'sha256': sha256.hexdigest(),
+            'archived_at': datetime.now(timezone.utc).isoformat(),
+        }
+        with open(os.path.join(archive_dir, f"{name}.json"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        cur.execute("BEGIN;")
+        try:
+            cur.execute("SET LOCAL lock_timeout = '5s';")
+            cur.execute(f"ALTER TABLE lumi_memories DETACH PARTITION {name};")
+            cur.execute(f"DROP TABLE {name};")
+            cur.execute("COMMIT;")
+        except Exception:
+            cur.execute("ROLLBACK;")
+            raise
+    metrics.observe('partition_archive', time.monotonic() - started)
+    logger.info("✅ 已封存分區 %s: %d 筆 → %s", name, exported, path)
+    return manifest
+
+
+@contextmanager
+def maintenance_lock(conn):
+    """advisory lock：拿到時 yield True，其他 process 正在維護時 yield False"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (PARTITION_LOCK_KEY,))
+        locked = cur.fetchone()[0]
+        try:
+            yield locked
+        finally:
+            if locked:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (PARTITION_LOCK_KEY,))
+
+
+def expired_partitions(partitions, retention_months, now=None):
+    """保留本月與之前 retention_months 個月，更早的分區視為過期"""
+    cutoff = add_months(month_start(now or datetime.now(timezone.utc)), -retention_months)
+    return [(name, month) for name, month in partitions if month < cutoff]
+
+
+def apply_retention(conn, retention_months, archive_dir, now=None):
+    """封存所有過期分區，回傳 manifest 清單；retention_months <= 0 表示不封存"""
+    if retention_months <= 0:
+        return []
+    manifests = []
+    for name, _ in expired_partitions(list_partitions(conn), retention_months, now):
+        manifests.append(archive_partition(conn, name, archive_dir))
+    return manifests
+
+
+class PartitionMaintainer:
+    """背景維護：定期建立未來的分區，設定保留月數時封存過期分區
+
+    get_pool() 回傳目前的連線池（資料庫重新連線後也能用到新的連線池）。
+    """
+
+    def __init__(self, get_pool, months_ahead=3, retention_months=0, archive_dir='archive', interval=21600):
+        self.get_pool = get_pool
+        self.months_ahead = int(months_ahead)
+        self.retention_months = int(retention_months)
+        self.archive_dir = archive_dir
+        self.interval = float(interval)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'failures': 0, 'skipped_locked': 0, 'created': [], 'archived': [],
+                       'last_run_at': None}
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="partition-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self._stats['failures'] += 1
+                logger.error("❌ 分區維護失敗: %s", e)
+            self._stop.wait(self.interval)
+
+    def run_once(self, now=None):
+        """回傳 (新建立的分區, 封存的 manifest)；其他 process 正在維護時回傳 None"""
+        pool = self.get_pool()
+        if not pool:
+            return None
+        with pool.connection() as conn, maintenance_lock(conn) as locked:
+            if not locked:
+                with self._lock:
+                    self._stats['skipped_locked'] += 1
+                return None
+            created = ensure_partitions(conn, self.months_ahead, now)
+            archived = apply_retention(conn, self.retention_months, self.archive_dir, now)
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['created'] += created
+            self._stats['archived'] += [m['partition'] for m in archived]
+            self._stats['last_run_at'] = datetime.now(timezone.utc).isoformat()
+        return created, archived
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats, created=list(self._stats['created']), archived=list(self._stats['archived']))
+        pool = self.get_pool()
+        if pool:
+            try:
+                with pool.connection() as conn:
+                    stats['partitions'] = [name for name, _ in list_partitions(conn)]
+            except Exception as e:
+                stats['error'] = str(e)
+        stats['months_ahead'] = self.months_ahead
+        stats['retention_months'] = self.retention_months
+        return stats
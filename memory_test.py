@@ -139,11 +139,10 @@ def cleanup_test_data():
     
     test_user_id = "test_user_001"
     
-    if memory_manager and memory_manager.conn:
+    if memory_manager and memory_manager.pool:
         try:
-            with memory_manager.conn.cursor() as cur:
+            with memory_manager.pool.connection() as conn, conn.cursor() as cur:
                 cur.execute("DELETE FROM lumi_memories WHERE user_id = %s", (test_user_id,))
-                memory_manager.conn.commit()
             print("  ✅ 測試資料已清理")
         except Exception as e:
             print(f"  ❌ 清理失敗: {e}")
@@ -160,7 +159,7 @@ def main():
         print("❌ 記憶管理器未初始化，請檢查資料庫連接")
         return
     
-    if not memory_manager.conn:
+    if not memory_manager.pool:
         print("❌ 資料庫連接失敗，請檢查 DATABASE_URL 環境變數")
         return
     
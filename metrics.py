@@ -0,0 +1,214 @@
+"""
+各階段延遲追蹤與 Prometheus 指標
+
+    with metrics.span('llm'):
+        ...
+
+    @metrics.timed('db.recent_context')
+    def query(...): ...
+
+每個 span 結束時把耗時記到該階段的直方圖（Prometheus buckets + 最近樣本的 p50/p95/p99），
+拋出例外時另外累計錯誤次數。記錄一次只需要一次 bisect 與 deque append，可以在正式環境常開。
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from collections import deque
+
+# 直方圖的上界（秒），涵蓋快取命中到 LLM 呼叫
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """單一階段的延遲分布：累計 buckets / sum / count，以及最近 window 筆樣本供計算百分位數"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1024):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.samples.append(seconds)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: 0.0 for q in quantiles}
+        last = len(ordered) - 1
+        return {q: ordered[min(last, int(round(q * last)))] for q in quantiles}
+
+
+class Span:
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+        self.seconds = 0.0
+
+    @property
+    def ms(self):
+        return round(self.seconds * 1000, 2)
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._started
+        self.registry.observe(self.stage, self.seconds, error=exc_type is not None)
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self, prefix='lumi', buckets=DEFAULT_BUCKETS, window=1024):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._errors = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def span(self, stage):
+        return Span(self, stage)
+
+    def timed(self, stage):
+        """裝飾器版本的 span"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            # 保留原本的簽名：LINE WebhookHandler 用 getfullargspec 決定要不要多傳 destination
+            wrapper.__signature__ = inspect.signature(func)
+            return wrapper
+        return decorator
+
+    def observe(self, stage, seconds, error=False):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.buckets, self.window)
+            histogram.observe(seconds)
+            if error:
+                self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    def inc(self, name, amount=1, **labels):
+        """累加計數器，例如 inc('retrieval_timeouts', stage='similar')"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauge(self, name, func, help_text='', label=None):
+        """輸出時才呼叫 func()，回傳數值；有 label 時回傳 {標籤值: 數值}"""
+        self._gauges[name] = (func, help_text, label)
+
+    def get_summary(self):
+        """各階段的次數、錯誤與 p50/p95/p99（毫秒）"""
+        with self._lock:
+            stages = {}
+            for stage, h in sorted(self._histograms.items()):
+                p = h.percentiles()
+                stages[stage] = {
+                    'count': h.count,
+                    'errors': self._errors.get(stage, 0),
+                    'avg_ms': round(h.total / h.count * 1000, 2) if h.count else 0.0,
+                    'p50_ms': round(p[0.5] * 1000, 2),
+                    'p95_ms': round(p[0.95] * 1000, 2),
+                    'p99_ms': round(p[0.99] * 1000, 2),
+                }
+            counters = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                label = ','.join(f"{k}={v}" for k, v in labels)
+                counters[f"{name}{{{label}}}" if label else name] = value
+        return {'stages': stages, 'counters': counters}
+
+    def render_prometheus(self):
+        """Prometheus text exposition format"""
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_stage_duration_seconds 各階段耗時",
+            f"# TYPE {p}_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            histograms = [(stage, list(h.counts), h.total, h.count) for stage, h in sorted(self._histograms.items())]
+            errors = sorted(self._errors.items())
+            counters = sorted(self._counters.items())
+            quantiles = {stage: h.percentiles() for stage, h in self._histograms.items()}
+
+        for stage, counts, total, count in histograms:
+            label = _escape(stage)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{p}_stage_duration_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{p}_stage_duration_seconds_bucket{{stage="{label}",le="+Inf"}} {count}')
+            lines.append(f'{p}_stage_duration_seconds_sum{{stage="{label}"}} {total:.6f}')
+            lines.append(f'{p}_stage_duration_seconds_count{{stage="{label}"}} {count}')
+
+        lines.append(f"# HELP {p}_stage_latency_recent_seconds 最近樣本的百分位數")
+        lines.append(f"# TYPE {p}_stage_latency_recent_seconds gauge")
+        for stage, values in sorted(quantiles.items()):
+            for q, value in values.items():
+                lines.append(f'{p}_stage_latency_recent_seconds{{stage="{_escape(stage)}",quantile="{q}"}} {value:.6f}')
+
+        lines.append(f"# HELP {p}_stage_errors_total 各階段拋出例外的次數")
+        lines.append(f"# TYPE {p}_stage_errors_total counter")
+        for stage, n in errors:
+            lines.append(f'{p}_stage_errors_total{{stage="{_escape(stage)}"}} {n}')
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{p}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {value}")
+
+        for name, (func, help_text, label_name) in sorted(self._gauges.items()):
+            metric = f"{p}_{name}"
+            try:
+                value = func()
+            except Exception:
+                continue
+            if help_text:
+                lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            if label_name:
+                for label_value, v in sorted(value.items()):
+                    lines.append(f'{metric}{{{label_name}="{_escape(label_value)}"}} {v}')
+            else:
+                lines.append(f"{metric} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._errors.clear()
+            self._counters.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+# process 共用的 registry
+REGISTRY = MetricsRegistry()
+span = REGISTRY.span
+timed = REGISTRY.timed
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+register_gauge = REGISTRY.register_gauge
@@ -0,0 +1,43 @@
+"""
+個人資料標籤：寫入對話時就判斷訊息屬於哪些個人資料類別，存進 lumi_memories.profile_tags
+
+關鍵詞可以不改 SQL 就調整：
+- PROFILE_KEYWORDS_FILE：JSON 檔，內容可以是關鍵詞 list，或 {標籤: [關鍵詞, ...]}
+- PROFILE_KEYWORDS：以逗號分隔的關鍵詞
+調整後執行 backfill_profile_tags.py 重新標記既有記憶。
+"""
+import os
+import json
+
+# 預設關鍵詞（標籤就是關鍵詞本身）
+DEFAULT_PROFILE_KEYWORDS = [
+    '喜歡', '討厭', '習慣', '工作', '學校', '家人', '朋友', '興趣', '愛好',
+    '生日', '年齡', '住址', '電話', 'email', '職業', '學歷', '夢想', '目標',
+    '害怕', '擔心', '開心', '難過', '壓力', '放鬆', '運動', '音樂', '電影',
+    '食物', '顏色', '動物', '地方', '旅行', '學習', '技能', '成就', '挫折'
+]
+
+
+def load_profile_keywords():
+    """讀取設定，回傳 {標籤: [關鍵詞, ...]}"""
+    path = os.getenv('PROFILE_KEYWORDS_FILE')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    elif os.getenv('PROFILE_KEYWORDS'):
+        data = [k.strip() for k in os.getenv('PROFILE_KEYWORDS').split(',') if k.strip()]
+    else:
+        data = DEFAULT_PROFILE_KEYWORDS
+
+    if isinstance(data, dict):
+        return {tag: [k.lower() for k in (words if isinstance(words, list) else [words])]
+                for tag, words in data.items()}
+    return {keyword: [keyword.lower()] for keyword in data}
+
+
+def extract_profile_tags(text, keyword_sets):
+    """回傳訊息命中的標籤（排序後的 list，沒有命中就是空 list）"""
+    if not isinstance(text, str) or not text:
+        return []
+    lowered = text.lower()
+    return sorted(tag for tag, words in keyword_sets.items() if any(w in lowered for w in words))
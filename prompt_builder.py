@@ -0,0 +1,165 @@
+"""
+依 token 預算組出回覆用的 prompt
+
+- 記憶在各段落之間去除重複（同一輪對話只保留在優先順序最高的段落）
+- 每個段落各自排序後，在自己的預算內由重要到次要依序放入
+- 回傳各段落實際使用的 token 數，方便觀察 prompt 大小
+
+有安裝 tiktoken 時用模型的 tokenizer 計數，否則用字元估算（中日韓文字約一字一 token）。
+"""
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    except Exception:
+        _encoding = None
+
+_CJK = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+_WHITESPACE = re.compile(r'\s+')
+
+# 段落的預設順序（也是去重時的優先順序）
+SECTION_ORDER = ('recent', 'profile', 'similar')
+
+SECTION_TITLES = {
+    'recent': "【最近的對話歷史】",
+    'profile': "【用戶個人資料】",
+    'similar': "【相關歷史對話】",
+}
+
+
+def count_tokens(text):
+    """計算 token 數"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    cjk = len(_CJK.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def truncate_to_tokens(text, max_tokens):
+    """截斷到 max_tokens 以內（超過時結尾加上「…」）"""
+    if max_tokens <= 0:
+        return ''
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens - 1]) + '…'
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens - 1:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + '…'
+
+
+def _memory_key(memory):
+    return (_WHITESPACE.sub('', memory.get('user_message') or ''),
+            _WHITESPACE.sub('', memory.get('lumi_response') or ''))
+
+
+class PromptBuilder:
+    """各段落的 token 預算可由環境變數或參數調整"""
+
+    def __init__(self, budgets=None, entry_max_tokens=None):
+        self.budgets = {
+            'recent': int(os.getenv('PROMPT_BUDGET_RECENT', '400')),
+            'profile': int(os.getenv('PROMPT_BUDGET_PROFILE', '200')),
+            'similar': int(os.getenv('PROMPT_BUDGET_SIMILAR', '300')),
+        }
+        self.budgets.update(budgets or {})
+        self.entry_max_tokens = int(entry_max_tokens or os.getenv('PROMPT_ENTRY_MAX_TOKENS', '120'))
+        self._fixed_tokens = {}
+
+    def _fixed_count(self, text):
+        """人格設定與規則是固定字串，只算一次"""
+        tokens = self._fixed_tokens.get(text)
+        if tokens is None:
+            tokens = self._fixed_tokens[text] = count_tokens(text)
+        return tokens
+
+    @staticmethod
+    def _rank(section, memories):
+        """由最重要到最不重要排序，回傳 (原本位置, 記憶)
+
+        最近對話（時間正序傳入）越新越重要，相似對話依相似度，個人資料維持傳入的新到舊順序。
+        """
+        indexed = list(enumerate(memories))
+        if section == 'recent':
+            return indexed[::-1]
+        if section == 'similar':
+            return sorted(indexed, key=lambda item: item[1].get('similarity') or 0.0, reverse=True)
+        return indexed
+
+    def _format(self, section, memory):
+        half = self.entry_max_tokens // 2
+        user_message = truncate_to_tokens(memory.get('user_message') or '', half)
+        lumi_response = truncate_to_tokens(memory.get('lumi_response') or '', half)
+        if section == 'recent':
+            return f"用戶: {user_message}\nLumi: {lumi_response}\n"
+        return f"{user_message} → {lumi_response}\n"
+
+    def build_memory_context(self, sections):
+        """sections: {'recent': [...], 'profile': [...], 'similar': [...]}
+
+        回傳 (記憶上下文字串, 報告)；報告含各段落 token 數與被去除的筆數。
+        """
+        seen = set()
+        parts = []
+        report = {'tokens': {}, 'entries': {}, 'duplicates': 0, 'over_budget': 0}
+        for section in SECTION_ORDER:
+            memories = []
+            for memory in sections.get(section) or []:
+                key = _memory_key(memory)
+                if key in seen:
+                    report['duplicates'] += 1
+                    continue
+                seen.add(key)
+                memories.append(memory)
+
+            header = f"\n\n{SECTION_TITLES[section]}\n"
+            budget = self.budgets.get(section, 0)
+            used = count_tokens(header)
+            chosen = []
+            for index, memory in self._rank(section, memories):
+                line = self._format(section, memory)
+                tokens = count_tokens(line)
+                if used + tokens > budget:
+                    report['over_budget'] += 1
+                    continue
+                used += tokens
+                chosen.append((index, line))
+
+            if not chosen:
+                report['tokens'][section] = 0
+                report['entries'][section] = 0
+                continue
+            if section == 'recent':
+                # 最近對話依時間正序呈現
+                chosen.sort()
+            parts.append(header + ''.join(line for _, line in chosen))
+            report['tokens'][section] = used
+            report['entries'][section] = len(chosen)
+        return ''.join(parts), report
+
+    def build(self, persona, sections, message, rules):
+        """組出完整 prompt，回傳 (prompt, 報告)"""
+        memory_context, report = self.build_memory_context(sections)
+        message_part = f"\n\n用戶訊息：{message}"
+        rules_part = f"\n\n{rules}"
+        report['tokens']['persona'] = self._fixed_count(persona)
+        report['tokens']['message'] = count_tokens(message_part)
+        report['tokens']['rules'] = self._fixed_count(rules_part)
+        report['tokens']['total'] = sum(report['tokens'].values())
+        return persona + memory_context + message_part + rules_part, report
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+切換嵌入儲存方式（EMBEDDING_STORAGE）時搬移既有的 lumi_memories
+
+- 預設：把還只有 float32 embedding 的對話量化，寫入 embedding_i8 / embedding_scale / embedding_bits
+  （不動原本的 embedding，可以在服務仍是 vector 模式時先跑）
+- --drop-float：已量化的對話清空 float32 embedding（切換到 int8 並確認搜尋正常之後再執行；
+  空間要等 VACUUM 之後才會重複使用，要交還給作業系統需 VACUUM FULL 或 pg_repack）
+- --restore：切回 vector 模式前，把只有 int8 的對話還原成 float32 embedding
+
+以 id 分批處理，每批一個 UPDATE，可以在服務運行中執行，中斷後重新執行會接著處理。
+
+用法：
+    DATABASE_URL=postgresql://... python quantize_embeddings.py --batch-size 1000
+    DATABASE_URL=postgresql://... python quantize_embeddings.py --drop-float
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import schema
+from vector_utils import as_float_array, quantize_int8, dequantize_int8, binary_signature
+
+
+def quantize_batch(cur, last_id, batch_size):
+    cur.execute("""
+        SELECT id, timestamp, embedding
+        FROM lumi_memories
+        WHERE id > %s AND embedding IS NOT NULL AND embedding_i8 IS NULL
+        ORDER BY id
+        LIMIT %s;
+    """, (last_id, batch_size))
+    rows = cur.fetchall()
+    if rows:
+        vectors = np.stack([as_float_array(row[2]) for row in rows])
+        quantized, scales = quantize_int8(vectors)
+        execute_values(cur, """
+            UPDATE lumi_memories AS m
+            SET embedding_i8 = v.embedding_i8, embedding_scale = v.embedding_scale,
+                embedding_bits = v.embedding_bits
+            FROM (VALUES %s) AS v(id, timestamp, embedding_i8, embedding_scale, embedding_bits)
+            WHERE m.id = v.id AND m.timestamp = v.timestamp;
+        """, [(row[0], row[1], q.tobytes(), float(scale), binary_signature(vector))
+              for row, q, scale, vector in zip(rows, quantized, scales, vectors)],
+            template="(%s, %s::timestamptz, %s::bytea, %s::real, %s::varbit)")
+    return rows
+
+
+def drop_float_batch(cur, last_id, batch_size):
+    cur.execute("""
+        WITH batch AS (
+            SELECT id, timestamp
+            FROM lumi_memories
+            WHERE id > %s AND embedding IS NOT NULL AND embedding_i8 IS NOT NULL
+            ORDER BY id
+            LIMIT %s
+        )
+        UPDATE lumi_memories AS m
+        SET embedding = NULL
+        FROM batch
+        WHERE m.id = batch.id AND m.timestamp = batch.timestamp
+        RETURNING m.id;
+    """, (last_id, batch_size))
+    return sorted(cur.fetchall())
+
+
+def restore_batch(cur, last_id, batch_size):
+    cur.execute("""
+        SELECT id, timestamp, embedding_i8, embedding_scale
+        FROM lumi_memories
+        WHERE id > %s AND embedding IS NULL AND embedding_i8 IS NOT NULL
+        ORDER BY id
+        LIMIT %s;
+    """, (last_id, batch_size))
+    rows = cur.fetchall()
+    if rows:
+        execute_values(cur, """
+            UPDATE lumi_memories AS m
+            SET embedding = v.embedding
+            FROM (VALUES %s) AS v(id, timestamp, embedding)
+            WHERE m.id = v.id AND m.timestamp = v.timestamp;
+        """, [(row[0], row[1], dequantize_int8(row[2], row[3])) for row in rows],
+            template="(%s, %s::timestamptz, %s::vector)")
+    return rows
+
+
+def migrate(conn, step, batch_size=1000, start_id=0):
+    """重複執行 step 直到沒有資料，回傳處理筆數"""
+    last_id = start_id
+    processed = 0
+    while True:
+        with conn.cursor() as cur:
+            rows = step(cur, last_id, batch_size)
+        if not rows:
+            return processed
+        processed += len(rows)
+        last_id = rows[-1][0]
+        print(f"  已處理到 id={last_id}（累計 {processed} 筆）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="搬移 lumi_memories 的嵌入儲存方式")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--start-id', type=int, default=0)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--drop-float', action='store_true', help='量化後清空 float32 embedding')
+    mode.add_argument('--restore', action='store_true', help='把只有 int8 的對話還原成 float32 embedding')
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        print("❌ 請設定 DATABASE_URL")
+        sys.exit(1)
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    register_vector(conn)
+    schema.apply_migrations(conn)
+
+    started = time.time()
+    if args.restore:
+        print("♻️ 還原 float32 embedding...")
+        restored = migrate(conn, restore_batch, args.batch_size, args.start_id)
+        print(f"✅ 已還原 {restored} 筆，耗時 {time.time() - started:.1f}s")
+    else:
+        print("🗜️ 量化既有的 embedding...")
+        quantized = migrate(conn, quantize_batch, args.batch_size, args.start_id)
+        print(f"✅ 已量化 {quantized} 筆，耗時 {time.time() - started:.1f}s")
+        if args.drop_float:
+            dropped = migrate(conn, drop_float_batch, args.batch_size, args.start_id)
+            print(f"✅ 已清空 {dropped} 筆 float32 embedding；執行 VACUUM 後空間才會重複使用")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+更換嵌入後端 / 模型 / 維度（EMBEDDING_BACKEND、EMBEDDING_MODEL、EMBEDDING_DIM）後重新產生所有對話的嵌入
+
+1. schema.change_embedding_dimension：嵌入欄位改成新的維度、清空舊嵌入、摘要與嵌入快取
+   （對話文字都保留；整併會在之後的排程中用新嵌入重新進行）
+2. 以 id 分批讀取還沒有嵌入的對話，用新的後端產生嵌入後寫回（依 EMBEDDING_STORAGE 寫入 float32 或 int8）
+3. 依 VECTOR_INDEX_TYPE 重建向量索引
+
+步驟 1 之後到步驟 2 完成前，相似記憶搜尋只會找到已重新產生的對話；中斷後重新執行會接著處理。
+請先停止服務（或先部署新設定再執行，新設定啟動時若仍有舊嵌入會拒絕連線資料庫）。
+
+用法：
+    DATABASE_URL=postgresql://... EMBEDDING_BACKEND=hashing python reembed_memories.py --dry-run
+    DATABASE_URL=postgresql://... EMBEDDING_BACKEND=hashing python reembed_memories.py --yes
+"""
+
+import os
+import sys
+import time
+import argparse
+from functools import partial
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import schema
+from embedding_backends import get_backend
+from quantize_embeddings import migrate
+from vector_utils import stored_embedding
+
+
+def embed_texts(backend, texts):
+    """空白文字回傳零向量（與 SimpleLumiMemory._get_embeddings 相同），其餘一次交給後端"""
+    results = [np.zeros(backend.dim).tolist() if not t.strip() else None for t in texts]
+    todo = [i for i, t in enumerate(texts) if t.strip()]
+    if todo:
+        for i, embedding in zip(todo, backend.embed([texts[i] for i in todo])):
+            results[i] = embedding
+    return results
+
+
+def reembed_batch(cur, last_id, batch_size, backend, storage='vector'):
+    cur.execute("""
+        SELECT id, timestamp, user_message
+        FROM lumi_memories
+        WHERE id > %s AND embedding IS NULL AND embedding_i8 IS NULL
+        ORDER BY id
+        LIMIT %s;
+    """, (last_id, batch_size))
+    rows = cur.fetchall()
+    if rows:
+        embeddings = embed_texts(backend, [row[2] or '' for row in rows])
+        execute_values(cur, """
+            UPDATE lumi_memories AS m
+            SET embedding = v.embedding, embedding_i8 = v.embedding_i8,
+                embedding_scale = v.embedding_scale, embedding_bits = v.embedding_bits
+            FROM (VALUES %s) AS v(id, timestamp, embedding, embedding_i8, embedding_scale, embedding_bits)
+            WHERE m.id = v.id AND m.timestamp = v.timestamp;
+        """, [(row[0], row[1]) + stored_embedding(embedding, storage) for row, embedding in zip(rows, embeddings)],
+            template="(%s, %s::timestamptz, %s::vector, %s::bytea, %s::real, %s::varbit)")
+    return rows
+
+
+def reembed(conn, backend, storage='vector', batch_size=500, start_id=0):
+    """切換嵌入設定並重新產生嵌入，回傳處理筆數"""
+    if schema.change_embedding_dimension(conn, backend.model, backend.dim):
+        print(f"🔁 嵌入欄位已改為 {backend.model}（{backend.dim} 維），舊嵌入已清空")
+    return migrate(conn, partial(reembed_batch, backend=backend, storage=storage), batch_size, start_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="更換嵌入後端後重新產生 lumi_memories 的嵌入")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--start-id', type=int, default=0)
+    parser.add_argument('--dry-run', action='store_true', help='只顯示目前與新的設定及筆數')
+    parser.add_argument('--yes', action='store_true', help='確認清空舊嵌入')
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        print("❌ 請設定 DATABASE_URL")
+        sys.exit(1)
+
+    backend = get_backend()
+    storage = os.getenv('EMBEDDING_STORAGE', 'vector').lower()
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    register_vector(conn)
+    schema.apply_migrations(conn)
+
+    model, dim = schema.get_embedding_config(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM lumi_memories;")
+        total = cur.fetchone()[0]
+    print(f"📋 目前: {model}（{dim} 維） → 新設定: {backend.model}（{backend.dim} 維），共 {total} 筆對話")
+    if args.dry_run:
+        conn.close()
+        return
+    if not args.yes and (model, dim) != (backend.model, backend.dim):
+        print("❌ 會清空所有舊嵌入與整併摘要，確認後請加上 --yes")
+        sys.exit(1)
+
+    started = time.time()
+    processed = reembed(conn, backend, storage, args.batch_size, args.start_id)
+    print(f"✅ 已重新產生 {processed} 筆嵌入，耗時 {time.time() - started:.1f}s")
+    index_type = os.getenv('VECTOR_INDEX_TYPE', 'hnsw').lower()
+    if schema.ensure_vector_index(conn, index_type):
+        print(f"✅ 已重建 {index_type} 向量索引")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+回覆期限：從收到 webhook 的時間點開始計算
+
+LINE 的 reply token 在 webhook 送出後一段時間就會失效，產生回覆（記憶檢索 + LLM）
+必須在期限內完成；太晚才產生的回覆改用 push_message 送出。
+"""
+import os
+import re
+import time
+
+# reply token 視為有效的秒數，以及送出前保留的安全時間
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '50'))
+REPLY_SAFETY_MARGIN = float(os.getenv('REPLY_SAFETY_MARGIN', '3'))
+
+# 從收到 webhook 起，LLM 產生回覆最多可以用到的秒數（需小於 REPLY_TOKEN_TTL）
+LLM_DEADLINE_SECONDS = float(os.getenv('LLM_DEADLINE_SECONDS', '25'))
+
+_SENTENCE_END = re.compile(r'[。！？!?~～\n]')
+
+
+class Deadline:
+    """以 time.monotonic() 計算的期限"""
+
+    def __init__(self, budget_seconds, started_at=None):
+        self.budget = float(budget_seconds)
+        self.started_at = started_at if started_at is not None else time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining(self):
+        return max(0.0, self.budget - self.elapsed())
+
+    def expired(self):
+        return self.elapsed() >= self.budget
+
+
+def reply_token_usable(received_at, ttl=None, margin=None):
+    """reply token 還來得及用時回傳 (True, 剩餘秒數)，否則 (False, 剩餘秒數)"""
+    ttl = REPLY_TOKEN_TTL if ttl is None else ttl
+    margin = REPLY_SAFETY_MARGIN if margin is None else margin
+    remaining = ttl - (time.monotonic() - received_at)
+    return remaining > margin, max(0.0, remaining)
+
+
+def trim_partial(text):
+    """期限到時只拿到部分回覆：切在最後一個完整句子，沒有句子結尾就加上「…」"""
+    text = (text or '').strip()
+    if not text:
+        return ''
+    ends = [m.end() for m in _SENTENCE_END.finditer(text)]
+    if ends and ends[-1] >= len(text) // 3:
+        return text[:ends[-1]].strip()
+    return text + '…'
@@ -0,0 +1,443 @@
+"""
+資料庫結構版本管理
+
+每個 migration 只會執行一次，已套用的版本記錄在 lumi_schema_version。
+啟動時只要版本已是最新，就只花一次查詢、不會跑任何 DDL。
+"""
+import psycopg2
+import psycopg2.errors
+
+# 多個 process 同時啟動時，用 advisory lock 確保只有一個在跑 migration
+MIGRATION_LOCK_KEY = 7315001
+
+# (版本, 說明, SQL 清單)，只能往後新增，不要修改已發布的版本
+MIGRATIONS = [
+    (1, "建立 lumi_memories 資料表與基本索引", [
+        "CREATE EXTENSION IF NOT EXISTS vector;",
+        """
+        CREATE TABLE IF NOT EXISTS lumi_memories (
+            id SERIAL PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            user_message TEXT NOT NULL,
+            lumi_response TEXT NOT NULL,
+            emotion_tag TEXT,
+            timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            embedding VECTOR(1536),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_lumi_memories_user_id ON lumi_memories(user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_lumi_memories_timestamp ON lumi_memories(timestamp DESC);",
+        """
+        CREATE INDEX IF NOT EXISTS idx_lumi_memories_emotion_tag
+        ON lumi_memories(emotion_tag) WHERE emotion_tag IS NOT NULL;
+        """,
+    ]),
+    (2, "建立嵌入快取資料表", [
+        """
+        CREATE TABLE IF NOT EXISTS lumi_embedding_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            embedding VECTOR(1536) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (3, "新增 profile_tags 欄位與個人資料部分索引", [
+        "ALTER TABLE lumi_memories ADD COLUMN IF NOT EXISTS profile_tags TEXT[] NOT NULL DEFAULT '{}';",
+        """
+        CREATE INDEX IF NOT EXISTS idx_lumi_memories_profile_facts
+        ON lumi_memories(user_id, timestamp DESC) WHERE profile_tags <> '{}';
+        """,
+    ]),
+    (4, "建立 user_profiles 資料表並搬移既有的 profile 記憶", [
+        """
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id TEXT PRIMARY KEY,
+            name TEXT,
+            attributes JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        # 舊版把名稱存成 emotion_tag='profile' 的假對話（「我是XXX」），取每位用戶最新的一筆
+        """
+        INSERT INTO user_profiles (user_id, name, updated_at)
+        SELECT DISTINCT ON (user_id)
+               user_id, btrim(regexp_replace(user_message, '^(我的名字是|我是|我叫)', '')), timestamp
+        FROM lumi_memories
+        WHERE emotion_tag = 'profile'
+        ORDER BY user_id, timestamp DESC
+        ON CONFLICT (user_id) DO NOTHING;
+        """,
+    ]),
+    (5, "建立每日日記快取資料表", [
+        """
+        CREATE TABLE IF NOT EXISTS lumi_daily_diaries (
+            user_id TEXT NOT NULL,
+            diary_date DATE NOT NULL,
+            diary TEXT NOT NULL,
+            last_memory_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            turn_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, diary_date)
+        );
+        """,
+    ]),
+    (6, "依用戶查詢時間範圍的複合索引", [
+        # 每位用戶的查詢都以時間排序，(user_id, timestamp DESC) 可以直接依序讀出、不需要排序
+        """
+        CREATE INDEX IF NOT EXISTS idx_lumi_memories_user_timestamp
+        ON lumi_memories(user_id, timestamp DESC);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_lumi_memories_user_emotion_timestamp
+        ON lumi_memories(user_id, emotion_tag, timestamp DESC);
+        """,
+        # 已被上面兩個索引的前綴涵蓋
+        "DROP INDEX IF EXISTS idx_lumi_memories_user_id;",
+    ]),
+    (7, "lumi_memories 改為依 timestamp 每月分區", [
+        # 舊表改名保留到資料搬完；序號沿用，id 不會重複
+        "ALTER TABLE lumi_memories RENAME TO lumi_memories_unpartitioned;",
+        "ALTER TABLE lumi_memories_unpartitioned RENAME CONSTRAINT lumi_memories_pkey TO lumi_memories_unpartitioned_pkey;",
+        "ALTER SEQUENCE lumi_memories_id_seq OWNED BY NONE;",
+        # 分區表的主鍵必須包含分區鍵
+        """
+        CREATE TABLE lumi_memories (
+            id INTEGER NOT NULL DEFAULT nextval('lumi_memories_id_seq'),
+            user_id TEXT NOT NULL,
+            user_message TEXT NOT NULL,
+            lumi_response TEXT NOT NULL,
+            emotion_tag TEXT,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            embedding VECTOR(1536),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            profile_tags TEXT[] NOT NULL DEFAULT '{}',
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        """,
+        "ALTER SEQUENCE lumi_memories_id_seq OWNED BY lumi_memories.id;",
+        # 建立涵蓋既有資料到下個月的分區（UTC 月份），之後由 memory_partitions 提前建立
+        """
+        DO $$
+        DECLARE
+            month_start TIMESTAMP;
+            last_month TIMESTAMP;
+        BEGIN
+            SELECT date_trunc('month', COALESCE(MIN(COALESCE(timestamp, created_at)), now()) AT TIME ZONE 'UTC'),
+                   date_trunc('month', GREATEST(MAX(COALESCE(timestamp, created_at)), now()) AT TIME ZONE 'UTC')
+            INTO month_start, last_month
+            FROM lumi_memories_unpartitioned;
+            WHILE month_start <= last_month + INTERVAL '1 month' LOOP
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF lumi_memories FOR VALUES FROM (%L) TO (%L)',
+                    'lumi_memories_p' || to_char(month_start, 'YYYYMM'),
+                    month_start AT TIME ZONE 'UTC',
+                    (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC');
+                month_start := month_start + INTERVAL '1 month';
+            END LOOP;
+        END $$;
+        """,
+        """
+        INSERT INTO lumi_memories (id, user_id, user_message, lumi_response, emotion_tag, timestamp,
+                                   embedding, created_at, profile_tags)
+        SELECT id, user_id, user_message, lumi_response, emotion_tag, COALESCE(timestamp, created_at, now()),
+               embedding, created_at, profile_tags
+        FROM lumi_memories_unpartitioned;
+        """,
+        "DROP TABLE lumi_memories_unpartitioned;",
+        # 索引建在分區表上，每個分區（包含之後新建的）都會自動建立對應的索引
+        "CREATE INDEX idx_lumi_memories_user_timestamp ON lumi_memories(user_id, timestamp DESC);",
+        "CREATE INDEX idx_lumi_memories_user_emotion_timestamp ON lumi_memories(user_id, emotion_tag, timestamp DESC);",
+        "CREATE INDEX idx_lumi_memories_timestamp ON lumi_memories(timestamp DESC);",
+        """
+        CREATE INDEX idx_lumi_memories_emotion_tag
+        ON lumi_memories(emotion_tag) WHERE emotion_tag IS NOT NULL;
+        """,
+        """
+        CREATE INDEX idx_lumi_memories_profile_facts
+        ON lumi_memories(user_id, timestamp DESC) WHERE profile_tags <> '{}';
+        """,
+    ]),
+    (8, "記憶整併：摘要資料表與整併進度", [
+        # 一筆摘要代表一群相似的舊對話，embedding 是各筆單位向量的平均（中心向量）
+        """
+        CREATE TABLE IF NOT EXISTS lumi_memory_summaries (
+            id SERIAL PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            user_message TEXT NOT NULL,
+            lumi_response TEXT NOT NULL,
+            emotion_tag TEXT,
+            source_count INTEGER NOT NULL,
+            first_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            last_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            embedding VECTOR(1536) NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        # 每位用戶的摘要不多，依 user_id 取出後精確計算距離即可
+        "CREATE INDEX IF NOT EXISTS idx_lumi_memory_summaries_user_id ON lumi_memory_summaries(user_id);",
+        """
+        CREATE TABLE IF NOT EXISTS lumi_consolidation_state (
+            user_id TEXT PRIMARY KEY,
+            consolidated_until TIMESTAMP WITH TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        # 已整併進摘要的對話（NULL 表示還是獨立的一輪對話）；可為 NULL 且沒有預設值，不需要重寫資料表
+        "ALTER TABLE lumi_memories ADD COLUMN IF NOT EXISTS summary_id INTEGER;",
+    ]),
+    (9, "量化嵌入欄位（int8 與正負號位元）", [
+        # EMBEDDING_STORAGE=int8 時寫入這三欄、embedding 留空：int8 約 1.5 KB（float32 為 6 KB），
+        # 位元字串在資料庫中以 hamming 距離挑候選，再由應用程式用 int8 精確重新排序
+        "ALTER TABLE lumi_memories ADD COLUMN IF NOT EXISTS embedding_i8 BYTEA;",
+        "ALTER TABLE lumi_memories ADD COLUMN IF NOT EXISTS embedding_scale REAL;",
+        "ALTER TABLE lumi_memories ADD COLUMN IF NOT EXISTS embedding_bits BIT VARYING;",
+    ]),
+    (10, "記錄嵌入模型與維度", [
+        # 只有一列；既有的嵌入都是 ada-002 產生的，換後端時由 ensure_embedding_config 檢查
+        """
+        CREATE TABLE IF NOT EXISTS lumi_embedding_config (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        INSERT INTO lumi_embedding_config (model, dim) VALUES ('text-embedding-ada-002', 1536)
+        ON CONFLICT (id) DO NOTHING;
+        """,
+    ]),
+    (11, "整併檢查進度", [
+        # consolidated_until 只前進到已成群或超過沉澱期的對話；checked_until 記錄分群看過的最新對話，
+        # 沒有更新的對話時不再重新分群還在沉澱期的對話
+        "ALTER TABLE lumi_consolidation_state ADD COLUMN IF NOT EXISTS checked_until TIMESTAMP WITH TIME ZONE;",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """目前已套用的版本，尚未建立版本表時回傳 0"""
+    with conn.cursor() as cur:
+        try:
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM lumi_schema_version;")
+        except psycopg2.errors.UndefinedTable:
+            return 0
+        return cur.fetchone()[0]
+
+
+def apply_migrations(conn, migrations=None):
+    """套用尚未執行的 migration，回傳 (原本版本, 目前版本)
+
+    conn 需為 autocommit 連線；每個 migration 在自己的交易中執行。
+    """
+    migrations = migrations or MIGRATIONS
+    latest = migrations[-1][0]
+    current = get_schema_version(conn)
+    if current >= latest:
+        return current, current
+
+    start_version = current
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS lumi_schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            # 拿到鎖之後重新讀取，其他 process 可能已經套用過
+            current = get_schema_version(conn)
+            for version, description, statements in migrations:
+                if version <= current:
+                    continue
+                cur.execute("BEGIN;")
+                try:
+                    for sql in statements:
+                        cur.execute(sql)
+                    cur.execute(
+                        "INSERT INTO lumi_schema_version (version, description) VALUES (%s, %s);",
+                        (version, description)
+                    )
+                    cur.execute("COMMIT;")
+                except psycopg2.Error:
+                    cur.execute("ROLLBACK;")
+                    raise
+                current = version
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+    return start_version, current
+
+
+# 向量索引（ANN）：類型可透過設定切換，由啟動流程確保只存在一種
+VECTOR_INDEX_PREFIX = 'idx_lumi_memories_embedding_'
+VECTOR_INDEX_TYPES = ('hnsw', 'ivfflat', 'none')
+
+
+def _vector_index_ddl(cur, index_type, table='lumi_memories', name=None, only=False):
+    name = name or VECTOR_INDEX_PREFIX + index_type
+    # 分區表本身不能 CONCURRENTLY 建立，只建立父索引（ON ONLY），再逐一建立各分區的索引後掛上
+    create = f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table}" if only else \
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}"
+    if index_type == 'hnsw':
+        return f"""
+            {create} USING hnsw (embedding vector_cosine_ops)
+            WITH (m = 16, ef_construction = 64);
+        """
+    # IVFFlat 的 lists 依資料量決定（約 rows / 1000，至少 10）
+    cur.execute(f"SELECT COUNT(*) FROM {table};")
+    lists = max(10, cur.fetchone()[0] // 1000)
+    return f"""
+        {create} USING ivfflat (embedding vector_cosine_ops)
+        WITH (lists = {lists});
+    """
+
+
+def _is_partitioned(cur, table='lumi_memories'):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass;", (table,))
+    return cur.fetchone()[0]
+
+
+def _create_partitioned_vector_index(cur, index_type):
+    """分區表：父索引 + 每個分區各自 CONCURRENTLY 建立再 ATTACH，全部掛上後父索引才會生效"""
+    name = VECTOR_INDEX_PREFIX + index_type
+    cur.execute(_vector_index_ddl(cur, index_type, only=True))
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'lumi_memories'::regclass
+          AND NOT EXISTS (
+              SELECT 1 FROM pg_inherits pi
+              JOIN pg_index x ON x.indexrelid = pi.inhrelid
+              WHERE pi.inhparent = %s::regclass AND x.indrelid = c.oid)
+        ORDER BY c.relname;
+    """, (name,))
+    for (partition,) in cur.fetchall():
+        child = f"{partition}_embedding_{index_type}"
+        cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (child,))
+        row = cur.fetchone()
+        if row and not row[0]:
+            cur.execute(f"DROP INDEX CONCURRENTLY {child};")
+        cur.execute(_vector_index_ddl(cur, index_type, table=partition, name=child))
+        cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {child};")
+
+
+def ensure_vector_index(conn, index_type='hnsw'):
+    """確保 lumi_memories.embedding 上只有指定類型的向量索引，回傳是否有變更
+
+    已存在且有效時只花一次系統目錄查詢；CONCURRENTLY 建立不會鎖住寫入。
+    分區表上逐一分區建立，之後新建的分區會自動帶有同樣的索引。
+    """
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(f"不支援的向量索引類型: {index_type}")
+    wanted = VECTOR_INDEX_PREFIX + index_type
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname, i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = 'lumi_memories'::regclass AND c.relname LIKE %s;
+        """, (VECTOR_INDEX_PREFIX + '%',))
+        existing = dict(cur.fetchall())
+        if existing == {wanted: True} or (index_type == 'none' and not existing):
+            return False
+
+        partitioned = _is_partitioned(cur)
+        # 建立中斷留下的無效索引、或其他類型的索引都要移除（分區表的無效父索引留著繼續補建分區）
+        for name, valid in existing.items():
+            if name == wanted and (valid or partitioned):
+                continue
+            cur.execute(f"DROP INDEX {'' if partitioned else 'CONCURRENTLY '}IF EXISTS {name};")
+        if index_type == 'none':
+            pass
+        elif partitioned:
+            _create_partitioned_vector_index(cur, index_type)
+        else:
+            cur.execute(_vector_index_ddl(cur, index_type))
+    return True
+
+
+# 有 VECTOR 欄位的資料表；換維度時全部一起改
+EMBEDDING_TABLES = ('lumi_memories', 'lumi_memory_summaries', 'lumi_embedding_cache')
+
+
+def get_embedding_config(conn):
+    """資料庫中嵌入的 (model, dim)"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT model, dim FROM lumi_embedding_config;")
+        return cur.fetchone()
+
+
+def has_stored_embeddings(conn):
+    """是否已經有對話或摘要帶著嵌入"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT EXISTS (SELECT 1 FROM lumi_memories
+                           WHERE embedding IS NOT NULL OR embedding_i8 IS NOT NULL)
+                OR EXISTS (SELECT 1 FROM lumi_memory_summaries);
+        """)
+        return cur.fetchone()[0]
+
+
+def change_embedding_dimension(conn, model, dim):
+    """把所有嵌入欄位改成 VECTOR(dim) 並清空舊嵌入，回傳是否有變更
+
+    在一個交易中完成：移除向量索引（之後由 ensure_vector_index 在空欄位上重建）、
+    清空對話的嵌入與整併結果、清空摘要 / 整併進度 / 嵌入快取，最後更新 lumi_embedding_config。
+    對話文字都保留，需由 reembed_memories.py 重新產生嵌入。
+    """
+    with conn.cursor() as cur:
+        cur.execute("BEGIN;")
+        try:
+            # 與 migration 共用鎖，多個 process 同時啟動時只有一個會改
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_KEY,))
+            cur.execute("SELECT model, dim FROM lumi_embedding_config;")
+            if cur.fetchone() == (model, dim):
+                cur.execute("ROLLBACK;")
+                return False
+            cur.execute("""
+                SELECT c.relname
+                FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indrelid = 'lumi_memories'::regclass AND c.relname LIKE %s;
+            """, (VECTOR_INDEX_PREFIX + '%',))
+            for (name,) in cur.fetchall():
+                cur.execute(f"DROP INDEX {name};")
+            cur.execute("TRUNCATE lumi_memory_summaries, lumi_consolidation_state, lumi_embedding_cache;")
+            for table in EMBEDDING_TABLES:
+                cur.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE VECTOR({int(dim)}) USING NULL;")
+            cur.execute("""
+                UPDATE lumi_memories
+                SET embedding_i8 = NULL, embedding_scale = NULL, embedding_bits = NULL, summary_id = NULL
+                WHERE embedding_i8 IS NOT NULL OR summary_id IS NOT NULL;
+            """)
+            cur.execute("""
+                UPDATE lumi_embedding_config SET model = %s, dim = %s, updated_at = CURRENT_TIMESTAMP;
+            """, (model, dim))
+            cur.execute("COMMIT;")
+        except psycopg2.Error:
+            cur.execute("ROLLBACK;")
+            raise
+    return True
+
+
+def ensure_embedding_config(conn, model, dim):
+    """確保資料庫的嵌入欄位與目前的嵌入後端一致，回傳是否有變更
+
+    設定相同時只花一次查詢。還沒有任何嵌入（新資料庫）時自動切換；
+    已有嵌入時拋出 RuntimeError，不同模型 / 維度的向量不能混在一起搜尋，
+    需先執行 reembed_memories.py。
+    """
+    current = get_embedding_config(conn)
+    if current == (model, dim):
+        return False
+    if has_stored_embeddings(conn):
+        raise RuntimeError(
+            f"資料庫中的嵌入是 {current[0]}（{current[1]} 維），與目前的設定 {model}（{dim} 維）不同；"
+            f"請先執行 reembed_memories.py 重新產生嵌入")
+    return change_embedding_dimension(conn, model, dim)
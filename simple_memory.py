@@ -1,267 +1,607 @@
 import os
 import json
-from datetime import datetime
+import logging
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
 from pgvector.psycopg2 import register_vector
 import numpy as np
-import openai
+from db_pool import PgConnectionPool
+from embedding_cache import EmbeddingCache
+from embedding_batcher import EmbeddingBatcher
+from embedding_backends import get_backend
+from write_behind import WriteBehindBuffer
+from profile_tags import load_profile_keywords, extract_profile_tags
+from user_profiles import UserProfileStore
+from diary_store import DiaryStore
+from hot_vector_index import HotVectorIndex
+from vector_utils import dequantize_int8, binary_signature, cosine_distances, stored_embedding
+import user_time
+import memory_partitions
+import schema
+import metrics
+from lumi_logging import log_user
+
+logger = logging.getLogger(__name__)
+
+# 自我介紹的前綴（「我是XXX」「我叫XXX」）
+NAME_PREFIXES = ["我是", "我叫", "我的名字是"]
+
+# 多個 process 都開啟日記預先產生時，同一時間只讓一個執行
+DIARY_PRECOMPUTE_LOCK_KEY = 7315002
+
+# 相似度搜尋：整併後的摘要與尚未整併的對話各取 limit 筆近鄰，摘要排在前面（各自依距離排序）；
+# 相似度門檻與 limit 由 _similar_rows 在判斷是否需要精確搜尋之後才套用。回傳 (id, user_message, lumi_response, emotion_tag, timestamp, distance, source_count)，
+# source_count 只有摘要才有值（摘要的 id 與對話的 id 是不同的序號）
+SIMILAR_SEARCH_SQL = """
+    SELECT * FROM (
+        (SELECT id, user_message, lumi_response, emotion_tag, last_at AS timestamp,
+                embedding <=> %(embedding)s::vector AS distance, source_count
+         FROM lumi_memory_summaries
+         WHERE user_id = %(user_id)s
+         ORDER BY distance
+         LIMIT %(limit)s)
+        UNION ALL
+        (SELECT id, user_message, lumi_response, emotion_tag, timestamp,
+                embedding <=> %(embedding)s::vector AS distance, NULL::integer
+         FROM lumi_memories
+         WHERE user_id = %(user_id)s AND summary_id IS NULL
+         ORDER BY distance
+         LIMIT %(limit)s)
+    ) nearest
+    ORDER BY source_count IS NULL, distance;
+"""
+
+# 向量索引回傳的候選不足 limit 筆時，確認用戶實際有幾筆（最多數到 limit，只用 user_id 索引）
+SIMILAR_CANDIDATE_COUNT_SQL = """
+    SELECT (SELECT count(*) FROM (SELECT 1 FROM lumi_memory_summaries
+                                  WHERE user_id = %(user_id)s LIMIT %(limit)s) s),
+           (SELECT count(*) FROM (SELECT 1 FROM lumi_memories
+                                  WHERE user_id = %(user_id)s AND summary_id IS NULL LIMIT %(limit)s) t);
+"""
+
+# EMBEDDING_STORAGE=int8：對話只存量化後的嵌入，先在資料庫以正負號位元的 hamming 距離挑出 candidates 筆，
+# 回傳 int8 與 scale 由應用程式精確計算 cosine 距離後重新排序（摘要仍存 float，距離在資料庫計算）
+QUANTIZED_SEARCH_SQL = """
+    (SELECT id, user_message, lumi_response, emotion_tag, last_at AS timestamp,
+            embedding <=> %(embedding)s::vector AS distance, source_count, NULL::bytea, NULL::real
+     FROM lumi_memory_summaries
+     WHERE user_id = %(user_id)s
+     ORDER BY distance
+     LIMIT %(limit)s)
+    UNION ALL
+    (SELECT id, user_message, lumi_response, emotion_tag, timestamp,
+            NULL::float8, NULL::integer, embedding_i8, embedding_scale
+     FROM lumi_memories
+     WHERE user_id = %(user_id)s AND summary_id IS NULL AND embedding_bits IS NOT NULL
+     ORDER BY bit_count(embedding_bits # %(bits)s::varbit)
+     LIMIT %(candidates)s);
+"""
+
+EMBEDDING_STORAGE_TYPES = ('vector', 'int8')
+MEMORY_ENGINES = ('auto', 'postgres', 'sqlite')
+
+_shared_memory = None
+_shared_memory_lock = threading.Lock()
+
+
+def create_memory():
+    """依 MEMORY_ENGINE 建立記憶系統：postgres / sqlite / auto（預設，有 DATABASE_URL 用 Postgres，否則用本地 SQLite）"""
+    engine = os.getenv('MEMORY_ENGINE', 'auto').lower()
+    if engine not in MEMORY_ENGINES:
+        raise ValueError(f"不支援的記憶儲存引擎: {engine}")
+    if engine == 'sqlite' or (engine == 'auto' and not os.getenv('DATABASE_URL')):
+        from local_memory import LocalLumiMemory
+        return LocalLumiMemory()
+    return SimpleLumiMemory()
+
+
+def get_shared_memory():
+    """整個 process 共用同一個記憶系統（第一次呼叫時才建立）"""
+    global _shared_memory
+    if _shared_memory is None:
+        with _shared_memory_lock:
+            if _shared_memory is None:
+                _shared_memory = create_memory()
+    return _shared_memory
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
 class SimpleLumiMemory:
     def __init__(self):
-        self.conn = None
+        self.pool = None
+        # 個人資料關鍵詞（寫入時標記 profile_tags）
+        self.profile_keywords = load_profile_keywords()
+        # 嵌入後端：openai（預設）/ hashing（本地，不需網路），維度必須與資料庫欄位一致
+        self.embedding_backend = get_backend()
+        self.embedding_cache = EmbeddingCache(
+            max_size=int(os.getenv('EMBEDDING_CACHE_SIZE', '2048')),
+            ttl_seconds=float(os.getenv('EMBEDDING_CACHE_TTL', '86400')),
+            persist=os.getenv('EMBEDDING_CACHE_PERSIST', 'true').lower() in ('1', 'true', 'yes')
+        )
+        # 嵌入微批次：同時進來的請求在幾毫秒內合併成一次 API 呼叫
+        # 本地後端每筆只要幾十微秒，直接計算比排隊合併還快
+        self.embedding_batcher = None
+        if not self.embedding_backend.local and \
+                os.getenv('EMBEDDING_BATCH_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+            self.embedding_batcher = EmbeddingBatcher(
+                self._call_embedding_api,
+                max_batch_size=int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', '64')),
+                max_wait_ms=float(os.getenv('EMBEDDING_BATCH_WAIT_MS', '5')),
+                max_concurrent_batches=int(os.getenv('EMBEDDING_BATCH_CONCURRENCY', '4'))
+            )
+        # 向量索引設定：hnsw（預設）/ ivfflat / none，以及每次查詢的搜尋寬度
+        self.vector_index_type = os.getenv('VECTOR_INDEX_TYPE', 'hnsw').lower()
+        self.hnsw_ef_search = int(os.getenv('VECTOR_HNSW_EF_SEARCH', '100'))
+        self.ivfflat_probes = int(os.getenv('VECTOR_IVFFLAT_PROBES', '10'))
+        # 嵌入儲存方式：vector（float32，預設）/ int8（量化，搜尋時取 limit * RERANK_FACTOR 筆候選重新排序）
+        self.embedding_storage = os.getenv('EMBEDDING_STORAGE', 'vector').lower()
+        if self.embedding_storage not in EMBEDDING_STORAGE_TYPES:
+            raise ValueError(f"不支援的嵌入儲存方式: {self.embedding_storage}")
+        self.rerank_factor = max(1, int(os.getenv('EMBEDDING_RERANK_FACTOR', '20')))
+        # 每月分區：提前建立幾個月份的分區
+        self.partition_months_ahead = int(os.getenv('MEMORY_PARTITION_MONTHS_AHEAD', '3'))
+        # 非同步寫入：對話先進緩衝區，依筆數或時間批次寫入，程式結束前會寫完
+        self.write_buffer = None
+        if os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+            self.write_buffer = WriteBehindBuffer(
+                self._insert_memories,
+                batch_size=int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '50')),
+                flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '1.0')),
+                max_attempts=int(os.getenv('WRITE_BEHIND_MAX_ATTEMPTS', '10'))
+            )
+            self.write_buffer.start()
+            atexit.register(self.write_buffer.stop)
+        # 用戶名稱與結構化屬性（user_profiles），讀取經過 TTL 快取，寫入時更新
+        self.profiles = UserProfileStore(
+            ttl_seconds=float(os.getenv('PROFILE_CACHE_TTL', '300')),
+            max_size=int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+        )
+        # 每日日記與已整理到的最後一筆對話（日記只需要補上之後的對話）
+        self.diaries = DiaryStore()
+        # 活躍用戶的嵌入放在記憶體中，相似度搜尋不必查資料庫（HOT_INDEX_MAX_MB=0 關閉）
+        self.hot_index = None
+        hot_index_mb = float(os.getenv('HOT_INDEX_MAX_MB', '128'))
+        if hot_index_mb > 0:
+            self.hot_index = HotVectorIndex(
+                max_bytes=hot_index_mb * 1024 * 1024,
+                ttl_seconds=float(os.getenv('HOT_INDEX_TTL', '600'))
+            )
+            atexit.register(self.hot_index.stop)
+        # 記憶檢索並行：各分支的期限（秒），超時的分支以空結果回傳
+        self.retrieval_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('RETRIEVAL_WORKERS', '8')),
+            thread_name_prefix="memory-retrieval"
+        )
+        self.retrieval_timeouts = {
+            'profile_name': float(os.getenv('RETRIEVAL_PROFILE_TIMEOUT', '0.5')),
+            'recent': float(os.getenv('RETRIEVAL_RECENT_TIMEOUT', '1.0')),
+            'similar': float(os.getenv('RETRIEVAL_SIMILAR_TIMEOUT', '2.0')),
+        }
+        # 資料庫斷線時同一時間只讓一個執行緒重建連線池，失敗後至少隔 DB_RECONNECT_INTERVAL 秒才再試
+        self.reconnect_interval = float(os.getenv('DB_RECONNECT_INTERVAL', '5'))
+        self._reconnect_lock = threading.Lock()
+        self._next_reconnect_at = 0.0
         self._initialize_railway_pgvector()
         # 移除 self.embedding_model 相關程式碼
-        print("SimpleLumiMemory: 初始化完成")
+        logger.info("SimpleLumiMemory: 初始化完成")
 
     def _initialize_railway_pgvector(self):
-        """初始化 Railway pgvector 服務連接"""
+        """初始化 Railway pgvector 服務連接（資料庫結構就緒後才設定 self.pool，其他執行緒不會拿到半初始化的連線池）"""
+        pool = None
         try:
             # 從 Railway 環境變數獲取連接字串
             database_url = os.getenv('DATABASE_URL')
-            print(f"[LOG] DATABASE_URL: {database_url}")
-            
             if not database_url:
-                print("❌ [LOG] 未找到 DATABASE_URL 環境變數")
-                print("請確保在 Railway 中正確配置了 pgvector 服務")
+                logger.error("❌ 未找到 DATABASE_URL 環境變數，請確保在 Railway 中正確配置了 pgvector 服務")
                 return
             
-            print(f"[LOG] 正在連接 Railway pgvector 服務... {database_url[:50]}...")
+            logger.info("正在連接 Railway pgvector 服務...")
             
-            # 建立連接
-            self.conn = psycopg2.connect(database_url)
-            
-            # 註冊 pgvector 擴展
-            register_vector(self.conn)
+            # 建立連線池（每條連線建立時註冊 pgvector 型別）
+            pool = PgConnectionPool(
+                database_url,
+                min_size=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+                max_size=int(os.getenv('DB_POOL_MAX_SIZE', '5')),
+                checkout_timeout=float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT', '5')),
+                health_check_idle=float(os.getenv('DB_POOL_HEALTH_CHECK_IDLE', '30')),
+                on_connect=self._configure_connection
+            )
             
-            # 初始化資料庫結構
-            self._initialize_db()
+            # 初始化資料庫結構（失敗時連線池已關閉）
+            if not self._initialize_db(pool):
+                return
+            self.pool = pool
+            self.embedding_cache.pool = pool
+            self.profiles.pool = pool
+            self.diaries.pool = pool
+            if self.hot_index:
+                self.hot_index.pool = pool
             
-            print("✅ [LOG] Railway pgvector 服務連接成功！")
+            logger.info("✅ Railway pgvector 服務連接成功")
             
         except Exception as e:
-            print(f"❌ [LOG] Railway pgvector 服務連接失敗: {e}")
-            print("請檢查：")
-            print("1. Railway 專案中是否已添加 pgvector 服務")
-            print("2. DATABASE_URL 環境變數是否正確設定")
-            print("3. 網路連接是否正常")
-            self.conn = None
-
-    def _initialize_db(self):
-        """初始化 Railway pgvector 資料庫結構"""
-        if not self.conn:
-            print("❌ [LOG] 無法初始化資料庫結構，未連接資料庫")
-            return
-            
+            logger.error("❌ Railway pgvector 服務連接失敗: %s（請檢查 pgvector 服務、DATABASE_URL 與網路連接）", e)
+            if pool:
+                pool.close()
+            self.pool = None
+            self.embedding_cache.pool = None
+            self.profiles.pool = None
+            self.diaries.pool = None
+            if self.hot_index:
+                self.hot_index.pool = None
+
+    @staticmethod
+    def _configure_connection(conn):
+        """新連線建立時註冊 pgvector 型別（全新資料庫先建立 vector 擴展）"""
         try:
-            with self.conn.cursor() as cur:
-                # Railway pgvector 服務已經預裝了 vector 擴展，但我們還是確保它存在
+            register_vector(conn)
+        except psycopg2.ProgrammingError:
+            with conn.cursor() as cur:
                 cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-                self.conn.commit()
-                
-                # 先刪除舊的資料表（如果存在）
-                cur.execute("DROP TABLE IF EXISTS lumi_memories;")
-                self.conn.commit()
-                print("🔄 [LOG] 已刪除舊的 lumi_memories 資料表")
-                
-                # 創建新的記憶資料表（Railway pgvector 優化版本）
-                cur.execute("""
-                    CREATE TABLE lumi_memories (
-                        id SERIAL PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        user_message TEXT NOT NULL,
-                        lumi_response TEXT NOT NULL,
-                        emotion_tag TEXT,
-                        timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                        embedding VECTOR(1536),
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-                
-                # 創建索引以優化查詢效能
-                cur.execute("""
-                    CREATE INDEX idx_lumi_memories_user_id 
-                    ON lumi_memories(user_id);
-                """)
-                
-                cur.execute("""
-                    CREATE INDEX idx_lumi_memories_timestamp 
-                    ON lumi_memories(timestamp DESC);
-                """)
-                
-                cur.execute("""
-                    CREATE INDEX idx_lumi_memories_emotion_tag 
-                    ON lumi_memories(emotion_tag) WHERE emotion_tag IS NOT NULL;
-                """)
-                
-                self.conn.commit()
-                print("✅ [LOG] Railway pgvector 資料庫結構初始化完成（1536維）")
+            register_vector(conn)
+
+    def _initialize_db(self, pool=None):
+        """套用尚未執行的資料庫 migration（版本已是最新時不跑任何 DDL），回傳是否成功；失敗時關閉連線池"""
+        pool = pool or self.pool
+        if not pool:
+            logger.error("❌ 無法初始化資料庫結構，未連接資料庫")
+            return False
+            
+        try:
+            with pool.connection() as conn:
+                before, after = schema.apply_migrations(conn)
+                memory_partitions.ensure_partitions(conn, self.partition_months_ahead)
+                if schema.ensure_embedding_config(conn, self.embedding_backend.model, self.embedding_backend.dim):
+                    logger.info("✅ 嵌入設定已切換為 %s（%d 維）",
+                                self.embedding_backend.model, self.embedding_backend.dim)
+                index_changed = schema.ensure_vector_index(conn, self.vector_index_type)
+            if before == after:
+                logger.info("✅ 資料庫結構已是最新版本 v%s，略過 DDL", after)
+            else:
+                logger.info("✅ 資料庫結構已從 v%s 升級到 v%s", before, after)
+            if index_changed:
+                logger.info("✅ 向量索引已切換為 %s", self.vector_index_type)
+            return True
                 
         except Exception as e:
-            print(f"❌ [LOG] Railway pgvector 資料庫初始化失敗: {e}")
-            self.conn = None
+            logger.error("❌ Railway pgvector 資料庫初始化失敗: %s", e)
+            pool.close()
+            if pool is self.pool:
+                self.pool = None
+            return False
 
+    @metrics.timed('embedding')
     def _get_embedding(self, text):
-        """使用 OpenAI 生成文本嵌入"""
-        print(f"[LOG] 生成嵌入 for text: {text}")
+        """取得文本嵌入（先查嵌入快取，未命中才呼叫嵌入後端；本地後端直接計算）"""
+        if not isinstance(text, str):
+            text = str(text)
+        if not text.strip():
+            return np.zeros(self.embedding_backend.dim).tolist()
+        if self.embedding_backend.local:
+            return self._request_embedding(text)
+        return self.embedding_cache.get_or_compute(self.embedding_backend.model, text, self._request_embedding)
+
+    @metrics.timed('embedding.bulk')
+    def _get_embeddings(self, texts):
+        """批次取得多段文本的嵌入（未命中快取的文字合併成一次 API 呼叫）"""
+        texts = [t if isinstance(t, str) else str(t) for t in texts]
+        results = [np.zeros(self.embedding_backend.dim).tolist() if not t.strip() else None for t in texts]
+        todo = [i for i, t in enumerate(texts) if t.strip()]
+        if todo and self.embedding_backend.local:
+            embeddings = self._request_embeddings([texts[i] for i in todo])
+            for i, embedding in zip(todo, embeddings):
+                results[i] = embedding
+        elif todo:
+            embeddings = self.embedding_cache.get_or_compute_many(
+                self.embedding_backend.model, [texts[i] for i in todo], self._request_embeddings)
+            for i, embedding in zip(todo, embeddings):
+                results[i] = embedding
+        return results
+
+    @metrics.timed('embedding.api')
+    def _call_embedding_api(self, texts):
+        """呼叫嵌入後端（input 可以是多段文字），失敗時拋出例外"""
+        return self.embedding_backend.embed(texts)
+
+    def _request_embeddings(self, texts):
+        """一次 API 呼叫產生多段文本的嵌入，失敗時整批回傳 None"""
+        logger.debug("批次生成嵌入: %d 筆", len(texts))
         try:
-            if not isinstance(text, str):
-                text = str(text)
-            if not text.strip():
-                return np.zeros(1536).tolist()  # OpenAI ada-002 是 1536 維
-            result = openai.Embedding.create(
-                input=text,
-                model="text-embedding-ada-002"
-            )
-            print(f"[LOG] 嵌入生成成功，長度: {len(result['data'][0]['embedding'])}")
-            return result['data'][0]['embedding']
+            return self._call_embedding_api(texts)
         except Exception as e:
-            print(f"❌ [LOG] 生成嵌入失敗: {e}")
+            logger.error("❌ 批次生成嵌入失敗: %s", e)
+            return [None] * len(texts)
+
+    def _request_embedding(self, text):
+        """使用嵌入後端生成文本嵌入（開啟微批次時會和其他執行緒的請求合併送出）"""
+        try:
+            if self.embedding_batcher:
+                embedding = self.embedding_batcher.embed(text)
+            else:
+                embedding = self._call_embedding_api([text])[0]
+            return embedding
+        except Exception as e:
+            logger.error("❌ 生成嵌入失敗: %s", e)
             return None
 
+    def get_embedding_batcher_stats(self):
+        """嵌入微批次的批次大小、等待時間與每批延遲"""
+        if not self.embedding_batcher:
+            return {}
+        return self.embedding_batcher.get_stats()
+
     def _ensure_connection(self):
-        """確保資料庫連接正常"""
-        if not self.conn:
-            print("❌ [LOG] 資料庫連接未建立")
-            return False
-        
-        try:
-            # 測試連接
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT 1")
-            print("[LOG] 資料庫連接測試成功")
+        """確保連線池可用（健康檢查由連線池在 checkout 時處理）"""
+        if self.pool:
             return True
-        except Exception as e:
-            print(f"❌ [LOG] 資料庫連接測試失敗: {e}")
-            # 嘗試重新連接
+        if not os.getenv('DATABASE_URL'):
+            logger.error("❌ 資料庫連接未建立")
+            return False
+        # 啟動時連線失敗，嘗試重新建立連線池：同一時間只有一個執行緒重試，失敗後等 reconnect_interval 秒
+        if time.monotonic() < self._next_reconnect_at:
+            return False
+        with self._reconnect_lock:
+            if self.pool:
+                return True
+            if time.monotonic() < self._next_reconnect_at:
+                return False
             try:
                 self._initialize_railway_pgvector()
-                return self.conn is not None
-            except:
+            except Exception as e:
+                logger.error("❌ 重新建立連線池失敗: %s", e)
+            if self.pool is None:
+                self._next_reconnect_at = time.monotonic() + self.reconnect_interval
+                metrics.inc('db_reconnect', result='failed')
                 return False
+            metrics.inc('db_reconnect', result='ok')
+            return True
 
-    def store_user_profile_name(self, user_id, name):
-        """將 user_id 與 name 存成 profile 記憶"""
-        print(f"[LOG] 儲存 profile: user_id={user_id}, name={name}")
+    def get_pool_stats(self):
+        """連線池等待時間與 checkout 次數"""
+        if not self.pool:
+            return {}
+        return self.pool.get_stats()
+
+    def get_embedding_cache_stats(self):
+        """嵌入快取命中率與省下的 API 延遲"""
+        return self.embedding_cache.get_stats()
+
+    def _make_record(self, user_id, user_message, lumi_response, emotion_tag=None, embedding_text=None):
+        """一筆待寫入 lumi_memories 的記錄（時間戳在收到時就決定，批次寫入也不會亂序）"""
+        return {
+            'user_id': user_id,
+            'user_message': user_message,
+            'lumi_response': lumi_response,
+            'emotion_tag': emotion_tag,
+            'timestamp': datetime.now(timezone.utc),
+            'embedding_text': embedding_text if embedding_text is not None else user_message,
+            'profile_tags': extract_profile_tags(user_message, self.profile_keywords),
+        }
+
+    @metrics.timed('db.insert_memories')
+    def _insert_memories(self, records):
+        """批次產生嵌入後，以一個多列 INSERT 寫入（write-behind 的 flush 也用這個）
+
+        回傳無法生成嵌入、沒有寫入的記錄，其餘照常寫入；資料庫寫入失敗時拋出例外（整批都沒寫入）
+        """
+        if not records:
+            return []
         if not self._ensure_connection():
-            print("❌ [LOG] 無法儲存 profile：Railway pgvector 服務連接失敗")
+            raise RuntimeError("Railway pgvector 服務連接失敗")
+        records, embeddings, failed = self._embed_records(records)
+        if not records:
+            return failed
+        rows = [
+            (r['user_id'], r['user_message'], r['lumi_response'], r['emotion_tag'], r['timestamp'],
+             r['profile_tags']) + self._stored_embedding(embedding)
+            for r, embedding in zip(records, embeddings)
+        ]
+        with self.pool.connection() as conn:
+            try:
+                ids = self._execute_insert(conn, rows)
+            except psycopg2.errors.CheckViolation:
+                # 時間落在還沒建立的月份（例如時鐘偏差）：補建分區後重試一次
+                memory_partitions.ensure_partitions(
+                    conn, months=[memory_partitions.month_start(r['timestamp']) for r in records])
+                ids = self._execute_insert(conn, rows)
+        logger.info("已批次寫入 %d 筆記憶", len(rows))
+        self._after_insert(records, ids, embeddings)
+        return failed
+
+    def _embed_records(self, records):
+        """產生嵌入，回傳 (有嵌入的記錄, 對應的嵌入, 無法生成嵌入的記錄)"""
+        embeddings = self._get_embeddings([r['embedding_text'] for r in records])
+        embedded = [(r, embedding) for r, embedding in zip(records, embeddings) if embedding is not None]
+        failed = [r for r, embedding in zip(records, embeddings) if embedding is None]
+        if failed:
+            logger.warning("⚠️ %d 筆記憶無法生成嵌入，稍後重試", len(failed))
+        return [r for r, _ in embedded], [embedding for _, embedding in embedded], failed
+
+    def _after_insert(self, records, ids, embeddings):
+        """寫入已 commit 後的更新；失敗只記錄，不能讓記錄被重試（會重複寫入）"""
+        if not self.hot_index:
             return
-        embedding = self._get_embedding(name)
-        if embedding is None:
-            print("❌ [LOG] 無法生成嵌入，profile 未儲存")
+        try:
+            self._append_hot_index(records, ids, embeddings)
+        except Exception as e:
+            logger.error("❌ 更新記憶體向量索引失敗: %s", e)
+            # 索引內容可能不完整，讓這些用戶下次搜尋時重新載入
+            for user_id in {r['user_id'] for r in records}:
+                self.hot_index.invalidate(user_id)
+
+    def _append_hot_index(self, records, ids, embeddings):
+        """剛寫入的對話加進記憶體中的向量索引（只有已載入的用戶會更新）"""
+        by_user = {}
+        for r, memory_id, embedding in zip(records, ids, embeddings):
+            rows, vectors = by_user.setdefault(r['user_id'], ([], []))
+            rows.append((memory_id, r['user_message'], r['lumi_response'], r['emotion_tag'], r['timestamp'], None))
+            vectors.append(embedding)
+        for user_id, (rows, vectors) in by_user.items():
+            self.hot_index.append(user_id, rows, vectors)
+
+    def _stored_embedding(self, embedding):
+        """依 EMBEDDING_STORAGE 回傳 (embedding, embedding_i8, embedding_scale, embedding_bits)"""
+        return stored_embedding(embedding, self.embedding_storage)
+
+    @staticmethod
+    def _execute_insert(conn, rows):
+        """寫入多列，回傳依序對應的 id"""
+        with conn.cursor() as cur:
+            inserted = execute_values(cur, """
+                INSERT INTO lumi_memories (user_id, user_message, lumi_response, emotion_tag, timestamp, profile_tags,
+                                           embedding, embedding_i8, embedding_scale, embedding_bits)
+                VALUES %s
+                RETURNING id;
+            """, rows, template="(%s, %s, %s, %s, %s, %s::text[], %s, %s, %s, %s::varbit)", fetch=True)
+        return [row[0] for row in inserted]
+
+    def _save_records(self, records):
+        """有 write-behind 時放入緩衝區，否則同步寫入"""
+        if self.write_buffer:
+            for record in records:
+                self.write_buffer.add(record)
             return
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO lumi_memories (user_id, user_message, lumi_response, emotion_tag, embedding)
-                    VALUES (%s, %s, %s, %s, %s);
-                """, (user_id, f"我是{name}", f"記住用戶名稱：{name}", 'profile', embedding))
-                self.conn.commit()
-            print(f"✅ [LOG] 已儲存 user_id={user_id} 的 profile name={name}")
+            failed = self._insert_memories(records)
         except Exception as e:
-            print(f"❌ [LOG] 儲存 profile 失敗: {e}")
-            self._ensure_connection()
+            logger.error("❌ 儲存記憶到 Railway pgvector 失敗: %s", e)
+            return
+        if failed:
+            logger.error("❌ %d 筆記憶無法生成嵌入，未儲存", len(failed))
 
-    def get_user_profile_name(self, user_id):
-        """查詢 user_id 最新的 profile name"""
-        print(f"\n=== 用戶名稱查詢開始 ===")
-        print(f"[用戶名稱] 查詢用戶: {user_id}")
-        
+    def store_user_profile_name(self, user_id, name):
+        """將 user_id 與 name 寫入 user_profiles（UPSERT，不需要嵌入）"""
+        logger.debug("儲存用戶名稱", extra=log_user(user_id))
+        if not self._ensure_connection():
+            logger.error("❌ 無法儲存 profile：Railway pgvector 服務連接失敗")
+            return
+        try:
+            self.profiles.upsert(user_id, name=name)
+        except Exception as e:
+            logger.error("❌ 儲存 profile 失敗: %s", e, extra=log_user(user_id))
+
+    def update_user_profile(self, user_id, **attributes):
+        """更新用戶的結構化屬性（與既有屬性合併），回傳最新的 profile"""
         if not self._ensure_connection():
-            print("❌ [用戶名稱] 資料庫連接未建立")
+            logger.error("❌ 無法更新 profile：Railway pgvector 服務連接失敗")
             return None
-        
         try:
-            with self.conn.cursor() as cur:
-                print(f"[用戶名稱] 執行 SQL SELECT...")
-                cur.execute("""
-                    SELECT user_message FROM lumi_memories
-                    WHERE user_id = %s AND emotion_tag = 'profile'
-                    ORDER BY timestamp DESC LIMIT 1;
-                """, (user_id,))
-                row = cur.fetchone()
-                print(f"[用戶名稱] SQL 查詢完成，結果: {row}")
-                
-                if row:
-                    # user_message 可能是「我是XXX」或「我叫XXX」
-                    msg = row[0]
-                    print(f"[用戶名稱] 原始訊息: {msg}")
-                    
-                    for prefix in ["我是", "我叫", "我的名字是"]:
-                        if msg.startswith(prefix):
-                            name = msg[len(prefix):].strip()
-                            print(f"[用戶名稱] 找到名稱: {name}")
-                            print(f"=== 用戶名稱查詢結束 ===\n")
-                            return name
-                    
-                    print(f"[用戶名稱] 未找到標準前綴，直接返回: {msg}")
-                    print(f"=== 用戶名稱查詢結束 ===\n")
-                    return msg
-                else:
-                    print(f"[用戶名稱] 未找到用戶名稱記錄")
-                    print(f"=== 用戶名稱查詢結束 ===\n")
-                    return None
+            return self.profiles.upsert(user_id, attributes=attributes)
+        except Exception as e:
+            logger.error("❌ 更新 profile 失敗: %s", e, extra=log_user(user_id))
+            return None
+
+    def get_user_profile(self, user_id):
+        """回傳 {'name': ..., 'attributes': {...}}，沒有資料時回傳 None（經過 TTL 快取）"""
+        if not self._ensure_connection():
+            return None
+        try:
+            return self.profiles.get_profile(user_id)
         except Exception as e:
-            print(f"❌ [用戶名稱] 查詢 profile name 失敗: {e}")
-            print(f"=== 用戶名稱查詢結束 ===\n")
+            logger.error("❌ 查詢 profile 失敗: %s", e, extra=log_user(user_id))
             return None
 
+    def get_user_profile_name(self, user_id):
+        """查詢 user_id 的名稱（大多數情況直接命中快取，不用查資料庫）"""
+        profile = self.get_user_profile(user_id)
+        return profile['name'] if profile else None
+
+    def get_user_timezone(self, user_id):
+        """用戶的時區（user_profiles.attributes 的 timezone，沒有時用 USER_TIMEZONE）"""
+        profile = self.get_user_profile(user_id) if user_id else None
+        return user_time.get_zone((profile or {}).get('attributes', {}).get('timezone'))
+
+    def get_user_today(self, user_id):
+        """用戶時區的今天（YYYY-MM-DD）"""
+        return user_time.local_today(self.get_user_timezone(user_id))
+
+    def get_profile_cache_stats(self):
+        """用戶資料快取的命中率"""
+        return self.profiles.get_stats()
+
+    @staticmethod
+    def _detect_profile_name(user_message):
+        """訊息以「我是」「我叫」等自我介紹開頭時回傳名稱"""
+        if not isinstance(user_message, str):
+            return None
+        text = user_message.strip()
+        for prefix in NAME_PREFIXES:
+            if text.startswith(prefix):
+                return text[len(prefix):].strip() or None
+        return None
+
     def store_conversation_memory(self, user_id, user_message, lumi_response, emotion_tag=None):
-        print(f"\n=== 記憶儲存開始 ===")
-        print(f"[記憶儲存] user_id: {user_id}")
-        print(f"[記憶儲存] user_message: {user_message}")
-        print(f"[記憶儲存] lumi_response: {lumi_response}")
-        print(f"[記憶儲存] emotion_tag: {emotion_tag}")
-        
-        # 自動偵測 profile 記憶
-        for prefix in ["我是", "我叫", "我的名字是"]:
-            if isinstance(user_message, str) and user_message.strip().startswith(prefix):
-                name = user_message.strip()[len(prefix):].strip()
-                if name:
-                    print(f"[記憶儲存] 偵測到 profile 記憶: {name}")
-                    self.store_user_profile_name(user_id, name)
-                    break
+        logger.debug("儲存對話記憶: user_message=%r lumi_response=%r emotion_tag=%s",
+                     user_message, lumi_response, emotion_tag, extra=log_user(user_id))
         
         if not self._ensure_connection():
-            print("❌ [記憶儲存] 無法儲存記憶：Railway pgvector 服務連接失敗")
-            return
-        
-        print(f"[記憶儲存] 開始生成嵌入...")
-        embedding = self._get_embedding(user_message)
-        if embedding is None:
-            print("❌ [記憶儲存] 無法生成嵌入，記憶未儲存")
+            logger.error("❌ 無法儲存記憶：Railway pgvector 服務連接失敗")
             return
         
-        print(f"[記憶儲存] 嵌入生成成功，長度: {len(embedding)}")
-        
-        try:
-            with self.conn.cursor() as cur:
-                print(f"[記憶儲存] 執行 SQL INSERT...")
-                cur.execute("""
-                    INSERT INTO lumi_memories (user_id, user_message, lumi_response, emotion_tag, embedding)
-                    VALUES (%s, %s, %s, %s, %s);
-                """, (user_id, user_message, lumi_response, emotion_tag, embedding))
-                self.conn.commit()
-                print(f"✅ [記憶儲存] 已成功儲存用戶 {user_id[:8]}... 的對話記憶到 Railway pgvector")
-        except Exception as e:
-            print(f"❌ [記憶儲存] 儲存記憶到 Railway pgvector 失敗: {e}")
-            self._ensure_connection()
+        # 自動偵測自我介紹，名稱寫入 user_profiles
+        name = self._detect_profile_name(user_message)
+        if name:
+            self.store_user_profile_name(user_id, name)
         
-        print(f"=== 記憶儲存結束 ===\n")
+        self._save_records([self._make_record(user_id, user_message, lumi_response, emotion_tag)])
+
+    def flush_pending_writes(self):
+        """立即寫出緩衝區中的記憶，回傳寫入筆數"""
+        if not self.write_buffer:
+            return 0
+        return self.write_buffer.flush()
+
+    def get_write_behind_stats(self):
+        """非同步寫入緩衝區的批次大小、寫入延遲與待寫筆數"""
+        if not self.write_buffer:
+            return {}
+        return self.write_buffer.get_stats()
+
+    def _pending_memories(self, user_id):
+        """尚未寫入資料庫的記憶（read-your-writes 用），格式與查詢結果相同"""
+        if not self.write_buffer:
+            return []
+        return [{
+            'user_message': r['user_message'],
+            'lumi_response': r['lumi_response'],
+            'emotion_tag': r['emotion_tag'],
+            'timestamp': r['timestamp'].isoformat()
+        } for r in self.write_buffer.pending_for(user_id)]
 
+    @staticmethod
+    def _merge_memories(memories, pending, limit=None):
+        """合併資料庫與緩衝區的記憶：去除重複、依時間正序，保留最新的 limit 筆"""
+        def parse(ts):
+            return datetime.fromisoformat(ts) if ts else datetime.min.replace(tzinfo=timezone.utc)
+
+        seen = set()
+        merged = []
+        for m in list(memories) + list(pending):
+            key = (parse(m['timestamp']), m['user_message'])
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append((key[0], m))
+        merged.sort(key=lambda item: item[0])
+        merged = [m for _, m in merged]
+        if limit is not None:
+            merged = merged[-limit:] if limit > 0 else []
+        return merged
+
+    @metrics.timed('db.recent_memories')
     def get_recent_memories(self, user_id, limit=5): # 這裡的 limit 應該是從 PGVector 檢索的數量
-        print(f"\n=== 記憶讀取開始 ===")
-        print(f"[記憶讀取] 查詢用戶: {user_id}")
-        print(f"[記憶讀取] 查詢數量: {limit}")
-        
         if not self._ensure_connection():
-            print("❌ [記憶讀取] 資料庫連接未建立，無法檢索記憶。")
+            logger.error("❌ 資料庫連接未建立，無法檢索記憶")
             return []
         
         try:
-            with self.conn.cursor() as cur:
-                print(f"[記憶讀取] 執行 SQL SELECT...")
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT user_message, lumi_response, emotion_tag, timestamp
                     FROM lumi_memories
@@ -270,10 +610,9 @@ class SimpleLumiMemory:
                     LIMIT %s;
                 """, (user_id, limit))
                 rows = cur.fetchall()
-                print(f"[記憶讀取] SQL 查詢完成，找到 {len(rows)} 筆記錄")
                 
                 memories = []
-                for i, row in enumerate(rows):
+                for row in rows:
                     memory = {
                         'user_message': row[0],
                         'lumi_response': row[1],
@@ -281,85 +620,312 @@ class SimpleLumiMemory:
                         'timestamp': row[3].isoformat() # 轉換為 ISO 格式字串
                     }
                     memories.append(memory)
-                    print(f"[記憶讀取] 記錄 {i+1}: {memory}")
                 
-                # 返回按時間正序排列的記憶，以便於對話上下文的組織
-                result = memories[::-1]
-                print(f"[記憶讀取] 返回 {len(result)} 筆記憶")
-                print(f"=== 記憶讀取結束 ===\n")
+                # 返回按時間正序排列的記憶，以便於對話上下文的組織（含尚未寫入的記憶）
+                result = self._merge_memories(memories[::-1], self._pending_memories(user_id), limit)
+                logger.debug("讀取最近記憶: 資料庫 %d 筆，返回 %d 筆", len(rows), len(result),
+                             extra=log_user(user_id))
                 return result
         except Exception as e:
-            print(f"❌ [記憶讀取] 從 PGVector 檢索記憶失敗: {e}")
-            print(f"=== 記憶讀取結束 ===\n")
+            logger.error("❌ 從 PGVector 檢索記憶失敗: %s", e, extra=log_user(user_id))
             return []
 
-    def get_similar_memories(self, user_id, query_message, limit=5, similarity_threshold=0.7):
-        """根據相似度搜尋相關記憶"""
+    def _vector_search_settings(self, ef_search=None, probes=None):
+        """組出本次查詢用的 SET LOCAL（只在這次查詢的隱含交易內有效）"""
+        if self.vector_index_type == 'hnsw':
+            return f"SET LOCAL hnsw.ef_search = {int(ef_search or self.hnsw_ef_search)};"
+        if self.vector_index_type == 'ivfflat':
+            return f"SET LOCAL ivfflat.probes = {int(probes or self.ivfflat_probes)};"
+        return ""
+
+    @metrics.timed('memory.similar_memories')
+    def get_similar_memories(self, user_id, query_message, limit=5, similarity_threshold=0.7,
+                             ef_search=None, probes=None):
+        """根據相似度搜尋相關記憶（先找整併後的摘要，不足的名額再用未整併的對話補上）
+
+        ef_search / probes 可針對單次查詢調整 HNSW / IVFFlat 的搜尋寬度。
+        """
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法進行相似度搜尋。")
+            logger.warning("資料庫連接未建立，無法進行相似度搜尋")
             return []
         
         query_embedding = self._get_embedding(query_message)
         if query_embedding is None:
-            print("警告: 無法生成查詢嵌入，使用時間排序檢索。")
+            logger.warning("無法生成查詢嵌入，使用時間排序檢索")
             return self.get_recent_memories(user_id, limit)
         
+        rows = self._hot_similar_rows(user_id, query_embedding, limit, similarity_threshold)
+        if rows is not None:
+            return [self._similar_row_to_memory(row) for row in rows]
+
         try:
-            with self.conn.cursor() as cur:
-                # embedding_str 必須加上中括號，pgvector 才能正確解析
-                embedding_str = '[' + ','.join([str(x) for x in query_embedding]) + ']'
-                
-                # 使用餘弦相似度搜尋最相關的記憶 - 修正 pgvector 語法
-                cur.execute("""
-                    SELECT user_message, lumi_response, emotion_tag, timestamp,
-                           1 - (embedding <=> %s::vector) as similarity
-                    FROM lumi_memories
-                    WHERE user_id = %s
-                    AND 1 - (embedding <=> %s::vector) > %s
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT %s;
-                """, (embedding_str, user_id, embedding_str, similarity_threshold, embedding_str, limit))
-                rows = cur.fetchall()
-                
-                memories = []
-                for row in rows:
-                    memories.append({
-                        'user_message': row[0],
-                        'lumi_response': row[1],
-                        'emotion_tag': row[2],
-                        'timestamp': row[3].isoformat() if row[3] else None,
-                        'similarity': float(row[4])
-                    })
-                return memories
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                rows = self._similar_rows(cur, user_id, query_embedding, limit, similarity_threshold,
+                                          self._vector_search_settings(ef_search, probes),
+                                          self._exact_search_settings())
+                return [self._similar_row_to_memory(row) for row in rows]
         except Exception as e:
-            print(f"SimpleLumiMemory: 相似度搜尋失敗: {e}")
+            logger.error("相似度搜尋失敗: %s", e, extra=log_user(user_id))
             return self.get_recent_memories(user_id, limit)
 
-    def get_user_profile_memories(self, user_id, limit=10):
-        """獲取用戶個人資料相關的記憶（偏好、習慣、重要事件等）"""
+    def _hot_similar_rows(self, user_id, query_embedding, limit, similarity_threshold):
+        """用戶已在記憶體中的向量索引時直接搜尋（精確搜尋），否則回傳 None 改查 pgvector"""
+        if not self.hot_index:
+            return None
+        return self.hot_index.search(user_id, query_embedding, limit, 1 - similarity_threshold)
+
+    def get_hot_index_stats(self):
+        """記憶體向量索引的命中率、用戶數與佔用的記憶體"""
+        if not self.hot_index:
+            return {}
+        return self.hot_index.get_stats()
+
+    @staticmethod
+    def _statement_timeout(seconds):
+        """讓資料庫在期限到時中止查詢，逾時的分支不會一直佔著連線"""
+        if not seconds:
+            return ""
+        return f"SET LOCAL statement_timeout = {max(1, int(seconds * 1000))};"
+
+    @staticmethod
+    def _row_to_memory(row):
+        return {
+            'user_message': row[1],
+            'lumi_response': row[2],
+            'emotion_tag': row[3],
+            'timestamp': row[4].isoformat() if row[4] else None
+        }
+
+    def _exact_search_settings(self, timeout=None):
+        """候選不足時重查用的設定（關閉索引掃描）；沒有向量索引時回傳 None，不需要重查"""
+        if self.vector_index_type == 'none':
+            return None
+        return self._statement_timeout(timeout) + "SET LOCAL enable_indexscan = off;"
+
+    def _similar_rows(self, cur, user_id, query_embedding, limit, similarity_threshold, settings="",
+                      exact_settings=None):
+        """執行相似度搜尋，回傳 SIMILAR_SEARCH_SQL 格式的列（int8 儲存時在這裡重新排序）
+
+        向量索引是先找全域近鄰再過濾 user_id：門檻之前的候選不足 limit 筆、而用戶實際的摘要或對話
+        比回傳的多時（索引漏掉了），以 exact_settings 精確搜尋一次。對話本來就不多的用戶不會重查；
+        相似度門檻在這之後才套用，門檻濾掉的候選也不會觸發重查。
+        """
+        # embedding_str 必須加上中括號，pgvector 才能正確解析
+        embedding_str = '[' + ','.join([str(x) for x in query_embedding]) + ']'
+        params = {
+            'user_id': user_id,
+            'embedding': embedding_str,
+            'limit': limit,
+            'max_distance': 1 - similarity_threshold,
+        }
+        if self.embedding_storage == 'vector':
+            cur.execute(settings + SIMILAR_SEARCH_SQL, params)
+            rows = cur.fetchall()
+            if exact_settings is not None and self._index_missed_rows(cur, rows, params):
+                cur.execute(exact_settings + SIMILAR_SEARCH_SQL, params)
+                rows = cur.fetchall()
+            return [row for row in rows if row[5] < params['max_distance']][:limit]
+
+        params['bits'] = binary_signature(query_embedding)
+        params['candidates'] = limit * self.rerank_factor
+        cur.execute(settings + QUANTIZED_SEARCH_SQL, params)
+        return self._rerank_quantized(cur.fetchall(), query_embedding, limit, params['max_distance'])
+
+    @staticmethod
+    def _index_missed_rows(cur, rows, params):
+        """索引回傳的摘要或對話候選少於 limit 筆，且少於用戶實際筆數時回傳 True"""
+        summaries = sum(1 for row in rows if row[6] is not None)
+        turns = len(rows) - summaries
+        if summaries >= params['limit'] and turns >= params['limit']:
+            return False
+        cur.execute(SIMILAR_CANDIDATE_COUNT_SQL, params)
+        total_summaries, total_turns = cur.fetchone()
+        return total_summaries > summaries or total_turns > turns
+
+    @staticmethod
+    @metrics.timed('embedding.rerank')
+    def _rerank_quantized(rows, query_embedding, limit, max_distance):
+        """候選對話以 int8 還原後精確計算距離，和摘要合併成與 SIMILAR_SEARCH_SQL 相同的順序"""
+        summaries = sorted((row[:7] for row in rows if row[6] is not None and row[5] < max_distance),
+                           key=lambda row: row[5])
+        candidates = [row for row in rows if row[6] is None]
+        turns = []
+        if candidates:
+            vectors = np.stack([dequantize_int8(row[7], row[8]) for row in candidates])
+            distances = cosine_distances(query_embedding, vectors)
+            turns = sorted((row[:5] + (float(distance), None) for row, distance in zip(candidates, distances)
+                            if distance < max_distance), key=lambda row: row[5])
+        return (summaries + turns)[:limit]
+
+    @staticmethod
+    def _similar_row_to_memory(row):
+        """SIMILAR_SEARCH_SQL 的一列；摘要會註明合併了幾輪相似的對話"""
+        memory = SimpleLumiMemory._row_to_memory(row)
+        memory['similarity'] = 1 - float(row[5])
+        if row[6] is not None:
+            memory['user_message'] = f"{memory['user_message']}（類似的話說過 {row[6]} 次）"
+            memory['source_count'] = row[6]
+        return memory
+
+    @metrics.timed('db.recent_context')
+    def _fetch_recent_context(self, user_id, recent_limit, profile_limit, timeout=None):
+        """最近對話 + 個人資料記憶（不需要嵌入），回傳 (section, id, ...) 列"""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(self._statement_timeout(timeout) + """
+                WITH recent_turns AS (
+                    SELECT id, user_message, lumi_response, emotion_tag, timestamp
+                    FROM lumi_memories
+                    WHERE user_id = %(user_id)s
+                    ORDER BY timestamp DESC
+                    LIMIT %(recent_limit)s
+                ),
+                profile_facts AS (
+                    SELECT id, user_message, lumi_response, emotion_tag, timestamp
+                    FROM lumi_memories
+                    WHERE user_id = %(user_id)s
+                      AND profile_tags <> '{}'
+                      AND id NOT IN (SELECT id FROM recent_turns)
+                    ORDER BY timestamp DESC
+                    LIMIT %(profile_limit)s
+                )
+                SELECT 'recent' AS section, id, user_message, lumi_response, emotion_tag, timestamp FROM recent_turns
+                UNION ALL
+                SELECT 'profile', id, user_message, lumi_response, emotion_tag, timestamp FROM profile_facts;
+            """, {'user_id': user_id, 'recent_limit': recent_limit, 'profile_limit': profile_limit})
+            return cur.fetchall()
+
+    def _fetch_similar_context(self, user_id, message, limit, similarity_threshold, timeout=None):
+        """產生查詢嵌入後做向量搜尋（摘要優先），回傳 SIMILAR_SEARCH_SQL 的列"""
+        query_embedding = self._get_embedding(message)
+        if query_embedding is None:
+            logger.warning("無法生成查詢嵌入，略過相似記憶")
+            return []
+        rows = self._hot_similar_rows(user_id, query_embedding, limit, similarity_threshold)
+        if rows is not None:
+            return rows
+        with metrics.span('db.similar_context'), self.pool.connection() as conn, conn.cursor() as cur:
+            return self._similar_rows(cur, user_id, query_embedding, limit, similarity_threshold,
+                                      self._statement_timeout(timeout) + self._vector_search_settings(),
+                                      self._exact_search_settings(timeout))
+
+    @metrics.timed('memory.get_context')
+    def get_context(self, user_id, message, recent_limit=3, similar_limit=3, profile_limit=5,
+                    similarity_threshold=0.7, timeouts=None):
+        """同時取回回覆所需的記憶上下文
+
+        用戶名稱（user_profiles 快取）、最近對話 + 個人資料記憶、查詢嵌入 + 相似對話三條分支並行，
+        總延遲取決於最慢的一條；任一分支超過自己的期限就以空結果回傳，其餘照常使用。
+        相似對話會排除最近對話，個人資料記憶會排除前兩者，避免同一輪對話重複出現。
+        timeouts 可覆寫各分支的期限（秒）：{'profile_name': ..., 'recent': ..., 'similar': ...}
+        """
+        context = {
+            'profile_name': None,
+            'recent_memories': [],
+            'similar_memories': [],
+            'profile_memories': [],
+            'timed_out': [],
+            'stage_ms': {},
+        }
+        if not self._ensure_connection():
+            logger.warning("資料庫連接未建立，無法獲取記憶上下文")
+            return context
+
+        timeouts = {**self.retrieval_timeouts, **(timeouts or {})}
+        started = time.monotonic()
+        stage_ms = {}
+
+        def timed(stage, func, *args):
+            def run():
+                try:
+                    return func(*args)
+                finally:
+                    stage_ms[stage] = round((time.monotonic() - started) * 1000, 2)
+            return run
+
+        # 相似對話多取幾筆，扣掉和最近對話重複的之後仍有 similar_limit 筆
+        futures = {
+            'profile_name': self.retrieval_executor.submit(
+                timed('profile_name', self.get_user_profile_name, user_id)),
+            'recent': self.retrieval_executor.submit(
+                timed('recent', self._fetch_recent_context, user_id, recent_limit,
+                      profile_limit + similar_limit, timeouts['recent'])),
+        }
+        if similar_limit > 0:
+            futures['similar'] = self.retrieval_executor.submit(
+                timed('similar', self._fetch_similar_context, user_id, message,
+                      similar_limit + recent_limit, similarity_threshold, timeouts['similar']))
+
+        results = {}
+        for stage, future in futures.items():
+            remaining = started + timeouts[stage] - time.monotonic()
+            try:
+                results[stage] = future.result(timeout=max(0.0, remaining))
+            except FutureTimeoutError:
+                future.cancel()
+                context['timed_out'].append(stage)
+                metrics.inc('retrieval_timeouts', stage=stage)
+                logger.warning("記憶分支 %s 超過 %ss，先以其他結果回覆", stage, timeouts[stage],
+                               extra=log_user(user_id))
+            except Exception as e:
+                logger.error("記憶分支 %s 失敗: %s", stage, e, extra=log_user(user_id))
+
+        context['profile_name'] = results.get('profile_name')
+
+        recent_ids = set()
+        profile_rows = []
+        for row in results.get('recent', []):
+            if row[0] == 'recent':
+                recent_ids.add(row[1])
+                context['recent_memories'].append(self._row_to_memory(row[1:]))
+            else:
+                profile_rows.append(row[1:])
+
+        similar_ids = set()
+        for row in results.get('similar', []):
+            # 摘要（row[6] 有值）的 id 與對話不同序號，不和最近對話比對
+            summary = row[6] is not None
+            if (not summary and row[0] in recent_ids) or len(context['similar_memories']) >= similar_limit:
+                continue
+            if not summary:
+                similar_ids.add(row[0])
+            context['similar_memories'].append(self._similar_row_to_memory(row))
+
+        context['profile_memories'] = [
+            self._row_to_memory(row) for row in profile_rows if row[0] not in similar_ids
+        ][:profile_limit]
+
+        # 尚未寫入資料庫的對話也要看得到（read-your-writes）
+        pending = self._pending_memories(user_id)
+
+        # 最近對話依時間正序（和 get_recent_memories 一致），相似對話依相似度
+        context['recent_memories'] = self._merge_memories(context['recent_memories'], pending, recent_limit)
+        context['similar_memories'].sort(key=lambda m: m['similarity'], reverse=True)
+        context['profile_memories'].sort(key=lambda m: m['timestamp'] or '', reverse=True)
+        # 逾時的分支還在背景跑，複製一份避免回傳後被改動
+        context['stage_ms'] = dict(stage_ms, total=round((time.monotonic() - started) * 1000, 2))
+        return context
+
+    @metrics.timed('db.profile_memories')
+    def get_user_profile_memories(self, user_id, limit=10, tags=None):
+        """獲取用戶個人資料相關的記憶（偏好、習慣、重要事件等）
+
+        使用寫入時標記的 profile_tags（走部分索引）；tags 可限定特定標籤。
+        """
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法獲取用戶資料記憶。")
+            logger.warning("資料庫連接未建立，無法獲取用戶資料記憶")
             return []
         
-        # 定義個人資料相關的關鍵詞
-        profile_keywords = [
-            '喜歡', '討厭', '習慣', '工作', '學校', '家人', '朋友', '興趣', '愛好',
-            '生日', '年齡', '住址', '電話', 'email', '職業', '學歷', '夢想', '目標',
-            '害怕', '擔心', '開心', '難過', '壓力', '放鬆', '運動', '音樂', '電影',
-            '食物', '顏色', '動物', '地方', '旅行', '學習', '技能', '成就', '挫折'
-        ]
-        
         try:
-            with self.conn.cursor() as cur:
-                # 搜尋包含個人資料關鍵詞的記憶
-                keyword_conditions = " OR ".join([f"user_message ILIKE '%{keyword}%'" for keyword in profile_keywords])
-                cur.execute(f"""
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                # 搜尋寫入時已標記為個人資料的記憶
+                cur.execute("""
                     SELECT user_message, lumi_response, emotion_tag, timestamp
                     FROM lumi_memories
-                    WHERE user_id = %s AND ({keyword_conditions})
+                    WHERE user_id = %s AND profile_tags <> '{}'
+                      AND (%s::text[] IS NULL OR profile_tags && %s::text[])
                     ORDER BY timestamp DESC
                     LIMIT %s;
-                """, (user_id, limit))
+                """, (user_id, tags, tags, limit))
                 rows = cur.fetchall()
                 
                 memories = []
@@ -372,17 +938,18 @@ class SimpleLumiMemory:
                     })
                 return memories
         except Exception as e:
-            print(f"SimpleLumiMemory: 獲取用戶資料記憶失敗: {e}")
+            logger.error("獲取用戶資料記憶失敗: %s", e)
             return []
 
+    @metrics.timed('db.emotional_memories')
     def get_emotional_memories(self, user_id, emotion_type=None, limit=5):
         """獲取特定情緒類型的記憶"""
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法獲取情緒記憶。")
+            logger.warning("資料庫連接未建立，無法獲取情緒記憶")
             return []
         
         try:
-            with self.conn.cursor() as cur:
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 if emotion_type:
                     cur.execute("""
                         SELECT user_message, lumi_response, emotion_tag, timestamp
@@ -411,25 +978,27 @@ class SimpleLumiMemory:
                     })
                 return memories
         except Exception as e:
-            print(f"SimpleLumiMemory: 獲取情緒記憶失敗: {e}")
+            logger.error("獲取情緒記憶失敗: %s", e)
             return []
 
+    @metrics.timed('db.long_term_memories')
     def get_long_term_memories(self, user_id, days_back=30, limit=20):
-        """獲取長期記憶（指定天數內的重要記憶）"""
+        """獲取長期記憶（用戶時區包含今天在內最近 days_back 天的記憶）"""
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法獲取長期記憶。")
+            logger.warning("資料庫連接未建立，無法獲取長期記憶")
             return []
         
+        start, end = user_time.recent_days_range(days_back, self.get_user_timezone(user_id))
         try:
-            with self.conn.cursor() as cur:
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT user_message, lumi_response, emotion_tag, timestamp
                     FROM lumi_memories
-                    WHERE user_id = %s 
-                    AND timestamp >= NOW() - INTERVAL '%s days'
+                    WHERE user_id = %s
+                      AND timestamp >= %s AND timestamp < %s
                     ORDER BY timestamp DESC
                     LIMIT %s;
-                """, (user_id, days_back, limit))
+                """, (user_id, start, end, limit))
                 rows = cur.fetchall()
                 
                 memories = []
@@ -442,17 +1011,19 @@ class SimpleLumiMemory:
                     })
                 return memories
         except Exception as e:
-            print(f"SimpleLumiMemory: 獲取長期記憶失敗: {e}")
+            logger.error("獲取長期記憶失敗: %s", e)
             return []
 
+    @metrics.timed('db.memory_statistics')
     def get_memory_statistics(self, user_id):
         """獲取用戶記憶統計資訊"""
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法獲取記憶統計。")
+            logger.warning("資料庫連接未建立，無法獲取記憶統計")
             return {}
         
+        week_start, week_end = user_time.recent_days_range(7, self.get_user_timezone(user_id))
         try:
-            with self.conn.cursor() as cur:
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 # 總對話數
                 cur.execute("SELECT COUNT(*) FROM lumi_memories WHERE user_id = %s", (user_id,))
                 total_conversations = cur.fetchone()[0]
@@ -475,9 +1046,9 @@ class SimpleLumiMemory:
                 cur.execute("""
                     SELECT COUNT(*) 
                     FROM lumi_memories 
-                    WHERE user_id = %s 
-                    AND timestamp >= NOW() - INTERVAL '7 days'
-                """, (user_id,))
+                    WHERE user_id = %s
+                      AND timestamp >= %s AND timestamp < %s
+                """, (user_id, week_start, week_end))
                 weekly_interactions = cur.fetchone()[0]
                 
                 return {
@@ -488,23 +1059,29 @@ class SimpleLumiMemory:
                     'memory_strength': 'strong' if total_conversations > 50 else 'medium' if total_conversations > 20 else 'weak'
                 }
         except Exception as e:
-            print(f"SimpleLumiMemory: 獲取記憶統計失敗: {e}")
+            logger.error("獲取記憶統計失敗: %s", e)
             return {}
 
-    def get_daily_memories(self, user_id, date_str):
+    @metrics.timed('db.daily_memories')
+    def get_daily_memories(self, user_id, date_str, since=None):
+        """用戶時區某一天的對話（時間正序）；指定 since（ISO 時間字串）時只回傳之後的對話"""
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法檢索每日記憶。")
+            logger.warning("資料庫連接未建立，無法檢索每日記憶")
             return []
         
+        start, end = user_time.day_range(date_str, self.get_user_timezone(user_id))
+        since_dt = datetime.fromisoformat(since) if since else None
+        after = "AND timestamp > %s" if since_dt else ""
+        params = (user_id, start, end, since_dt) if since_dt else (user_id, start, end)
         try:
-            with self.conn.cursor() as cur:
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 # 查詢特定用戶在特定日期的所有對話記錄
-                cur.execute("""
+                cur.execute(f"""
                     SELECT user_message, lumi_response, emotion_tag, timestamp
                     FROM lumi_memories
-                    WHERE user_id = %s AND DATE(timestamp) = %s
+                    WHERE user_id = %s AND timestamp >= %s AND timestamp < %s {after}
                     ORDER BY timestamp ASC;
-                """, (user_id, date_str))
+                """, params)
                 rows = cur.fetchall()
                 
                 memories = []
@@ -515,18 +1092,97 @@ class SimpleLumiMemory:
                         'emotion_tag': row[2],
                         'timestamp': row[3].isoformat() if row[3] else None
                     })
-                return memories
+                # 加上當天尚未寫入資料庫的對話
+                pending = [m for m in self._pending_memories(user_id)
+                           if start <= datetime.fromisoformat(m['timestamp']) < end
+                           and (since_dt is None or datetime.fromisoformat(m['timestamp']) > since_dt)]
+                return self._merge_memories(memories, pending)
         except Exception as e:
-            print(f"SimpleLumiMemory: 從 PGVector 檢索每日記憶失敗: {e}")
+            logger.error("從 PGVector 檢索每日記憶失敗: %s", e)
             return []
 
+    def get_daily_diary(self, user_id, date_str):
+        """已快取的日記 {'diary', 'last_memory_at', 'turn_count'}，沒有時回傳 None"""
+        if not self._ensure_connection():
+            return None
+        try:
+            return self.diaries.get(user_id, date_str)
+        except Exception as e:
+            logger.error("查詢日記快取失敗: %s", e, extra=log_user(user_id))
+            return None
+
+    def save_daily_diary(self, user_id, date_str, diary, last_memory_at, turn_count):
+        """寫入日記快取；last_memory_at 是日記已包含的最後一筆對話時間（ISO 字串）"""
+        if not self._ensure_connection():
+            return False
+        try:
+            return self.diaries.save(user_id, date_str, diary, datetime.fromisoformat(last_memory_at), turn_count)
+        except Exception as e:
+            logger.error("寫入日記快取失敗: %s", e, extra=log_user(user_id))
+            return False
+
+    @metrics.timed('db.stale_diary_users')
+    def get_stale_diary_users(self, date_str, limit=200, min_new_turns=1):
+        """當天有聊天、但日記還沒包含最新對話的用戶（新對話最多的優先）
+
+        「當天」以每位用戶自己的時區計算（與 get_daily_memories 相同）；沒有設定或時區無效時用 USER_TIMEZONE。
+        外層先以預設時區前後各放寬一天的範圍走 timestamp 索引，再套用每位用戶的午夜邊界。
+        """
+        if not self._ensure_connection():
+            return []
+        start, end = user_time.day_range(date_str, user_time.get_zone())
+        try:
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT m.user_id
+                    FROM lumi_memories m
+                    LEFT JOIN user_profiles p ON p.user_id = m.user_id
+                    LEFT JOIN pg_timezone_names z ON z.name = p.attributes->>'timezone'
+                    LEFT JOIN lumi_daily_diaries d
+                           ON d.user_id = m.user_id AND d.diary_date = %(date)s
+                    WHERE m.timestamp >= %(start)s AND m.timestamp < %(end)s
+                      AND m.timestamp >= %(date)s::date::timestamp AT TIME ZONE COALESCE(z.name, %(zone)s)
+                      AND m.timestamp < (%(date)s::date + 1)::timestamp AT TIME ZONE COALESCE(z.name, %(zone)s)
+                      AND (d.last_memory_at IS NULL OR m.timestamp > d.last_memory_at)
+                    GROUP BY m.user_id
+                    HAVING COUNT(*) >= %(min_new_turns)s
+                    ORDER BY COUNT(*) DESC
+                    LIMIT %(limit)s;
+                """, {'date': date_str, 'start': start - timedelta(days=1), 'end': end + timedelta(days=1),
+                      'zone': user_time.get_zone().key, 'min_new_turns': min_new_turns, 'limit': limit})
+                return [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            logger.error("查詢待更新日記的用戶失敗: %s", e)
+            return []
+
+    @contextmanager
+    def diary_precompute_lock(self):
+        """session advisory lock：拿到時 yield True，其他 process 正在執行時 yield False
+
+        預先產生可能跑上好幾分鐘，鎖放在連線池之外的專用連線上，不佔用 webhook 需要的連線。
+        """
+        if not self._ensure_connection():
+            yield False
+            return
+        conn = psycopg2.connect(self.pool.dsn)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s);", (DIARY_PRECOMPUTE_LOCK_KEY,))
+                locked = cur.fetchone()[0]
+            # 連線關閉時 session lock 會一併釋放
+            yield locked
+        finally:
+            conn.close()
+
+    @metrics.timed('db.memory_summary')
     def get_memory_summary(self, user_id):
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法獲取記憶摘要。")
+            logger.warning("資料庫連接未建立，無法獲取記憶摘要")
             return {'total_memories': 0, 'last_interaction': 'N/A'}
         
         try:
-            with self.conn.cursor() as cur:
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT COUNT(*), MAX(timestamp)
                     FROM lumi_memories
@@ -539,16 +1195,17 @@ class SimpleLumiMemory:
                     'last_interaction': last_ts.isoformat() if last_ts else 'N/A'
                 }
         except Exception as e:
-            print(f"SimpleLumiMemory: 從 PGVector 獲取記憶摘要失敗: {e}")
+            logger.error("從 PGVector 獲取記憶摘要失敗: %s", e)
             return {'total_memories': 0, 'last_interaction': 'N/A'}
 
+    @metrics.timed('db.emotion_patterns')
     def get_user_emotion_patterns(self, user_id):
         if not self._ensure_connection():
-            print("警告: 資料庫連接未建立，無法獲取情緒模式。")
+            logger.warning("資料庫連接未建立，無法獲取情緒模式")
             return {'dominant_emotion': 'friend', 'total_interactions': 0}
 
         try:
-            with self.conn.cursor() as cur:
+            with self.pool.connection() as conn, conn.cursor() as cur:
                 cur.execute("""
                     SELECT emotion_tag, COUNT(*)
                     FROM lumi_memories
@@ -572,5 +1229,5 @@ class SimpleLumiMemory:
                     'total_interactions': total_interactions if total_interactions else 0
                 }
         except Exception as e:
-            print(f"SimpleLumiMemory: 從 PGVector 獲取情緒模式失敗: {e}")
+            logger.error("從 PGVector 獲取情緒模式失敗: %s", e)
             return {'dominant_emotion': 'friend', 'total_interactions': 0}
\ No newline at end of file
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+日記快取測試：沒有新對話時直接用快取，有新對話時只把新對話交給 LLM（用假的記憶系統與 OpenAI）
+"""
+from datetime import datetime, timedelta, timezone
+
+import openai
+
+
+class FakeMemory:
+    """只實作日記用到的方法，資料放在記憶體中"""
+
+    def __init__(self):
+        self.memories = []
+        self.diaries = {}
+
+    def add(self, user_message, lumi_response):
+        ts = datetime(2026, 10, 18, 9, tzinfo=timezone.utc) + timedelta(minutes=len(self.memories))
+        self.memories.append({'user_message': user_message, 'lumi_response': lumi_response,
+                              'emotion_tag': None, 'timestamp': ts.isoformat()})
+
+    def get_user_today(self, user_id):
+        return '2026-10-18'
+
+    def get_daily_memories(self, user_id, date_str, since=None):
+        since_dt = datetime.fromisoformat(since) if since else None
+        return [m for m in self.memories
+                if since_dt is None or datetime.fromisoformat(m['timestamp']) > since_dt]
+
+    def get_daily_diary(self, user_id, date_str):
+        return self.diaries.get((user_id, date_str))
+
+    def save_daily_diary(self, user_id, date_str, diary, last_memory_at, turn_count):
+        self.diaries[(user_id, date_str)] = {'diary': diary, 'last_memory_at': last_memory_at,
+                                             'turn_count': turn_count}
+        return True
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts = []
+
+    def create(self, **kwargs):
+        prompt = kwargs['messages'][0]['content']
+        self.prompts.append(prompt)
+        return type('R', (), {'choices': [type('C', (), {
+            'message': type('M', (), {'content': f"親愛的日記 #{len(self.prompts)}"})()})()]})()
+
+
+def setup(monkeypatch):
+    import ai_logic
+    memory, llm = FakeMemory(), FakeLLM()
+    monkeypatch.setattr(ai_logic, 'memory_manager', memory)
+    monkeypatch.setattr(openai.ChatCompletion, 'create', llm.create)
+    return ai_logic, memory, llm
+
+
+def test_diary_cached_then_incremental(monkeypatch):
+    ai_logic, memory, llm = setup(monkeypatch)
+
+    assert ai_logic.update_daily_diary('u1', '2026-10-18') == (None, 'empty')
+
+    memory.add("今天去爬山", "好棒！")
+    memory.add("腳好痠", "記得伸展喔")
+    assert ai_logic.update_daily_diary('u1', '2026-10-18') == ("親愛的日記 #1", 'created')
+    assert "今天去爬山" in llm.prompts[0]
+
+    # 沒有新對話：不呼叫 LLM
+    assert ai_logic.update_daily_diary('u1', '2026-10-18') == ("親愛的日記 #1", 'cached')
+    assert len(llm.prompts) == 1
+
+    # 有新對話：只送出新對話與原本的日記
+    memory.add("晚上吃火鍋", "好好吃的樣子")
+    assert ai_logic.update_daily_diary('u1', '2026-10-18') == ("親愛的日記 #2", 'updated')
+    assert "晚上吃火鍋" in llm.prompts[1]
+    assert "親愛的日記 #1" in llm.prompts[1]
+    assert "今天去爬山" not in llm.prompts[1]
+    assert memory.diaries[('u1', '2026-10-18')]['turn_count'] == 3
+    print("✅ 日記只整理新的對話")
+
+
+def test_long_day_is_folded_in_bounded_chunks(monkeypatch):
+    ai_logic, memory, llm = setup(monkeypatch)
+    monkeypatch.setattr(ai_logic, 'DIARY_FOLD_TOKENS', 100)
+
+    for i in range(30):
+        memory.add(f"第{i}件事" + "很長的描述" * 20, "嗯嗯" * 50)
+    diary, status = ai_logic.update_daily_diary('u1', '2026-10-18')
+    assert status == 'created'
+    assert len(llm.prompts) > 1
+    longest = max(ai_logic.count_tokens(p) for p in llm.prompts)
+    assert longest < ai_logic.count_tokens(ai_logic.DIARY_REQUIREMENTS) + 400
+    assert memory.diaries[('u1', '2026-10-18')]['turn_count'] == 30
+    assert memory.diaries[('u1', '2026-10-18')]['last_memory_at'] == memory.memories[-1]['timestamp']
+
+
+def test_llm_error_keeps_cached_diary(monkeypatch):
+    ai_logic, memory, llm = setup(monkeypatch)
+    memory.add("今天去爬山", "好棒！")
+    ai_logic.update_daily_diary('u1', '2026-10-18')
+
+    def raise_error(**kwargs):
+        raise openai.error.APIError("boom")
+    monkeypatch.setattr(openai.ChatCompletion, 'create', raise_error)
+    memory.add("晚上吃火鍋", "好好吃的樣子")
+    assert ai_logic.update_daily_diary('u1', '2026-10-18') == ("親愛的日記 #1", 'error')
+    # 失敗的對話下次還會再整理
+    assert memory.diaries[('u1', '2026-10-18')]['last_memory_at'] == memory.memories[0]['timestamp']
+
+
+if __name__ == "__main__":
+    print("請用 pytest 執行：python -m pytest -q test_daily_diary.py")
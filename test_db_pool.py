@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+資料庫連線池測試（用假連線取代 psycopg2.connect，不需要資料庫）
+"""
+import psycopg2
+import psycopg2.extensions
+
+import db_pool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+
+
+class FakeInfo:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.broken = False
+        self.executed = []
+        self.info = FakeInfo()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def _make_pool(monkeypatch, **kwargs):
+    created = []
+
+    def fake_connect(dsn):
+        conn = FakeConnection()
+        created.append(conn)
+        return conn
+
+    monkeypatch.setattr(db_pool.psycopg2, 'connect', fake_connect)
+    return db_pool.PgConnectionPool('postgresql://fake', **kwargs), created
+
+
+def test_pool_reuses_connection_without_ping(monkeypatch):
+    """閒置時間短的連線直接重用，不做 SELECT 1"""
+    pool, created = _make_pool(monkeypatch, min_size=1, max_size=2)
+    for _ in range(3):
+        with pool.connection() as conn:
+            assert conn.autocommit
+    assert len(created) == 1
+    assert created[0].executed == []
+    stats = pool.get_stats()
+    assert stats['checkouts'] == 3
+    assert stats['health_checks'] == 0
+    print(f"✅ 連線池統計: {stats}")
+
+
+def test_pool_discards_broken_connection(monkeypatch):
+    """連線錯誤後丟棄並自動重建"""
+    pool, created = _make_pool(monkeypatch, min_size=1, max_size=1)
+    try:
+        with pool.connection() as conn:
+            raise psycopg2.OperationalError("boom")
+    except psycopg2.OperationalError:
+        pass
+    with pool.connection() as conn:
+        assert conn is created[1]
+    stats = pool.get_stats()
+    assert stats['connections_discarded'] == 1
+    assert stats['connections_created'] == 2
+
+
+def test_pool_checkout_timeout(monkeypatch):
+    """連線都被借走時，超過 checkout timeout 會拋出 PoolTimeoutError"""
+    pool, _ = _make_pool(monkeypatch, min_size=0, max_size=1, checkout_timeout=0.05)
+    with pool.connection():
+        try:
+            with pool.connection():
+                assert False, "應該逾時"
+        except db_pool.PoolTimeoutError:
+            pass
+    assert pool.get_stats()['checkout_timeouts'] == 1
+
+
+def test_reconnect_is_serialized_and_backs_off(monkeypatch):
+    """資料庫斷線時只有一個執行緒重建連線池，失敗後 reconnect_interval 內不再重試"""
+    import threading
+    import time
+    from simple_memory import SimpleLumiMemory
+
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.setenv('WRITE_BEHIND_ENABLED', 'false')
+    memory = SimpleLumiMemory()
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://unreachable/lumi')
+    attempts = []
+
+    def fail_to_connect():
+        attempts.append(threading.get_ident())
+        time.sleep(0.05)
+    memory._initialize_railway_pgvector = fail_to_connect
+    memory.reconnect_interval = 60
+
+    threads = [threading.Thread(target=memory._ensure_connection) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(attempts) == 1
+    assert not memory._ensure_connection() and len(attempts) == 1
+
+    # 間隔過後再試，成功時其他執行緒直接使用新的連線池
+    memory._next_reconnect_at = 0.0
+    memory._initialize_railway_pgvector = lambda: setattr(memory, 'pool', object())
+    assert memory._ensure_connection() and memory._ensure_connection()
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__, '-q'])
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+日記預先產生排程測試：時段判斷、並行上限、速率限制、忙碌暫停與跨 process 鎖；
+有 LUMI_TEST_DATABASE_URL 時另外測試 advisory lock 不佔用連線池
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+from diary_scheduler import DiaryPrecomputeScheduler, parse_window, in_window
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+
+
+def at(hour, minute=0):
+    return lambda: datetime(2026, 10, 18, hour, minute)
+
+
+class Recorder:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, user_id, date_str):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.calls.append((user_id, date_str, time.monotonic()))
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return "親愛的日記", 'created'
+
+
+def test_window_parsing():
+    window = parse_window("16:00-19:30")
+    assert window == ((16, 0), (19, 30))
+    assert in_window(window, datetime(2026, 10, 18, 16, 0))
+    assert in_window(window, datetime(2026, 10, 18, 19, 29))
+    assert not in_window(window, datetime(2026, 10, 18, 19, 30))
+
+    overnight = parse_window("23:00-02")
+    assert in_window(overnight, datetime(2026, 10, 18, 23, 30))
+    assert in_window(overnight, datetime(2026, 10, 18, 1, 0))
+    assert not in_window(overnight, datetime(2026, 10, 18, 12, 0))
+    print("✅ 時段判斷正確")
+
+
+def test_bounded_concurrency_and_rate():
+    recorder = Recorder(delay=0.05)
+    users = [f"u{i}" for i in range(6)]
+    scheduler = DiaryPrecomputeScheduler(recorder, lambda date_str, limit: users[:limit],
+                                         max_concurrency=2, rate_per_minute=60 / 0.02, clock=at(17))
+    assert scheduler.run_once() == 6
+    assert sorted(c[0] for c in recorder.calls) == users
+    assert recorder.max_active <= 2
+    assert all(c[1] == '2026-10-18' for c in recorder.calls)
+    starts = sorted(c[2] for c in recorder.calls)
+    assert all(b - a >= 0.015 for a, b in zip(starts, starts[1:]))
+
+    stats = scheduler.get_stats()
+    assert stats['users'] == 6 and stats['statuses'] == {'created': 6}
+    assert stats['in_window'] and stats['window'] == '16:00-19:00'
+    print(f"✅ 並行上限 {recorder.max_active}，速率限制生效")
+
+
+def test_paused_while_busy_and_outside_window():
+    recorder = Recorder()
+    busy = {'value': True}
+    threading.Timer(0.2, lambda: busy.update(value=False)).start()
+    scheduler = DiaryPrecomputeScheduler(recorder, lambda date_str, limit: ['u1'],
+                                         busy_func=lambda: busy['value'], clock=at(17))
+    scheduler.run_once()
+    assert len(recorder.calls) == 1
+    assert scheduler.get_stats()['paused_seconds'] > 0
+
+    scheduler = DiaryPrecomputeScheduler(recorder, lambda date_str, limit: ['u2'], clock=at(20))
+    assert scheduler.run_once() == 0
+
+
+def test_skips_when_other_process_holds_lock():
+    @contextmanager
+    def held():
+        yield False
+
+    recorder = Recorder()
+    scheduler = DiaryPrecomputeScheduler(recorder, lambda date_str, limit: ['u1'], lock=held, clock=at(17))
+    assert scheduler.run_once() == 0
+    assert not recorder.calls
+    assert scheduler.get_stats()['skipped_locked'] == 1
+
+
+def test_failures_are_counted():
+    def boom(user_id, date_str):
+        raise RuntimeError("llm down")
+
+    scheduler = DiaryPrecomputeScheduler(boom, lambda date_str, limit: ['u1', 'u2'], clock=at(17),
+                                         rate_per_minute=0)
+    assert scheduler.run_once() == 2
+    assert scheduler.get_stats()['failed'] == 2
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_precompute_lock_does_not_hold_a_pool_connection(monkeypatch):
+    from db_pool import PgConnectionPool
+    from simple_memory import SimpleLumiMemory
+
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.setenv('WRITE_BEHIND_ENABLED', 'false')
+    memory = SimpleLumiMemory()
+    memory.pool = PgConnectionPool(DSN, min_size=0, max_size=1, checkout_timeout=0.5)
+    try:
+        with memory.diary_precompute_lock() as locked:
+            assert locked
+            # 唯一的連線仍可借用，其他 process 拿不到鎖
+            with memory.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            with memory.diary_precompute_lock() as again:
+                assert not again
+        with memory.diary_precompute_lock() as locked:
+            assert locked
+    finally:
+        memory.pool.close()
+
+
+if __name__ == "__main__":
+    test_window_parsing()
+    test_bounded_concurrency_and_rate()
+    test_paused_while_busy_and_outside_window()
+    test_skips_when_other_process_holds_lock()
+    test_failures_are_counted()
+    print("✅ 日記預先產生排程測試通過")
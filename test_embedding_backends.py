@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+嵌入後端測試：本地雜湊嵌入的決定性與相似度、後端選擇；有 LUMI_TEST_DATABASE_URL 時另外測試切換維度與重新產生嵌入
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+
+from embedding_backends import HashingEmbeddingBackend, OpenAIEmbeddingBackend, get_backend
+from simple_memory import SimpleLumiMemory
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+TEST_DATABASE = 'lumi_embedding_backend_test'
+
+
+def similarity(a, b):
+    return float(np.dot(a, b))
+
+
+def test_hashing_backend_is_deterministic_and_normalized():
+    backend = HashingEmbeddingBackend(dim=256)
+    first, again = backend.embed(["今天好累喔"])[0], HashingEmbeddingBackend(dim=256).embed(["今天好累喔"])[0]
+    assert first == again and len(first) == 256
+    assert abs(np.linalg.norm(first) - 1.0) < 1e-5
+    # 空白與大小寫不影響結果
+    assert backend.embed(["Hello  World"])[0] == backend.embed([" hello world "])[0]
+
+    tired, tired_too, food = backend.embed(["今天上班好累", "上班好累喔", "晚餐想吃拉麵"])
+    assert similarity(tired, tired_too) > similarity(tired, food) + 0.3
+    print("✅ 雜湊嵌入結果固定，字面相近的句子較相似")
+
+
+def test_get_backend_from_env(monkeypatch):
+    monkeypatch.setenv('EMBEDDING_BACKEND', 'hashing')
+    monkeypatch.setenv('EMBEDDING_DIM', '384')
+    backend = get_backend()
+    assert isinstance(backend, HashingEmbeddingBackend) and backend.dim == 384 and backend.local
+    assert backend.model == 'hashing-char13-384'
+
+    monkeypatch.setenv('EMBEDDING_BACKEND', 'openai')
+    monkeypatch.delenv('EMBEDDING_DIM')
+    backend = get_backend()
+    assert isinstance(backend, OpenAIEmbeddingBackend) and backend.dim == 1536 and not backend.local
+    assert get_backend('openai', model='text-embedding-3-large').dim == 3072
+
+    monkeypatch.setenv('EMBEDDING_BACKEND', 'word2vec')
+    with pytest.raises(ValueError):
+        get_backend()
+
+
+def test_local_backend_skips_cache_and_batcher(monkeypatch):
+    monkeypatch.setenv('EMBEDDING_BACKEND', 'hashing')
+    monkeypatch.setenv('EMBEDDING_DIM', '64')
+    memory = SimpleLumiMemory()
+    assert memory.embedding_batcher is None
+
+    def fail(*args):
+        raise AssertionError("本地後端不應查詢嵌入快取")
+    monkeypatch.setattr(memory.embedding_cache, 'get_or_compute', fail)
+    monkeypatch.setattr(memory.embedding_cache, 'get_or_compute_many', fail)
+    assert memory._get_embedding("早安") == memory.embedding_backend.embed(["早安"])[0]
+    embeddings = memory._get_embeddings(["早安", "  ", "晚安"])
+    assert [len(e) for e in embeddings] == [64, 64, 64] and not any(embeddings[1])
+    print("✅ 本地後端直接計算，不經過快取與微批次")
+
+
+@pytest.fixture
+def pool():
+    import memory_partitions
+    import schema
+    from db_pool import PgConnectionPool
+    from test_query_plans import scratch_database, drop_database
+
+    pool = PgConnectionPool(scratch_database(TEST_DATABASE), min_size=1, max_size=2,
+                            on_connect=SimpleLumiMemory._configure_connection)
+    with pool.connection() as conn:
+        schema.apply_migrations(conn)
+        memory_partitions.ensure_partitions(conn, months_ahead=1)
+        schema.ensure_vector_index(conn, 'hnsw')
+    yield pool
+    pool.close()
+    drop_database(TEST_DATABASE)
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_dimension_change_and_reembed(pool):
+    import schema
+    import reembed_memories
+
+    old = HashingEmbeddingBackend(dim=1536)
+    new = HashingEmbeddingBackend(dim=128)
+    messages = ["今天上班好累", "晚餐想吃拉麵", "週末去爬山"]
+    now = datetime.now(timezone.utc)
+    with pool.connection() as conn:
+        # 新資料庫還沒有嵌入：直接切換
+        assert schema.ensure_embedding_config(conn, old.model, old.dim)
+        assert not schema.ensure_embedding_config(conn, old.model, old.dim)
+        with conn.cursor() as cur:
+            for i, (message, embedding) in enumerate(zip(messages, old.embed(messages))):
+                cur.execute("""
+                    INSERT INTO lumi_memories (user_id, user_message, lumi_response, timestamp, embedding)
+                    VALUES ('u1', %s, '回覆', %s, %s);
+                """, (message, now - timedelta(minutes=i), np.asarray(embedding, dtype=np.float32)))
+
+        # 已有嵌入時換維度：拒絕，資料不動
+        with pytest.raises(RuntimeError):
+            schema.ensure_embedding_config(conn, new.model, new.dim)
+        assert schema.get_embedding_config(conn) == (old.model, old.dim)
+
+        assert reembed_memories.reembed(conn, new, batch_size=2) == 3
+        assert schema.get_embedding_config(conn) == (new.model, new.dim)
+        assert reembed_memories.reembed(conn, new, batch_size=2) == 0
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM lumi_memories WHERE vector_dims(embedding) = 128;")
+            assert cur.fetchone()[0] == 3
+        assert schema.ensure_vector_index(conn, 'hnsw')
+
+    os.environ['EMBEDDING_BACKEND'] = 'hashing'
+    os.environ['EMBEDDING_DIM'] = '128'
+    try:
+        memory = SimpleLumiMemory()
+    finally:
+        del os.environ['EMBEDDING_BACKEND'], os.environ['EMBEDDING_DIM']
+    memory.pool = pool
+    memory.profiles.pool = pool
+    memory.diaries.pool = pool
+    results = memory.get_similar_memories('u1', '上班好累喔', limit=2, similarity_threshold=0.3)
+    assert [m['user_message'] for m in results] == ['今天上班好累']
+    print("✅ 換維度後重新產生嵌入，搜尋使用新的後端")
+
+
+if __name__ == "__main__":
+    test_hashing_backend_is_deterministic_and_normalized()
+    print("✅ 嵌入後端測試通過（其餘測試請用 pytest 執行）")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+嵌入微批次測試（用假的 request_many，不需要 OpenAI）
+"""
+import threading
+
+import openai
+import pytest
+
+from embedding_batcher import EmbeddingBatcher
+
+
+def test_batcher_merges_concurrent_requests_and_isolates_errors():
+    """同時送出的請求合併成少數幾批，壞掉的那筆不影響其他人"""
+    calls = []
+
+    def request_many(texts):
+        calls.append(list(texts))
+        if 'BAD' in texts:
+            raise openai.error.InvalidRequestError("invalid input", 'input')
+        return [[float(len(t))] for t in texts]
+
+    batcher = EmbeddingBatcher(request_many, max_batch_size=32, max_wait_ms=50)
+    texts = ['BAD' if i == 5 else f"訊息{i}" for i in range(16)]
+    results = {}
+
+    def worker(text):
+        try:
+            results[text] = batcher.embed(text)
+        except openai.error.InvalidRequestError:
+            results[text] = 'error'
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in texts]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    assert results['BAD'] == 'error'
+    assert all(results[t] == [float(len(t))] for t in texts if t != 'BAD')
+    assert len(calls[0]) > 1
+    stats = batcher.get_stats()
+    assert stats['item_failures'] == 1
+    assert stats['split_retries'] == len(calls) - stats['batches']
+    print(f"✅ 微批次統計: {stats}")
+
+
+@pytest.mark.parametrize('error', [
+    openai.error.RateLimitError("rate limited"),
+    openai.error.Timeout("timed out"),
+    openai.error.APIConnectionError("connection reset"),
+])
+def test_transient_errors_fail_the_whole_batch_without_splitting(error):
+    """限流 / 逾時 / 連線錯誤不拆開重送，整批拿到同一個錯誤"""
+    calls = []
+
+    def request_many(texts):
+        calls.append(list(texts))
+        raise error
+
+    batcher = EmbeddingBatcher(request_many, max_batch_size=32, max_wait_ms=50)
+    futures = [batcher.submit(f"訊息{i}") for i in range(8)]
+    errors = [future.exception(timeout=5) for future in futures]
+    batcher.close()
+
+    assert all(e is error for e in errors)
+    assert len(calls) == batcher.get_stats()['batches']
+    stats = batcher.get_stats()
+    assert stats['split_retries'] == 0 and stats['item_failures'] == 8
+
+
+if __name__ == "__main__":
+    test_batcher_merges_concurrent_requests_and_isolates_errors()
+    test_transient_errors_fail_the_whole_batch_without_splitting(openai.error.RateLimitError("rate limited"))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+嵌入快取測試（只測 process 內 LRU，不需要資料庫或 OpenAI）
+"""
+from embedding_cache import EmbeddingCache
+
+
+def test_embedding_cache_hits_and_lru():
+    """同一段文字只計算一次，超過大小時淘汰最久沒用的"""
+    computed = []
+
+    def compute(text):
+        computed.append(text)
+        return [float(len(text))]
+
+    cache = EmbeddingCache(max_size=2, persist=False)
+    assert cache.get_or_compute('m', '哈哈', compute) == [2.0]
+    assert cache.get_or_compute('m', '哈哈', compute) == [2.0]
+    cache.get_or_compute('m', '早安', compute)
+    cache.get_or_compute('m', '晚安喔', compute)  # 淘汰「哈哈」
+    cache.get_or_compute('m', '哈哈', compute)
+
+    assert computed == ['哈哈', '早安', '晚安喔', '哈哈']
+    stats = cache.get_stats()
+    assert stats['memory_hits'] == 1
+    assert stats['evictions'] == 2
+    assert stats['size'] == 2
+    print(f"✅ 嵌入快取統計: {stats}")
+
+
+def test_embedding_cache_ttl_and_model_key():
+    """TTL 過期或換模型都要重新計算"""
+    computed = []
+    cache = EmbeddingCache(ttl_seconds=0, persist=False)
+    compute = lambda text: computed.append(text) or [1.0]
+    cache.get_or_compute('m', '早安', compute)
+    cache.get_or_compute('m', '早安', compute)
+    cache.get_or_compute('other-model', '早安', compute)
+    assert len(computed) == 3
+
+
+if __name__ == "__main__":
+    test_embedding_cache_hits_and_lru()
+    test_embedding_cache_ttl_and_model_key()
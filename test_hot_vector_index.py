@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+記憶體向量索引測試：搜尋排序、寫入後更新、LRU 與記憶體上限；有 LUMI_TEST_DATABASE_URL 時另外比對 pgvector 的精確搜尋
+"""
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+os.environ['EMBEDDING_BATCH_ENABLED'] = 'false'
+
+from hot_vector_index import HotVectorIndex
+from simple_memory import SimpleLumiMemory
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+TEST_DATABASE = 'lumi_hot_index_test'
+DIM = 64
+TS = datetime(2026, 10, 1, tzinfo=timezone.utc)
+
+
+def random_vectors(n, seed=0, dim=DIM):
+    vectors = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class FakePool:
+    """LOAD_SQL 的結果：(id, user_message, lumi_response, emotion_tag, timestamp, source_count, embedding, i8, scale)"""
+
+    def __init__(self, rows_by_user):
+        self.rows_by_user = rows_by_user
+        self.queries = 0
+
+    @contextmanager
+    def connection(self):
+        pool = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, sql, params):
+                pool.queries += 1
+                self.rows = pool.rows_by_user.get(params['user_id'], [])
+
+            def fetchall(self):
+                return self.rows
+
+        class Conn:
+            def cursor(self):
+                return Cursor()
+        yield Conn()
+
+
+def make_rows(vectors, summaries=()):
+    return [(i, f"訊息{i}", '回覆', None, TS, 5 if i in summaries else None, v, None, None)
+            for i, v in enumerate(vectors)]
+
+
+def test_search_orders_summaries_first_and_applies_threshold():
+    vectors = random_vectors(200)
+    index = HotVectorIndex(FakePool({'u1': make_rows(vectors, summaries={7})}))
+    assert index.search('u1', vectors[3], 3, 0.5) is None
+    assert index.load('u1') == 200
+
+    query = vectors[3] + 0.05 * random_vectors(1, seed=1)[0]
+    rows = index.search('u1', query, 3, 0.5)
+    assert [row[0] for row in rows] == [3]
+    assert rows[0][5] < 0.01 and rows[0][6] is None
+
+    # 摘要即使距離較遠也排在前面
+    near_summary = vectors[7] + 0.3 * random_vectors(1, seed=2)[0]
+    rows = index.search('u1', (near_summary / np.linalg.norm(near_summary) + vectors[3]) / 2, 5, 0.9)
+    assert rows[0][0] == 7 and rows[0][6] == 5
+    assert sorted(row[5] for row in rows[1:]) == [row[5] for row in rows[1:]]
+    print("✅ 記憶體索引搜尋：摘要優先、依距離排序")
+
+
+def test_append_updates_warm_users_and_loads_in_background():
+    vectors = random_vectors(10)
+    pool = FakePool({'u1': make_rows(vectors[:5])})
+    index = HotVectorIndex(pool)
+    index.append('u1', [(99, '還沒載入', '回覆', None, TS, None)], [vectors[9]])
+    assert index.get_stats()['users'] == 0
+
+    assert index.search('u1', vectors[0], 1, 0.5) is None
+    index._executor.submit(lambda: None).result()
+    assert index.get_stats()['users'] == 1 and pool.queries == 1
+
+    # 寫入的對話會加進矩陣（超過初始容量時擴充）
+    extra = random_vectors(30, seed=4)
+    index.append('u1', [(100 + i, f"新訊息{i}", '回覆', None, TS, None) for i in range(30)], extra)
+    rows = index.search('u1', extra[20], 1, 0.5)
+    assert rows[0][1] == '新訊息20'
+    assert index.get_stats()['rows'] == 35 and index.get_stats()['appended'] == 30
+
+
+def test_lru_and_memory_budget():
+    per_user = 20
+    pool = FakePool({f"u{i}": make_rows(random_vectors(per_user, seed=i, dim=256)) for i in range(4)})
+    index = HotVectorIndex(pool, max_bytes=1)
+    assert index.load('u0') == 0 and index.get_stats()['too_large'] == 1
+
+    index.max_bytes = 1 << 30
+    index.load('u0')
+    index.max_bytes = int(index.get_stats()['bytes'] * 2.5)
+    index.load('u1')
+    index.search('u0', random_vectors(1, dim=256)[0], 1, 0.5)  # u0 變成最近使用
+    index.load('u2')
+    stats = index.get_stats()
+    assert stats['users'] == 2 and stats['evictions'] == 1 and stats['bytes'] <= index.max_bytes
+    # 最久沒用的 u1 被淘汰
+    assert list(index._entries) == ['u0', 'u2']
+    print(f"✅ LRU 淘汰：{stats}")
+
+
+def test_memory_uses_hot_index_when_warm(monkeypatch):
+    vectors = random_vectors(5)
+    memory = SimpleLumiMemory()
+    memory._ensure_connection = lambda: True
+    memory.hot_index.pool = FakePool({'u1': make_rows(vectors)})
+    memory.hot_index.load('u1')
+    monkeypatch.setattr(memory, '_get_embedding', lambda text: vectors[2].tolist())
+
+    def fail(*args, **kwargs):
+        raise AssertionError("用戶已在記憶體中，不應查詢資料庫")
+    memory.pool = type('Pool', (), {'connection': fail})()
+    results = memory.get_similar_memories('u1', '查詢', limit=2)
+    assert [m['user_message'] for m in results] == ['訊息2'] and results[0]['similarity'] > 0.99
+    assert memory._fetch_similar_context('u1', '查詢', 2, 0.7)[0][0] == 2
+
+
+@pytest.fixture
+def pool():
+    import memory_partitions
+    import schema
+    from db_pool import PgConnectionPool
+    from test_query_plans import scratch_database, drop_database
+
+    pool = PgConnectionPool(scratch_database(TEST_DATABASE), min_size=1, max_size=2,
+                            on_connect=SimpleLumiMemory._configure_connection)
+    with pool.connection() as conn:
+        schema.apply_migrations(conn)
+        memory_partitions.ensure_partitions(conn, months_ahead=1)
+    yield pool
+    pool.close()
+    drop_database(TEST_DATABASE)
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_matches_pgvector_exact_search(pool, monkeypatch):
+    vectors = random_vectors(300, seed=7, dim=1536)
+    embeddings = {f"訊息{i}": v.tolist() for i, v in enumerate(vectors)}
+    memory = SimpleLumiMemory()
+    memory.pool = pool
+    memory.profiles.pool = pool
+    memory.diaries.pool = pool
+    memory.hot_index.pool = pool
+    monkeypatch.setattr(memory, '_get_embeddings', lambda texts: [embeddings[t] for t in texts])
+
+    now = datetime.now(timezone.utc)
+    records = [memory._make_record('u1', name, '回覆') for name in list(embeddings)[:250]]
+    for i, record in enumerate(records):
+        record['timestamp'] = now - timedelta(minutes=len(records) - i)
+    memory._insert_memories(records)
+    assert memory.hot_index.load('u1') == 250
+
+    # 載入之後寫入的對話也要找得到
+    later = [memory._make_record('u1', name, '回覆') for name in list(embeddings)[250:]]
+    memory._insert_memories(later)
+    assert memory.hot_index.get_stats()['rows'] == 300
+
+    for seed, target in ((11, 42), (12, 280)):
+        query = vectors[target] + 0.3 * random_vectors(1, seed=seed, dim=1536)[0]
+        with pool.connection() as conn, conn.cursor() as cur:
+            expected = memory._similar_rows(cur, 'u1', query.tolist(), 5, 0.1, "SET LOCAL enable_indexscan = off;")
+        actual = memory.hot_index.search('u1', query, 5, 0.9)
+        assert [row[0] for row in actual] == [row[0] for row in expected]
+        assert np.allclose([row[5] for row in actual], [row[5] for row in expected], atol=1e-4)
+    print("✅ 記憶體索引與 pgvector 精確搜尋結果相同")
+
+
+if __name__ == "__main__":
+    test_search_orders_summaries_first_and_applies_threshold()
+    test_append_updates_warm_users_and_loads_in_background()
+    test_lru_and_memory_budget()
+    print("✅ 記憶體向量索引測試通過（資料庫測試請設定 LUMI_TEST_DATABASE_URL 後用 pytest 執行）")
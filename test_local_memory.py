@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+本地儲存引擎測試（SQLite + mmap 嵌入檔，使用本地雜湊嵌入，不需要資料庫或 OpenAI）
+"""
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+
+import local_memory
+from local_memory import LocalLumiMemory, LocalMemoryStore
+
+MESSAGES = ["今天上班好累", "晚餐想吃拉麵", "我喜歡貓", "週末去爬山", "明天要考試好緊張"]
+
+
+@pytest.fixture
+def memory(tmp_path, monkeypatch):
+    monkeypatch.setenv('EMBEDDING_BACKEND', 'hashing')
+    monkeypatch.setenv('EMBEDDING_DIM', '256')
+    memory = LocalLumiMemory(str(tmp_path))
+    yield memory
+    memory.close()
+
+
+def store_all(memory, user_id='u1'):
+    for message in MESSAGES:
+        memory.store_conversation_memory(user_id, message, f"回覆：{message}", 'friend')
+
+
+def test_store_recent_similar_and_daily(memory):
+    store_all(memory)
+    memory.store_conversation_memory('u2', '今天上班好累', '別人的對話')
+
+    recent = memory.get_recent_memories('u1', limit=2)
+    assert [m['user_message'] for m in recent] == MESSAGES[-2:]
+
+    similar = memory.get_similar_memories('u1', '上班好累喔', limit=3, similarity_threshold=0.3)
+    assert [m['user_message'] for m in similar] == ['今天上班好累']
+    assert 0.3 < similar[0]['similarity'] < 1
+
+    today = memory.get_user_today('u1')
+    daily = memory.get_daily_memories('u1', today)
+    assert [m['user_message'] for m in daily] == MESSAGES
+    assert memory.get_daily_memories('u1', today, since=daily[2]['timestamp'])[0]['user_message'] == MESSAGES[3]
+
+    stats = memory.get_memory_statistics('u1')
+    assert stats['total_conversations'] == 5 and stats['weekly_interactions'] == 5
+    assert stats['emotion_distribution'] == {'friend': 5}
+    assert memory.get_memory_summary('u2')['total_memories'] == 1
+    # 與 SimpleLumiMemory 相同：datetime.isoformat() 的字串
+    last = datetime.fromisoformat(stats['last_interaction'])
+    assert stats['last_interaction'] == last.isoformat() == memory.get_memory_summary('u1')['last_interaction']
+    assert last.tzinfo is not None and last == datetime.fromisoformat(recent[-1]['timestamp'])
+    assert memory.get_user_emotion_patterns('u1') == {'dominant_emotion': 'friend', 'total_interactions': 5}
+    assert [m['user_message'] for m in memory.get_user_profile_memories('u1')] == ['我喜歡貓']
+    assert memory.get_pool_stats()['memories'] == 6
+    print("✅ 本地儲存：寫入、最近對話、相似搜尋與每日記憶")
+
+
+def test_get_context_profiles_and_diaries(memory):
+    store_all(memory)
+    memory.store_conversation_memory('u1', '我叫小明', '小明你好')
+    assert memory.get_user_profile_name('u1') == '小明'
+    memory.update_user_profile('u1', timezone='Asia/Tokyo')
+    memory.profiles.invalidate()
+    assert memory.get_user_profile('u1') == {'name': '小明', 'attributes': {'timezone': 'Asia/Tokyo'}}
+
+    context = memory.get_context('u1', '我喜歡貓咪', recent_limit=2, similar_limit=2, similarity_threshold=0.3)
+    assert context['profile_name'] == '小明'
+    assert [m['user_message'] for m in context['recent_memories']] == ['明天要考試好緊張', '我叫小明']
+    assert [m['user_message'] for m in context['similar_memories']] == ['我喜歡貓']
+    assert context['timed_out'] == []
+
+    today = memory.get_user_today('u1')
+    assert memory.get_stale_diary_users(today) == ['u1']
+    last = memory.get_daily_memories('u1', today)[-1]['timestamp']
+    assert memory.save_daily_diary('u1', today, '今天的日記', last, 6)
+    assert memory.get_daily_diary('u1', today)['diary'] == '今天的日記'
+    # 舊版本不會覆蓋新版本
+    older = (datetime.fromisoformat(last) - timedelta(minutes=1)).isoformat()
+    assert not memory.save_daily_diary('u1', today, '舊的日記', older, 3)
+    assert memory.get_stale_diary_users(today) == []
+    with memory.diary_precompute_lock() as locked:
+        assert locked
+        with memory.diary_precompute_lock() as again:
+            assert not again
+
+
+def test_hot_index_and_reopen(memory, tmp_path):
+    store_all(memory)
+    assert memory.get_similar_memories('u1', '晚餐吃拉麵', limit=1, similarity_threshold=0.3)
+    memory.hot_index._executor.submit(lambda: None).result()
+    assert memory.get_hot_index_stats()['users'] == 1
+    memory.store_conversation_memory('u1', '晚餐吃拉麵好了', '好喔')
+    started = time.perf_counter()
+    similar = memory.get_similar_memories('u1', '晚餐吃拉麵', limit=2, similarity_threshold=0.3)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    assert {m['user_message'] for m in similar} == {'晚餐想吃拉麵', '晚餐吃拉麵好了'}
+    assert memory.get_hot_index_stats()['hits'] == 1
+    print(f"✅ 記憶體索引命中，相似搜尋 {elapsed_ms:.3f} ms")
+
+    # 重新開啟後資料還在；換維度時拒絕開啟
+    memory.close()
+    reopened = LocalLumiMemory(str(tmp_path))
+    assert len(reopened.get_recent_memories('u1', limit=10)) == 6
+    reopened.close()
+    with pytest.raises(RuntimeError):
+        LocalMemoryStore(str(tmp_path), 'hashing-char13-128', 128)
+
+
+def test_insert_skips_failed_embeddings_and_survives_hot_index_errors(memory, monkeypatch):
+    """無法生成嵌入的記錄回傳給呼叫端重試，其餘照常寫入；寫入後更新索引失敗不會讓記錄被重寫"""
+    memory.store_conversation_memory('u1', MESSAGES[4], '回覆')
+    records = [memory._make_record('u1', message, '回覆') for message in MESSAGES[:3]]
+    get_embeddings = memory._get_embeddings
+    monkeypatch.setattr(memory, '_get_embeddings', lambda texts: [
+        None if text == MESSAGES[1] else embedding for text, embedding in zip(texts, get_embeddings(texts))])
+    memory.hot_index.load('u1')
+    assert memory.get_hot_index_stats()['users'] == 1
+
+    def broken_append(*args):
+        raise RuntimeError("index broken")
+
+    monkeypatch.setattr(memory.hot_index, 'append', broken_append)
+    failed = memory._insert_memories(records)
+    assert [r['user_message'] for r in failed] == [MESSAGES[1]]
+    recent = memory.get_recent_memories('u1', limit=10)
+    assert [m['user_message'] for m in recent] == [MESSAGES[4], MESSAGES[0], MESSAGES[2]]
+    assert memory.get_hot_index_stats()['users'] == 0
+
+
+def test_stale_diary_users_follow_user_timezone(memory):
+    # 2024-01-03 01:00 UTC：紐約是 1/2 晚上，台北（預設時區）已經是 1/3 早上
+    at = datetime(2024, 1, 3, 1, tzinfo=timezone.utc)
+    records = [memory._make_record(user_id, '晚安', '晚安') for user_id in ('tz_ny', 'tz_default')]
+    for record in records:
+        record['timestamp'] = at
+    memory._insert_memories(records)
+    memory.update_user_profile('tz_ny', timezone='America/New_York')
+
+    assert memory.get_stale_diary_users('2024-01-02') == ['tz_ny']
+    assert memory.get_stale_diary_users('2024-01-03') == ['tz_default']
+
+
+def test_embedding_file_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(local_memory, 'INITIAL_ROWS', 4)
+    store = LocalMemoryStore(str(tmp_path), 'test', 8)
+    vectors = np.random.default_rng(0).standard_normal((10, 8)).astype(np.float32)
+    now = datetime.now(timezone.utc)
+    ids = store.insert([('u1', f"訊息{i}", '回覆', None, now, []) for i in range(10)], vectors)
+    assert ids == list(range(1, 11)) and len(store.vectors()) >= 10
+    rows = store.search('u1', vectors[7], 1, 0.5)
+    assert rows[0][:2] == (8, '訊息7') and rows[0][5] < 1e-5
+    store.close()
+
+
+def test_engine_selection(monkeypatch, tmp_path):
+    import simple_memory
+
+    monkeypatch.setenv('LOCAL_MEMORY_DIR', str(tmp_path))
+    monkeypatch.setenv('EMBEDDING_BACKEND', 'hashing')
+    memory = simple_memory.create_memory()
+    assert isinstance(memory, LocalLumiMemory) and memory.store
+    memory.close()
+    monkeypatch.setenv('MEMORY_ENGINE', 'postgres')
+    assert type(simple_memory.create_memory()) is simple_memory.SimpleLumiMemory
+
+
+if __name__ == "__main__":
+    print("請用 pytest 執行：python -m pytest -q test_local_memory.py")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+日誌設定測試：等級、per-user 取樣、JSON 輸出與 user_id 遮蔽
+"""
+import io
+import json
+import logging
+
+from lumi_logging import setup_logging, log_user, mask_user, user_sampled
+
+
+def make_logger(**kwargs):
+    stream = io.StringIO()
+    handler = setup_logging(stream=stream, **kwargs)
+    return logging.getLogger('test_lumi_logging'), stream, handler
+
+
+def teardown(handler):
+    logging.getLogger().removeHandler(handler)
+
+
+def test_json_output_masks_user_id():
+    """JSON 每行一筆，只輸出雜湊後的用戶代號"""
+    logger, stream, handler = make_logger(level='INFO', fmt='json', sample_rate=1.0)
+    try:
+        logger.info("回覆完成 total_ms=%.2f", 12.345, extra=log_user('U123', recent=3))
+        payload = json.loads(stream.getvalue().strip())
+        assert payload['msg'] == "回覆完成 total_ms=12.35"
+        assert payload['level'] == 'INFO'
+        assert payload['recent'] == 3
+        assert payload['user'] == mask_user('U123')
+        assert 'U123' not in stream.getvalue()
+        print(f"✅ JSON 日誌: {payload}")
+    finally:
+        teardown(handler)
+
+
+def test_debug_is_lazy_at_info_level():
+    """等級沒開時不會格式化參數（對話內容不會被轉成字串）"""
+    formatted = []
+
+    class Content:
+        def __repr__(self):
+            formatted.append(True)
+            return '內容'
+
+    logger, stream, handler = make_logger(level='INFO', fmt='text', sample_rate=1.0)
+    try:
+        logger.debug("收到訊息: %r", Content())
+        assert formatted == []
+        assert stream.getvalue() == ''
+    finally:
+        teardown(handler)
+
+
+def test_user_sampling_is_per_user():
+    """取樣以用戶為單位；WARNING 以上不受取樣影響"""
+    users = [f"U{i}" for i in range(200)]
+    sampled = [u for u in users if user_sampled(u, 0.25)]
+    assert 20 < len(sampled) < 80
+    assert sampled == [u for u in users if user_sampled(u, 0.25)]
+
+    dropped = next(u for u in users if not user_sampled(u, 0.25))
+    logger, stream, handler = make_logger(level='DEBUG', fmt='text', sample_rate=0.25)
+    try:
+        logger.info("耗時", extra=log_user(dropped))
+        logger.info("耗時", extra=log_user(sampled[0]))
+        logger.warning("失敗", extra=log_user(dropped))
+        lines = stream.getvalue().strip().splitlines()
+        assert len(lines) == 2
+        assert mask_user(sampled[0]) in lines[0]
+        assert 'WARNING' in lines[1]
+    finally:
+        teardown(handler)
+
+
+if __name__ == "__main__":
+    test_json_output_masks_user_id()
+    test_debug_is_lazy_at_info_level()
+    test_user_sampling_is_per_user()
+    print("✅ 所有日誌設定測試通過")
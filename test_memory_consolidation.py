@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+記憶整併測試：NumPy 分群與整併計畫；有 LUMI_TEST_DATABASE_URL 時另外測試寫入摘要與摘要優先的相似度搜尋
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import memory_consolidation as mc
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+TEST_DATABASE = 'lumi_consolidation_test'
+DIM = 1536
+START = datetime(2026, 6, 1, tzinfo=timezone.utc)
+
+
+def topic_vector(topic, noise=0.0, seed=0):
+    """同一個 topic 的向量彼此接近（noise 越小越像）"""
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[topic] = 1.0
+    if noise:
+        vector += np.random.default_rng(seed).normal(0, noise, DIM).astype(np.float32)
+    return vector
+
+
+def make_turns(topics):
+    return [{'id': i + 1, 'timestamp': START + timedelta(hours=i), 'user_message': f"話題{t}-{i}",
+             'lumi_response': f"回覆{i}", 'emotion_tag': 'tired' if t == 0 else None,
+             'embedding': topic_vector(t, 0.005, seed=i)}
+            for i, t in enumerate(topics)]
+
+
+def test_greedy_clusters_group_similar_vectors():
+    vectors = [topic_vector(t, 0.005, seed=i) for i, t in enumerate([0, 1, 0, 2, 1, 0])]
+    labels, sums, sizes = mc.greedy_clusters(vectors, 0.9)
+    assert labels.tolist() == [0, 1, 0, 2, 1, 0]
+    assert sizes.tolist() == [3, 2, 1]
+    assert np.allclose(sums[0] / np.linalg.norm(sums[0]), topic_vector(0), atol=0.05)
+
+
+def test_plan_creates_summaries_and_extends_existing():
+    turns = make_turns([0, 0, 0, 0, 1, 1, 2])
+    plan = mc.plan_consolidation(turns, [], threshold=0.9, min_cluster_size=3)
+    assert len(plan['created']) == 1 and plan['updated'] == []
+    summary = plan['created'][0]
+    assert summary['source_count'] == 4
+    assert summary['emotion_tag'] == 'tired'
+    assert summary['user_message'].startswith('話題0-')
+    assert [m[0] for m in summary['members']] == [1, 2, 3, 4]
+    assert (summary['first_at'], summary['last_at']) == (turns[0]['timestamp'], turns[3]['timestamp'])
+    assert plan['consolidated'] == 4
+
+    # 之後的對話加入既有的摘要，而不是另外建立
+    existing = [{'id': 7, 'embedding': summary['embedding'], 'source_count': 4,
+                 'first_at': summary['first_at'], 'last_at': summary['last_at']}]
+    later = make_turns([0, 3])
+    plan = mc.plan_consolidation(later, existing, threshold=0.9, min_cluster_size=3)
+    assert plan['created'] == []
+    assert [(u['id'], u['source_count'], u['members']) for u in plan['updated']] == \
+        [(7, 5, [(1, later[0]['timestamp'])])]
+    print("✅ 相似的對話合併成一筆摘要")
+
+
+def test_watermark_stops_before_unsettled_singletons():
+    turns = make_turns([0, 0, 0, 1, 0, 2])
+    plan = mc.plan_consolidation(turns, [], threshold=0.9, min_cluster_size=3)
+    # 第 4 筆（話題 1）沒有成群，還在沉澱期：進度停在它之前，下一輪再和新的對話一起分群
+    assert mc.next_watermark(turns, plan, settle_before=START) == turns[2]['timestamp']
+    # 超過沉澱期的單筆對話可以越過
+    assert mc.next_watermark(turns, plan, settle_before=START + timedelta(days=1)) == turns[-1]['timestamp']
+    # 第一筆就還不能越過時進度不變
+    assert mc.next_watermark(make_turns([1, 0]), {'created': [], 'updated': []}, START) is None
+
+
+@pytest.fixture
+def memory():
+    from psycopg2.extras import execute_values
+    import memory_partitions
+    import schema
+    from db_pool import PgConnectionPool
+    from simple_memory import SimpleLumiMemory
+    from test_query_plans import scratch_database, drop_database
+
+    os.environ.pop('DATABASE_URL', None)
+    os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+    os.environ['EMBEDDING_BATCH_ENABLED'] = 'false'
+
+    pool = PgConnectionPool(scratch_database(TEST_DATABASE), min_size=1, max_size=2,
+                            on_connect=SimpleLumiMemory._configure_connection)
+    with pool.connection() as conn:
+        schema.apply_migrations(conn)
+        turns = make_turns([0] * 6 + [1, 2])
+        memory_partitions.ensure_partitions(conn, months=[memory_partitions.month_start(START)])
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO lumi_memories (user_id, user_message, lumi_response, emotion_tag, timestamp, embedding)
+                VALUES %s;
+            """, [('u1', t['user_message'], t['lumi_response'], t['emotion_tag'], t['timestamp'], t['embedding'])
+                  for t in turns])
+
+    memory = SimpleLumiMemory()
+    memory.pool = pool
+    memory.profiles.pool = pool
+    memory.diaries.pool = pool
+    yield memory
+    pool.close()
+    drop_database(TEST_DATABASE)
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_consolidation_and_summary_first_search(memory, monkeypatch):
+    now = START + timedelta(days=60)
+    consolidator = mc.MemoryConsolidator(lambda: memory.pool, min_age_days=30, min_new_turns=3)
+    assert consolidator.run_once(now=now) == 1
+    stats = consolidator.get_stats()
+    assert (stats['summaries_created'], stats['turns_consolidated']) == (1, 6)
+    # 進度已記錄，沒有新的舊對話時不會再處理
+    assert consolidator.run_once(now=now) == 0
+
+    monkeypatch.setattr(memory, '_get_embedding', lambda text: topic_vector(0).tolist())
+    memories = memory.get_similar_memories('u1', '好累', limit=3, similarity_threshold=0.5)
+    assert len(memories) == 1
+    assert memories[0]['source_count'] == 6
+    assert '類似的話說過 6 次' in memories[0]['user_message']
+
+    # 摘要沒有命中時改用尚未整併的對話
+    monkeypatch.setattr(memory, '_get_embedding', lambda text: topic_vector(1).tolist())
+    memories = memory.get_similar_memories('u1', '別的話題', limit=3, similarity_threshold=0.5)
+    assert [m['user_message'] for m in memories] == ['話題1-6']
+    assert 'source_count' not in memories[0]
+    print("✅ 相似度搜尋先找摘要，再用未整併的對話補上")
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_singletons_merge_with_turns_from_a_later_run(memory):
+    from psycopg2.extras import execute_values
+
+    now = START + timedelta(days=60)
+    consolidator = mc.MemoryConsolidator(lambda: memory.pool, min_age_days=30, min_new_turns=1)
+    assert consolidator.run_once(now=now) == 1
+    assert consolidator.get_stats()['summaries_created'] == 1
+
+    # 之後才變舊的兩筆話題 1，和上一輪沒有成群的那筆合成一群
+    later = [START + timedelta(days=1, hours=i) for i in range(2)]
+    with memory.pool.connection() as conn, conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO lumi_memories (user_id, user_message, lumi_response, timestamp, embedding)
+            VALUES %s;
+        """, [('u1', f"話題1-後來{i}", '回覆', ts, topic_vector(1, 0.005, seed=100 + i))
+              for i, ts in enumerate(later)])
+    assert consolidator.run_once(now=now) == 1
+    stats = consolidator.get_stats()
+    assert (stats['summaries_created'], stats['turns_consolidated']) == (2, 9)
+    assert consolidator.run_once(now=now) == 0
+    print("✅ 不同輪出現的相似對話也能合併")
+
+
+if __name__ == "__main__":
+    test_greedy_clusters_group_similar_vectors()
+    test_plan_creates_summaries_and_extends_existing()
+    test_watermark_stops_before_unsettled_singletons()
+    print("✅ 記憶整併測試通過（資料庫測試請設定 LUMI_TEST_DATABASE_URL 後用 pytest 執行）")
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+每月分區測試：月份計算與保留期限；有 LUMI_TEST_DATABASE_URL 時另外測試建立分區與封存
+"""
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import memory_partitions as mp
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+TEST_DATABASE = 'lumi_partition_test'
+
+
+def test_month_helpers():
+    assert mp.month_start(datetime(2026, 10, 31, 20, tzinfo=timezone(timedelta(hours=-8)))) == date(2026, 11, 1)
+    assert mp.add_months(date(2026, 11, 1), 3) == date(2027, 2, 1)
+    assert mp.add_months(date(2026, 1, 1), -1) == date(2025, 12, 1)
+    assert mp.partition_name(date(2027, 2, 1)) == 'lumi_memories_p202702'
+
+
+def test_expired_partitions_keep_retention_window():
+    partitions = [(mp.partition_name(date(2025, m, 1)), date(2025, m, 1)) for m in range(1, 13)]
+    now = datetime(2025, 12, 15, tzinfo=timezone.utc)
+    expired = mp.expired_partitions(partitions, 3, now)
+    assert [name for name, _ in expired] == [f'lumi_memories_p2025{m:02d}' for m in range(1, 9)]
+    print("✅ 保留本月與之前 3 個月")
+
+
+@pytest.fixture
+def conn():
+    import psycopg2
+    import schema
+    from test_query_plans import scratch_database, drop_database
+
+    conn = psycopg2.connect(scratch_database(TEST_DATABASE))
+    conn.autocommit = True
+    schema.apply_migrations(conn)
+    yield conn
+    conn.close()
+    drop_database(TEST_DATABASE)
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_ensure_and_archive(conn, tmp_path):
+    now = datetime(2026, 10, 18, tzinfo=timezone.utc)
+    created = mp.ensure_partitions(conn, months_ahead=2, now=now,
+                                   months=[date(2026, 6, 1), date(2026, 7, 1), date(2026, 10, 1)])
+    assert 'lumi_memories_p202606' in created
+    assert mp.ensure_partitions(conn, months=[date(2026, 6, 1)]) == []
+
+    with conn.cursor() as cur:
+        for day in (datetime(2026, 6, 3, tzinfo=timezone.utc), datetime(2026, 6, 30, 23, tzinfo=timezone.utc),
+                    datetime(2026, 10, 1, tzinfo=timezone.utc)):
+            cur.execute("""
+                INSERT INTO lumi_memories (user_id, user_message, lumi_response, timestamp)
+                VALUES ('u1', '多行\n訊息, "引號"', '回覆', %s);
+            """, (day,))
+
+    manifests = mp.apply_retention(conn, 3, str(tmp_path), now=now)
+    assert [m['partition'] for m in manifests] == ['lumi_memories_p202606']
+    assert manifests[0]['rows'] == 2
+    assert 'lumi_memories_p202606' not in [name for name, _ in mp.list_partitions(conn)]
+    assert 'lumi_memories_p202607' in [name for name, _ in mp.list_partitions(conn)]
+
+    with gzip.open(tmp_path / 'lumi_memories_p202606.csv.gz', 'rt', encoding='utf-8') as f:
+        content = f.read()
+    assert content.startswith('id,user_id,')
+    assert '"多行\n訊息, ""引號"""' in content
+    assert json.loads((tmp_path / 'lumi_memories_p202606.json').read_text())['rows'] == 2
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM lumi_memories;")
+        assert cur.fetchone()[0] == 1
+    print("✅ 過期分區已匯出並移除")
+
+
+if __name__ == "__main__":
+    test_month_helpers()
+    test_expired_partitions_keep_retention_window()
+    print("✅ 分區測試通過（資料庫測試請設定 LUMI_TEST_DATABASE_URL 後用 pytest 執行）")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+延遲追蹤與 Prometheus 指標測試
+"""
+import time
+
+from metrics import MetricsRegistry
+
+
+def test_span_records_histogram_and_errors():
+    """span 結束時記錄耗時，拋出例外時累計錯誤"""
+    registry = MetricsRegistry()
+    for _ in range(3):
+        with registry.span('llm'):
+            time.sleep(0.002)
+    try:
+        with registry.span('llm'):
+            raise RuntimeError("timeout")
+    except RuntimeError:
+        pass
+
+    summary = registry.get_summary()['stages']['llm']
+    assert summary['count'] == 4
+    assert summary['errors'] == 1
+    assert summary['p99_ms'] >= summary['p50_ms'] >= 0
+    print(f"✅ llm 階段統計: {summary}")
+
+
+def test_percentiles_from_recent_samples():
+    """p50 / p95 / p99 來自最近的樣本"""
+    registry = MetricsRegistry()
+    for ms in range(1, 101):
+        registry.observe('db.recent_context', ms / 1000)
+    summary = registry.get_summary()['stages']['db.recent_context']
+    assert 49 <= summary['p50_ms'] <= 52
+    assert 94 <= summary['p95_ms'] <= 96
+    assert 98 <= summary['p99_ms'] <= 100
+
+
+def test_prometheus_exposition():
+    """buckets 累計、+Inf 等於 count，計數器與 gauge 也會輸出"""
+    registry = MetricsRegistry()
+    registry.observe('embedding.api', 0.03)
+    registry.observe('embedding.api', 0.2)
+    registry.observe('embedding.api', 50.0)
+    registry.inc('retrieval_timeouts', stage='similar')
+    registry.register_gauge('db_pool_in_use', lambda: 2)
+    registry.register_gauge('broken', lambda: 1 / 0)
+
+    text = registry.render_prometheus()
+    assert 'lumi_stage_duration_seconds_bucket{stage="embedding.api",le="0.05"} 1' in text
+    assert 'lumi_stage_duration_seconds_bucket{stage="embedding.api",le="0.25"} 2' in text
+    assert 'lumi_stage_duration_seconds_bucket{stage="embedding.api",le="30.0"} 2' in text
+    assert 'lumi_stage_duration_seconds_bucket{stage="embedding.api",le="+Inf"} 3' in text
+    assert 'lumi_stage_duration_seconds_count{stage="embedding.api"} 3' in text
+    assert 'lumi_retrieval_timeouts_total{stage="similar"} 1' in text
+    assert 'lumi_db_pool_in_use 2' in text
+    assert 'lumi_broken' not in text
+
+
+def test_timed_decorator_keeps_return_value():
+    registry = MetricsRegistry()
+
+    @registry.timed('db.daily_memories')
+    def query(x):
+        return x * 2
+
+    assert query(21) == 42
+    assert registry.get_summary()['stages']['db.daily_memories']['count'] == 1
+
+
+def test_timed_handler_dispatch_by_line_sdk():
+    """掛上 timed 的 handler 交給 WebhookHandler 時，只會收到 event（不會多傳 destination）"""
+    import base64
+    import hashlib
+    import hmac
+    import json
+
+    from linebot.v3 import WebhookHandler
+    from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+    registry = MetricsRegistry()
+    handler = WebhookHandler('secret')
+    received = []
+
+    @handler.add(MessageEvent, message=TextMessageContent)
+    @registry.timed('handle_message')
+    def handle_message(event):
+        received.append(event.message.text)
+
+    body = json.dumps({'destination': 'U0', 'events': [{
+        'type': 'message', 'mode': 'active', 'timestamp': 1700000000000,
+        'source': {'type': 'user', 'userId': 'U1'}, 'replyToken': 'r',
+        'webhookEventId': 'e1', 'deliveryContext': {'isRedelivery': False},
+        'message': {'type': 'text', 'id': '1', 'text': 'hi', 'quoteToken': 'q'},
+    }]})
+    signature = base64.b64encode(hmac.new(b'secret', body.encode(), hashlib.sha256).digest()).decode()
+    handler.handle(body, signature)
+
+    assert received == ['hi']
+    assert registry.get_summary()['stages']['handle_message']['count'] == 1
+
+
+if __name__ == "__main__":
+    test_span_records_histogram_and_errors()
+    test_percentiles_from_recent_samples()
+    test_prometheus_exposition()
+    test_timed_decorator_keeps_return_value()
+    test_timed_handler_dispatch_by_line_sdk()
+    print("✅ 所有指標測試通過")
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+個人資料標籤測試（不需要資料庫）
+"""
+import json
+
+import profile_tags
+
+
+def test_extract_profile_tags_default_keywords(monkeypatch):
+    """預設關鍵詞：標籤就是關鍵詞，英文不分大小寫"""
+    monkeypatch.delenv('PROFILE_KEYWORDS_FILE', raising=False)
+    monkeypatch.delenv('PROFILE_KEYWORDS', raising=False)
+    keywords = profile_tags.load_profile_keywords()
+    assert profile_tags.extract_profile_tags("我喜歡在工作後去運動", keywords) == sorted(['喜歡', '工作', '運動'])
+    assert profile_tags.extract_profile_tags("我的 EMAIL 換了", keywords) == ['email']
+    assert profile_tags.extract_profile_tags("早安", keywords) == []
+
+
+def test_profile_keywords_from_file(tmp_path, monkeypatch):
+    """可以用 JSON 檔把多個關鍵詞歸到同一個標籤"""
+    path = tmp_path / "keywords.json"
+    path.write_text(json.dumps({"寵物": ["貓", "狗"], "飲食": ["吃"]}, ensure_ascii=False), encoding='utf-8')
+    monkeypatch.setenv('PROFILE_KEYWORDS_FILE', str(path))
+    keywords = profile_tags.load_profile_keywords()
+    assert profile_tags.extract_profile_tags("我家的貓很愛吃", keywords) == ['寵物', '飲食']
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__, '-q'])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+prompt 組裝測試：跨段落去重、排序、token 預算與報告
+"""
+from prompt_builder import PromptBuilder, count_tokens, truncate_to_tokens
+
+
+def memory(user_message, lumi_response, similarity=None):
+    m = {'user_message': user_message, 'lumi_response': lumi_response, 'timestamp': None}
+    if similarity is not None:
+        m['similarity'] = similarity
+    return m
+
+
+def test_duplicates_kept_in_highest_priority_section():
+    """同一輪對話出現在多個段落時，只保留在最近對話"""
+    builder = PromptBuilder(budgets={'recent': 1000, 'profile': 1000, 'similar': 1000})
+    turn = memory("我喜歡貓", "貓很可愛")
+    context, report = builder.build_memory_context({
+        'recent': [turn],
+        'profile': [dict(turn), memory("我在台北工作", "通勤辛苦了")],
+        'similar': [memory(" 我喜歡貓 ", "貓很可愛", 0.9), memory("我討厭下雨", "下雨好煩", 0.8)],
+    })
+    assert context.count("我喜歡貓") == 1
+    assert "我在台北工作" in context and "我討厭下雨" in context
+    assert report['duplicates'] == 2
+    assert report['entries'] == {'recent': 1, 'profile': 1, 'similar': 1}
+    print(f"✅ 去重報告: {report}")
+
+
+def test_budget_keeps_most_important_entries():
+    """預算不足時：最近對話保留最新的（仍依時間正序呈現），相似對話保留相似度最高的"""
+    recent = [memory(f"第{i}句話", f"回覆{i}") for i in range(1, 6)]
+    similar = [memory("低相似", "x", 0.71), memory("高相似", "y", 0.95)]
+    line_tokens = count_tokens("用戶: 第1句話\nLumi: 回覆1\n")
+    header_tokens = count_tokens("\n\n【最近的對話歷史】\n")
+    builder = PromptBuilder(budgets={
+        'recent': header_tokens + line_tokens * 2,
+        'profile': 0,
+        'similar': count_tokens("\n\n【相關歷史對話】\n") + count_tokens("高相似 → y\n"),
+    })
+    context, report = builder.build_memory_context({'recent': recent, 'similar': similar})
+
+    assert "第3句話" not in context
+    assert context.index("第4句話") < context.index("第5句話")
+    assert "高相似" in context and "低相似" not in context
+    assert report['over_budget'] == 4
+    assert report['tokens']['recent'] <= builder.budgets['recent']
+
+
+def test_build_reports_tokens_per_section():
+    builder = PromptBuilder()
+    prompt, report = builder.build("人格設定", {'recent': [memory("早安", "早安呀")]}, "今天好累", "規則")
+    assert prompt.startswith("人格設定\n\n【最近的對話歷史】\n用戶: 早安\nLumi: 早安呀\n")
+    assert prompt.endswith("\n\n用戶訊息：今天好累\n\n規則")
+    tokens = report['tokens']
+    assert tokens['total'] == sum(v for k, v in tokens.items() if k != 'total')
+    assert tokens['profile'] == 0 and tokens['recent'] > 0
+
+
+def test_long_entries_are_truncated():
+    assert truncate_to_tokens("短句", 10) == "短句"
+    cut = truncate_to_tokens("一" * 500, 20)
+    assert cut.endswith("…") and count_tokens(cut) <= 20
+
+    builder = PromptBuilder(entry_max_tokens=40)
+    context, _ = builder.build_memory_context({'recent': [memory("長" * 300, "好")]})
+    assert count_tokens(context) < 60
+
+
+if __name__ == "__main__":
+    test_duplicates_kept_in_highest_priority_section()
+    test_budget_keeps_most_important_entries()
+    test_build_reports_tokens_per_section()
+    test_long_entries_are_truncated()
+    print("✅ 所有 prompt 組裝測試通過")
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+查詢計畫回歸測試：對 SimpleLumiMemory 實際送出的每個依用戶查詢執行 EXPLAIN，
+確認走 (user_id, timestamp) / (user_id, emotion_tag, timestamp) 複合索引：時間範圍是索引條件、
+ORDER BY timestamp LIMIT 不需要排序，只取計數或最大值的查詢為 Index Only Scan。
+
+需要有 pgvector 的 Postgres（會另外建立一個暫時的資料庫，不影響既有資料）：
+    LUMI_TEST_DATABASE_URL=postgresql://... python -m pytest -q test_query_plans.py
+"""
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+if not DSN:
+    pytest.skip("未設定 LUMI_TEST_DATABASE_URL", allow_module_level=True)
+
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+os.environ['EMBEDDING_BATCH_ENABLED'] = 'false'
+
+import memory_partitions
+import schema
+from db_pool import PgConnectionPool
+from simple_memory import SimpleLumiMemory
+
+TEST_DATABASE = 'lumi_plan_test'
+USERS = 300
+TURNS_PER_USER = 40
+EMOTIONS = ['happy', 'sad', 'angry', 'calm', None]
+# lumi_memories 為分區表，計畫中出現的是各分區自動建立的索引（<分區>_user_id_timestamp_idx 等）
+COMPOSITE_INDEX_SUFFIXES = ('_user_id_timestamp_idx', '_user_id_emotion_tag_timestamp_idx')
+
+executed = []
+empty_partitions = set()
+
+
+class RecordingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        executed.append((query, vars))
+        return super().execute(query, vars)
+
+
+def scratch_database(name):
+    """重新建立一個空的資料庫（含 vector 擴展），回傳連線字串"""
+    admin = psycopg2.connect(DSN)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE);")
+        cur.execute(f"CREATE DATABASE {name};")
+    admin.close()
+    dsn = psycopg2.extensions.make_dsn(DSN, dbname=name)
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    conn.close()
+    return dsn
+
+
+def drop_database(name):
+    admin = psycopg2.connect(DSN)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE);")
+    admin.close()
+
+
+def configure(conn):
+    register_vector(conn)
+    conn.cursor_factory = RecordingCursor
+
+
+@pytest.fixture(scope='module')
+def memory():
+    pool = PgConnectionPool(scratch_database(TEST_DATABASE), min_size=1, max_size=2, on_connect=configure)
+    with pool.connection() as conn:
+        schema.apply_migrations(conn)
+        now = datetime.now(timezone.utc)
+        rows = [(f"user{u}", f"訊息{t}", f"回覆{t}", EMOTIONS[t % len(EMOTIONS)], now - timedelta(hours=t * 60))
+                for u in range(USERS) for t in range(TURNS_PER_USER)]
+        memory_partitions.ensure_partitions(conn, months=[memory_partitions.month_start(r[4]) for r in rows])
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO lumi_memories (user_id, user_message, lumi_response, emotion_tag, timestamp)
+                VALUES %s;
+            """, rows)
+            cur.execute("VACUUM ANALYZE lumi_memories;")
+            # 未來月份的分區是空的，規劃器對空表一律選 Seq Scan，不列入檢查
+            cur.execute("""
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'lumi_memories'::regclass AND c.reltuples <= 0;
+            """)
+            empty_partitions.update(row[0] for row in cur.fetchall())
+
+    memory = SimpleLumiMemory()
+    memory.pool = pool
+    memory.profiles.pool = pool
+    memory.diaries.pool = pool
+    yield memory
+    pool.close()
+    drop_database(TEST_DATABASE)
+
+
+def plan_nodes(memory, query, vars, analyze=False):
+    options = "ANALYZE, FORMAT JSON" if analyze else "FORMAT JSON"
+    with memory.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(f"EXPLAIN ({options}) " + query.strip().rstrip(';'), vars)
+        plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = []
+
+    def walk(node):
+        nodes.append(node)
+        for child in node.get('Plans', []):
+            walk(child)
+    walk(plan[0]['Plan'])
+    return nodes
+
+
+def on_empty_partition(node):
+    relation = node.get('Relation Name') or ''
+    index = node.get('Index Name') or ''
+    return relation in empty_partitions or any(index.startswith(p + '_') for p in empty_partitions)
+
+
+def explain_calls(memory, call):
+    """執行 call()，回傳期間送出的 lumi_memories 查詢與其計畫節點"""
+    executed.clear()
+    call()
+    queries = [(q, v) for q, v in executed if 'FROM lumi_memories' in q]
+    assert queries, "沒有查詢 lumi_memories"
+    return [(q, plan_nodes(memory, q, v)) for q, v in queries]
+
+
+def assert_index_plan(query, nodes):
+    nodes = [n for n in nodes if not on_empty_partition(n)]
+    types = [n['Node Type'] for n in nodes]
+    assert 'Seq Scan' not in types, (query, types)
+    used = {n['Index Name'] for n in nodes if 'Index Name' in n}
+    assert any(name.endswith(COMPOSITE_INDEX_SUFFIXES) for name in used), (query, used)
+    if 'timestamp >=' in query:
+        # 時間範圍必須成為索引條件（sargable），而不是讀出整位用戶的資料再過濾
+        conds = ' '.join(n.get('Index Cond', '') for n in nodes)
+        assert 'timestamp' in conds, (query, conds)
+    elif 'ORDER BY timestamp' in query:
+        # 沒有範圍條件的 ORDER BY ... LIMIT 直接依索引順序讀出
+        assert 'Sort' not in types, (query, types)
+    return types
+
+
+def test_ordered_reads_use_composite_index(memory):
+    today = memory.get_user_today('user1')
+    calls = {
+        'recent': lambda: memory.get_recent_memories('user1', 5),
+        'daily': lambda: memory.get_daily_memories('user1', today),
+        'daily_since': lambda: memory.get_daily_memories('user1', today,
+                                                         since=(datetime.now(timezone.utc) - timedelta(days=1)).isoformat()),
+        'long_term': lambda: memory.get_long_term_memories('user1', days_back=7),
+        'emotion': lambda: memory.get_emotional_memories('user1', 'sad'),
+        'any_emotion': lambda: memory.get_emotional_memories('user1'),
+    }
+    for name, call in calls.items():
+        for query, nodes in explain_calls(memory, call):
+            types = assert_index_plan(query, nodes)
+            print(f"✅ {name}: {' > '.join(types)}")
+
+
+def test_aggregates_are_index_only(memory):
+    calls = {
+        'statistics': lambda: memory.get_memory_statistics('user1'),
+        'summary': lambda: memory.get_memory_summary('user1'),
+        'emotion_patterns': lambda: memory.get_user_emotion_patterns('user1'),
+    }
+    for name, call in calls.items():
+        for query, nodes in explain_calls(memory, call):
+            types = assert_index_plan(query, nodes)
+            assert 'Index Only Scan' in types, (name, query, types)
+            print(f"✅ {name}: {' > '.join(types)}")
+
+
+def test_queries_touch_only_relevant_partitions(memory):
+    with memory.pool.connection() as conn:
+        assert len(memory_partitions.list_partitions(conn)) > 2
+
+    # 有時間範圍的查詢在規劃時就只剩一個分區
+    executed.clear()
+    memory.get_daily_memories('user1', memory.get_user_today('user1'))
+    query, vars = [(q, v) for q, v in executed if 'FROM lumi_memories' in q][-1]
+    relations = {n['Relation Name'] for n in plan_nodes(memory, query, vars) if 'Relation Name' in n}
+    assert len(relations) == 1, relations
+
+    # 最近對話：依分區順序由新到舊讀取，本月的分區就湊滿 LIMIT，較舊的分區不會執行
+    executed.clear()
+    memory.get_recent_memories('user1', 5)
+    query, vars = [(q, v) for q, v in executed if 'FROM lumi_memories' in q][-1]
+    scans = [n for n in plan_nodes(memory, query, vars, analyze=True) if 'Relation Name' in n]
+    current = memory_partitions.partition_name(memory_partitions.month_start(datetime.now(timezone.utc)))
+    older = [n for n in scans if n['Relation Name'] < current]
+    assert older and all(n['Actual Loops'] == 0 for n in older), [(n['Relation Name'], n['Actual Loops']) for n in scans]
+    print(f"✅ recent: {len(older)} 個較舊的分區沒有被讀取")
+
+
+def test_daily_range_follows_user_timezone(memory):
+    memory.update_user_profile('user2', timezone='America/New_York')
+    executed.clear()
+    memory.get_daily_memories('user2', '2026-03-08')
+    query, vars = [(q, v) for q, v in executed if 'FROM lumi_memories' in q][-1]
+    assert 'DATE(' not in query
+    start, end = vars[1], vars[2]
+    # 夏令時間開始的那一天只有 23 小時
+    assert start.astimezone(timezone.utc) == datetime(2026, 3, 8, 5, tzinfo=timezone.utc)
+    assert end.astimezone(timezone.utc) - start.astimezone(timezone.utc) == timedelta(hours=23)
+
+
+def test_stale_diary_users_follow_user_timezone(memory):
+    # 2024-01-03 01:00 UTC：紐約是 1/2 晚上，台北（預設時區）已經是 1/3 早上
+    at = datetime(2024, 1, 3, 1, tzinfo=timezone.utc)
+    with memory.pool.connection() as conn:
+        memory_partitions.ensure_partitions(conn, months=[memory_partitions.month_start(at)])
+        with conn.cursor() as cur:
+            cur.executemany("""
+                INSERT INTO lumi_memories (user_id, user_message, lumi_response, timestamp)
+                VALUES (%s, '晚安', '晚安', %s);
+            """, [('tz_ny', at), ('tz_default', at), ('tz_invalid', at)])
+    memory.update_user_profile('tz_ny', timezone='America/New_York')
+    memory.update_user_profile('tz_invalid', timezone='Not/AZone')
+
+    assert memory.get_stale_diary_users('2024-01-02') == ['tz_ny']
+    assert sorted(memory.get_stale_diary_users('2024-01-03')) == ['tz_default', 'tz_invalid']
+
+
+if __name__ == "__main__":
+    print("請用 pytest 執行：LUMI_TEST_DATABASE_URL=postgresql://... python -m pytest -q test_query_plans.py")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+回覆期限測試：期限計算、部分回覆裁切與串流產生（用假的 OpenAI 串流）
+"""
+import time
+
+import openai
+
+from reply_deadline import Deadline, reply_token_usable, trim_partial
+
+
+def fake_stream(pieces, delay=0.0):
+    def create(**kwargs):
+        assert kwargs['stream'] is True
+        assert kwargs['request_timeout'] > 0
+
+        def gen():
+            for piece in pieces:
+                time.sleep(delay)
+                yield {'choices': [{'delta': {'content': piece}}]}
+        return gen()
+    return create
+
+
+def test_deadline_measured_from_receipt():
+    received_at = time.monotonic() - 10
+    deadline = Deadline(12, started_at=received_at)
+    assert 1.5 < deadline.remaining() <= 2
+    assert not deadline.expired()
+    assert Deadline(5, started_at=received_at).expired()
+
+    usable, remaining = reply_token_usable(received_at, ttl=50, margin=3)
+    assert usable and 39 < remaining <= 40
+    usable, remaining = reply_token_usable(received_at, ttl=12, margin=3)
+    assert not usable
+
+
+def test_trim_partial_keeps_complete_sentences():
+    assert trim_partial("今天辛苦了！要不要先休息一下？我覺得你可") == "今天辛苦了！要不要先休息一下？"
+    assert trim_partial("欸你這樣") == "欸你這樣…"
+    assert trim_partial("") == ""
+
+
+def test_stream_completion_complete_and_partial(monkeypatch):
+    import ai_logic
+
+    monkeypatch.setattr(openai.ChatCompletion, 'create', fake_stream(["嗨", "！今天", "好嗎？"]))
+    text, outcome = ai_logic.stream_completion("prompt", Deadline(5))
+    assert (text, outcome) == ("嗨！今天好嗎？", 'complete')
+
+    # 期限到時停止串流，只保留完整的句子
+    monkeypatch.setattr(openai.ChatCompletion, 'create',
+                        fake_stream(["辛苦了！", "要不要", "先休息", "一下？"], delay=0.05))
+    started = time.monotonic()
+    text, outcome = ai_logic.stream_completion("prompt", Deadline(0.12))
+    assert time.monotonic() - started < 0.3
+    assert (text, outcome) == ("辛苦了！", 'partial')
+    print("✅ 期限內只送出完整句子")
+
+
+def test_stream_completion_timeout_and_error(monkeypatch):
+    import ai_logic
+
+    assert ai_logic.stream_completion("prompt", Deadline(0)) == (None, 'timeout')
+
+    def raise_timeout(**kwargs):
+        raise openai.error.Timeout("read timeout")
+    monkeypatch.setattr(openai.ChatCompletion, 'create', raise_timeout)
+    assert ai_logic.stream_completion("prompt", Deadline(5)) == (None, 'timeout')
+
+    def raise_error(**kwargs):
+        raise openai.error.APIError("boom")
+    monkeypatch.setattr(openai.ChatCompletion, 'create', raise_error)
+    assert ai_logic.stream_completion("prompt", Deadline(5)) == (None, 'error')
+
+
+if __name__ == "__main__":
+    test_deadline_measured_from_receipt()
+    test_trim_partial_keeps_complete_sentences()
+    print("✅ 回覆期限測試通過（串流測試請用 pytest 執行）")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+記憶檢索並行測試（替換各分支的查詢，不需要資料庫或 OpenAI）
+"""
+import os
+import time
+from datetime import datetime, timezone
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+os.environ['EMBEDDING_BATCH_ENABLED'] = 'false'
+
+from simple_memory import SimpleLumiMemory
+
+TS = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_memory(recent_delay=0.0, similar_delay=0.0):
+    memory = SimpleLumiMemory()
+    memory._ensure_connection = lambda: True
+
+    def name(user_id):
+        return '小明'
+
+    def recent(user_id, recent_limit, profile_limit, timeout=None):
+        time.sleep(recent_delay)
+        return [('recent', 1, '早安', '早安呀', None, TS),
+                ('profile', 2, '我喜歡貓', '貓很可愛', None, TS),
+                ('profile', 3, '我討厭下雨', '下雨天好煩', None, TS)]
+
+    def similar(user_id, message, limit, threshold, timeout=None):
+        time.sleep(similar_delay)
+        return [(1, '早安', '早安呀', None, TS, 0.05, None),
+                (3, '我討厭下雨', '下雨天好煩', None, TS, 0.1, None)]
+
+    memory.get_user_profile_name = name
+    memory._fetch_recent_context = recent
+    memory._fetch_similar_context = similar
+    return memory
+
+
+def test_branches_run_in_parallel_and_deduplicate():
+    """總耗時約等於最慢的分支；相似對話排除最近對話，個人資料排除相似對話"""
+    memory = make_memory(recent_delay=0.2, similar_delay=0.2)
+    started = time.monotonic()
+    context = memory.get_context('u1', '下雨了')
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 0.35, elapsed
+    assert context['profile_name'] == '小明'
+    assert [m['user_message'] for m in context['recent_memories']] == ['早安']
+    assert [m['user_message'] for m in context['similar_memories']] == ['我討厭下雨']
+    assert [m['user_message'] for m in context['profile_memories']] == ['我喜歡貓']
+    assert context['timed_out'] == []
+    print(f"✅ 並行檢索耗時: {context['stage_ms']}")
+
+
+def test_slow_branch_returns_partial_results():
+    """向量搜尋超過期限時，只用最近對話回覆"""
+    memory = make_memory(similar_delay=1.0)
+    started = time.monotonic()
+    context = memory.get_context('u1', '下雨了', timeouts={'similar': 0.1})
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 0.5, elapsed
+    assert context['timed_out'] == ['similar']
+    assert context['similar_memories'] == []
+    assert [m['user_message'] for m in context['recent_memories']] == ['早安']
+    assert len(context['profile_memories']) == 2
+
+
+def test_summary_is_not_deduplicated_against_turn_ids():
+    """摘要的 id 是另一個序號，即使和最近對話的 id 相同也要保留"""
+    memory = make_memory()
+    memory._fetch_similar_context = lambda *args, **kwargs: [(1, '好累', '辛苦了', None, TS, 0.05, 12)]
+    context = memory.get_context('u1', '好累喔')
+    assert [m['user_message'] for m in context['similar_memories']] == ['好累（類似的話說過 12 次）']
+    assert context['similar_memories'][0]['source_count'] == 12
+
+
+class RecordingCursor:
+    """依序回傳預先準備的結果，記錄每次查詢的 SQL"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.queries = []
+
+    def execute(self, sql, params):
+        self.queries.append(sql)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+
+def test_threshold_does_not_trigger_exact_search():
+    """門檻濾掉候選不會重查；索引回傳的候選少於用戶實際筆數時才精確搜尋一次"""
+    memory = SimpleLumiMemory()
+    memory.vector_index_type = 'hnsw'
+    memory.embedding_storage = 'vector'
+    summary = (9, '摘要', '回覆', None, TS, 0.05, 4)
+    candidates = [(i, f"訊息{i}", '回覆', None, TS, 0.1 * i, None) for i in range(1, 4)]
+    cur = RecordingCursor([summary] * 3 + candidates)
+    rows = memory._similar_rows(cur, 'u1', [0.1] * 4, 3, 0.75, exact_settings=memory._exact_search_settings())
+    assert [row[0] for row in rows] == [9, 9, 9] and len(cur.queries) == 1
+
+    # 用戶只有一筆對話：候選不足但沒有漏掉，不重查
+    cur = RecordingCursor(candidates[:1], (0, 1))
+    rows = memory._similar_rows(cur, 'u1', [0.1] * 4, 3, 0.75, exact_settings=memory._exact_search_settings())
+    assert [row[0] for row in rows] == [1] and len(cur.queries) == 2
+
+    cur = RecordingCursor(candidates[:1], (0, 3), candidates)
+    rows = memory._similar_rows(cur, 'u1', [0.1] * 4, 3, 0.75, exact_settings=memory._exact_search_settings(0.5))
+    assert [row[0] for row in rows] == [1, 2] and len(cur.queries) == 3
+    assert cur.queries[2].startswith("SET LOCAL statement_timeout = 500;SET LOCAL enable_indexscan = off;")
+
+    # 沒有向量索引時本來就是精確搜尋
+    memory.vector_index_type = 'none'
+    cur = RecordingCursor(candidates[:1])
+    memory._similar_rows(cur, 'u1', [0.1] * 4, 3, 0.75, exact_settings=memory._exact_search_settings())
+    assert len(cur.queries) == 1
+
+
+if __name__ == "__main__":
+    test_branches_run_in_parallel_and_deduplicate()
+    test_slow_branch_returns_partial_results()
+    test_summary_is_not_deduplicated_against_turn_ids()
+    test_threshold_does_not_trigger_exact_search()
+    print("✅ 所有記憶檢索並行測試通過")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+用戶資料快取測試（用假的連線池，不需要資料庫）
+"""
+from contextlib import contextmanager
+
+from user_profiles import UserProfileStore
+
+
+class FakeCursor:
+    def __init__(self, db, log):
+        self.db = db
+        self.log = log
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        self.log.append(sql.split()[0])
+        user_id = params[0]
+        if sql.lstrip().startswith('SELECT'):
+            profile = self.db.get(user_id)
+            self.row = (profile['name'], profile['attributes']) if profile else None
+            return
+        name, attributes = params[1], params[2].adapted
+        profile = self.db.setdefault(user_id, {'name': None, 'attributes': {}})
+        profile['name'] = name if name is not None else profile['name']
+        profile['attributes'] = {**profile['attributes'], **attributes}
+        self.row = (profile['name'], dict(profile['attributes']))
+
+    def fetchone(self):
+        return self.row
+
+
+class FakePool:
+    def __init__(self):
+        self.db = {}
+        self.log = []
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return FakeCursor(self.db, self.log)
+
+
+def test_profile_reads_are_cached_including_misses():
+    """同一位用戶重複查詢只打一次資料庫，沒有資料也會被快取"""
+    pool = FakePool()
+    store = UserProfileStore(pool)
+    assert store.get_name('u1') is None
+    assert store.get_name('u1') is None
+    assert pool.log == ['SELECT']
+
+    stats = store.get_stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    print(f"✅ 用戶資料快取統計: {stats}")
+
+
+def test_upsert_updates_cache_and_merges_attributes():
+    """寫入後快取立即是新值，屬性會合併、名稱不會被 None 蓋掉"""
+    pool = FakePool()
+    store = UserProfileStore(pool)
+    assert store.get_name('u1') is None
+    store.upsert('u1', name='小明')
+    assert store.get_name('u1') == '小明'
+    store.upsert('u1', attributes={'city': '台北'})
+    store.upsert('u1', attributes={'pet': '貓'})
+    profile = store.get_profile('u1')
+    assert profile == {'name': '小明', 'attributes': {'city': '台北', 'pet': '貓'}}
+    assert pool.log.count('SELECT') == 1
+
+
+def test_profile_cache_ttl_and_invalidate():
+    """TTL 過期或手動清除後會重新查詢"""
+    pool = FakePool()
+    store = UserProfileStore(pool, ttl_seconds=0)
+    store.get_name('u1')
+    store.get_name('u1')
+    assert pool.log.count('SELECT') == 2
+
+    store = UserProfileStore(pool)
+    store.get_name('u2')
+    store.invalidate('u2')
+    store.get_name('u2')
+    assert pool.log.count('SELECT') == 4
+
+
+if __name__ == "__main__":
+    test_profile_reads_are_cached_including_misses()
+    test_upsert_updates_cache_and_merges_attributes()
+    test_profile_cache_ttl_and_invalidate()
+    print("✅ 所有用戶資料快取測試通過")
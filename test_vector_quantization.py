@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+嵌入量化測試：int8 量化誤差與重新排序；有 LUMI_TEST_DATABASE_URL 時另外測試 int8 模式的寫入、搜尋與搬移腳本
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['WRITE_BEHIND_ENABLED'] = 'false'
+os.environ['EMBEDDING_BATCH_ENABLED'] = 'false'
+
+from simple_memory import SimpleLumiMemory
+from vector_utils import quantize_int8, dequantize_int8, binary_signature, cosine_distances
+
+DSN = os.getenv('LUMI_TEST_DATABASE_URL')
+TEST_DATABASE = 'lumi_quantization_test'
+DIM = 1536
+TS = datetime(2026, 10, 1, tzinfo=timezone.utc)
+
+
+def random_vectors(n, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_int8_round_trip_keeps_cosine():
+    vectors = random_vectors(50)
+    quantized, scales = quantize_int8(vectors)
+    assert quantized.dtype == np.int8 and quantized.shape == (50, DIM)
+    restored = np.stack([dequantize_int8(q.tobytes(), s) for q, s in zip(quantized, scales)])
+    errors = cosine_distances(vectors[0], restored)[0], np.abs(restored - vectors).max()
+    assert errors[0] < 1e-3 and errors[1] < 1e-2
+
+    single, scale = quantize_int8(vectors[0])
+    assert isinstance(scale, float)
+    assert np.array_equal(single, quantized[0])
+    assert binary_signature([0.5, -0.1, 0.0, 2.0]) == '1001'
+
+
+def test_rerank_puts_summaries_first_and_applies_threshold():
+    query = random_vectors(1, seed=1)[0]
+    near = query + 0.1 * random_vectors(1, seed=2)[0]
+    far = random_vectors(1, seed=3)[0]
+    rows = [(10, '好累', '辛苦了', None, TS, 0.2, 6, None, None)]
+    for memory_id, vector in ((1, far), (2, near)):
+        q, scale = quantize_int8(vector)
+        rows.append((memory_id, f"對話{memory_id}", '回覆', None, TS, None, None, q.tobytes(), scale))
+
+    ranked = SimpleLumiMemory._rerank_quantized(rows, query, 5, 0.3)
+    assert [row[0] for row in ranked] == [10, 2]
+    assert ranked[1][6] is None and ranked[1][5] < 0.01
+    assert SimpleLumiMemory._rerank_quantized(rows, query, 1, 0.3) == [rows[0][:7]]
+    print("✅ int8 候選重新排序，摘要優先")
+
+
+@pytest.fixture
+def pool():
+    import memory_partitions
+    import schema
+    from db_pool import PgConnectionPool
+    from test_query_plans import scratch_database, drop_database
+
+    pool = PgConnectionPool(scratch_database(TEST_DATABASE), min_size=1, max_size=2,
+                            on_connect=SimpleLumiMemory._configure_connection)
+    with pool.connection() as conn:
+        schema.apply_migrations(conn)
+        memory_partitions.ensure_partitions(conn, months_ahead=1)
+    yield pool
+    pool.close()
+    drop_database(TEST_DATABASE)
+
+
+def make_memory(pool, monkeypatch, storage):
+    monkeypatch.setenv('EMBEDDING_STORAGE', storage)
+    memory = SimpleLumiMemory()
+    memory.pool = pool
+    memory.profiles.pool = pool
+    memory.diaries.pool = pool
+    return memory
+
+
+@pytest.mark.skipif(not DSN, reason="未設定 LUMI_TEST_DATABASE_URL")
+def test_int8_storage_search_and_migration(pool, monkeypatch):
+    import quantize_embeddings
+
+    vectors = random_vectors(40, seed=5)
+    embeddings = {f"訊息{i}": v.tolist() for i, v in enumerate(vectors)}
+    now = datetime.now(timezone.utc)
+
+    def store(memory, names):
+        records = [memory._make_record('u1', name, '回覆') for name in names]
+        for i, record in enumerate(records):
+            record['timestamp'] = now - timedelta(minutes=len(names) - i)
+        monkeypatch.setattr(memory, '_get_embeddings', lambda texts: [embeddings[t] for t in texts])
+        memory._insert_memories(records)
+
+    # 前 20 筆以 vector 模式寫入，後 20 筆以 int8 模式寫入
+    store(make_memory(pool, monkeypatch, 'vector'), list(embeddings)[:20])
+    memory = make_memory(pool, monkeypatch, 'int8')
+    store(memory, list(embeddings)[20:])
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COUNT(embedding), COUNT(embedding_i8) FROM lumi_memories;")
+        assert cur.fetchone() == (20, 20)
+
+        # 搬移：量化舊資料 → 清空 float32 → 還原
+        assert quantize_embeddings.migrate(conn, quantize_embeddings.quantize_batch, batch_size=7) == 20
+        assert quantize_embeddings.migrate(conn, quantize_embeddings.drop_float_batch, batch_size=7) == 20
+        cur.execute("SELECT COUNT(embedding), COUNT(embedding_i8) FROM lumi_memories;")
+        assert cur.fetchone() == (0, 40)
+
+    query = vectors[3] + 0.05 * random_vectors(1, seed=9)[0]
+    monkeypatch.setattr(memory, '_get_embedding', lambda text: query.tolist())
+    results = memory.get_similar_memories('u1', '查詢', limit=3, similarity_threshold=0.5)
+    assert [m['user_message'] for m in results] == ['訊息3']
+    assert results[0]['similarity'] > 0.95
+    context = memory.get_context('u1', '查詢', recent_limit=1, similar_limit=2)
+    assert [m['user_message'] for m in context['similar_memories']] == ['訊息3']
+
+    with pool.connection() as conn, conn.cursor() as cur:
+        assert quantize_embeddings.migrate(conn, quantize_embeddings.restore_batch, batch_size=7) == 40
+        cur.execute("SELECT COUNT(embedding) FROM lumi_memories;")
+        assert cur.fetchone()[0] == 40
+    memory = make_memory(pool, monkeypatch, 'vector')
+    monkeypatch.setattr(memory, '_get_embedding', lambda text: query.tolist())
+    assert [m['user_message'] for m in memory.get_similar_memories('u1', '查詢', limit=3,
+                                                                   similarity_threshold=0.5)] == ['訊息3']
+    print("✅ int8 模式寫入、搜尋與搬移")
+
+
+if __name__ == "__main__":
+    test_int8_round_trip_keeps_cosine()
+    test_rerank_puts_summaries_first_and_applies_threshold()
+    print("✅ 嵌入量化測試通過（資料庫測試請設定 LUMI_TEST_DATABASE_URL 後用 pytest 執行）")
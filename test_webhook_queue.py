@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+webhook 背景 worker pool 測試（不需要 LINE / OpenAI / 資料庫）
+"""
+import time
+import threading
+
+from webhook_queue import WebhookWorkerPool
+
+
+def test_worker_pool_processes_events():
+    """事件會被背景 worker 處理，統計數字正確"""
+    done = []
+    pool = WebhookWorkerPool(lambda item: done.append(item), num_workers=2, max_queue_size=10)
+    pool.start()
+    for i in range(5):
+        assert pool.submit(i)
+    pool.stop()
+
+    stats = pool.get_stats()
+    assert sorted(done) == [0, 1, 2, 3, 4]
+    assert stats['processed'] == 5
+    assert stats['failed'] == 0
+    assert stats['queue_depth'] == 0
+    print(f"✅ worker pool 統計: {stats}")
+
+
+def test_worker_pool_bounded_queue():
+    """佇列滿時 submit 回傳 False，例外不會讓 worker 停止"""
+    gate = threading.Event()
+
+    def slow(item):
+        gate.wait(2)
+        if item == 'boom':
+            raise RuntimeError(item)
+
+    pool = WebhookWorkerPool(slow, num_workers=1, max_queue_size=1)
+    pool.start()
+    assert pool.submit('boom')
+    time.sleep(0.05)  # 讓 worker 取走第一個事件
+    assert pool.submit('ok')
+    assert not pool.submit('overflow')
+    gate.set()
+    pool.stop()
+
+    stats = pool.get_stats()
+    assert stats['rejected'] == 1
+    assert stats['failed'] == 1
+    assert stats['processed'] == 1
+    print(f"✅ 有界佇列統計: {stats}")
+
+
+if __name__ == "__main__":
+    test_worker_pool_processes_events()
+    test_worker_pool_bounded_queue()
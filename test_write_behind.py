@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+非同步寫入緩衝測試（不需要資料庫）
+"""
+from write_behind import WriteBehindBuffer
+
+
+def test_write_behind_batches_and_read_your_writes():
+    """達到批次大小才寫出，寫出前 pending_for 看得到記錄"""
+    batches = []
+    buffer = WriteBehindBuffer(lambda records: batches.append(list(records)), batch_size=3, flush_interval=60)
+    buffer.add({'user_id': 'a', 'n': 1})
+    buffer.add({'user_id': 'b', 'n': 2})
+    assert [r['n'] for r in buffer.pending_for('a')] == [1]
+
+    buffer.add({'user_id': 'a', 'n': 3})
+    buffer.add({'user_id': 'a', 'n': 4})
+    assert buffer.flush() == 4
+    assert [len(b) for b in batches] == [3, 1]
+    assert buffer.pending_for('a') == []
+    print(f"✅ 批次寫入統計: {buffer.get_stats()}")
+
+
+def test_write_behind_retries_failed_batch_and_flushes_on_stop():
+    """寫入失敗時記錄放回緩衝區，stop() 時全部寫出"""
+    state = {'fail': True, 'written': []}
+
+    def flush(records):
+        if state['fail']:
+            raise RuntimeError("db down")
+        state['written'].extend(records)
+
+    buffer = WriteBehindBuffer(flush, batch_size=10, flush_interval=60)
+    buffer.start()
+    buffer.add({'user_id': 'a', 'n': 1})
+    assert buffer.flush() == 0
+    assert len(buffer.pending_for('a')) == 1
+
+    state['fail'] = False
+    buffer.stop()
+    assert [r['n'] for r in state['written']] == [1]
+    assert buffer.get_stats()['flush_failures'] == 1
+
+
+def test_write_behind_retries_only_failed_records_and_dead_letters():
+    """flush_func 回傳的記錄才重試，其他照常寫入；一直失敗的記錄超過次數後不再阻擋後面的寫入"""
+    written = []
+
+    def flush(records):
+        written.extend(r['n'] for r in records if r['n'] != 2)
+        return [r for r in records if r['n'] == 2]
+
+    buffer = WriteBehindBuffer(flush, batch_size=10, flush_interval=60, max_attempts=3)
+    for n in (1, 2, 3):
+        buffer.add({'user_id': 'a', 'n': n})
+    assert buffer.flush() == 2
+    assert [r['n'] for r in buffer.pending_for('a')] == [2]
+
+    buffer.add({'user_id': 'a', 'n': 4})
+    assert buffer.flush() == 1
+    assert buffer.flush() == 0
+    assert written == [1, 3, 4]
+    assert buffer.pending_for('a') == []
+    assert [r['n'] for r in buffer.dead_letters] == [2]
+    stats = buffer.get_stats()
+    assert stats['dead_lettered'] == 1 and stats['retried'] == 2 and stats['flushed'] == 3
+    print(f"✅ 失敗記錄重試與放棄: {stats}")
+
+
+if __name__ == "__main__":
+    test_write_behind_batches_and_read_your_writes()
+    test_write_behind_retries_failed_batch_and_flushes_on_stop()
+    test_write_behind_retries_only_failed_records_and_dead_letters()
@@ -0,0 +1,111 @@
+import threading
+import time
+
+from psycopg2.extras import Json
+
+import metrics
+
+_MISSING = object()
+
+
+class UserProfileStore:
+    """user_profiles 資料表（名稱 + 結構化屬性）與 process 內的 TTL 快取
+
+    - 讀取先查快取（「沒有資料」也會被快取），熱路徑上大多不需要查資料庫
+    - 寫入使用 UPSERT，寫入後直接更新快取
+    """
+
+    def __init__(self, pool=None, ttl_seconds=300, max_size=10000):
+        self.pool = pool
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_size = max(1, int(max_size))
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0}
+
+    def _cache_get(self, user_id):
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is None:
+                return _MISSING
+            profile, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._cache[user_id]
+                return _MISSING
+            return profile
+
+    def _cache_put(self, user_id, profile):
+        with self._lock:
+            if len(self._cache) >= self.max_size and user_id not in self._cache:
+                # 超過上限時先清掉過期的，還是太多就清掉最早放進來的一半
+                now = time.monotonic()
+                expired = [k for k, (_, t) in self._cache.items() if now - t > self.ttl_seconds]
+                for k in expired:
+                    del self._cache[k]
+                if len(self._cache) >= self.max_size:
+                    for k in list(self._cache)[:len(self._cache) // 2]:
+                        del self._cache[k]
+            self._cache[user_id] = (profile, time.monotonic())
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(user_id, None)
+
+    def get_profile(self, user_id):
+        """回傳 {'name': ..., 'attributes': {...}}，沒有資料時回傳 None"""
+        profile = self._cache_get(user_id)
+        if profile is not _MISSING:
+            with self._lock:
+                self._stats['hits'] += 1
+            return profile
+
+        with self._lock:
+            self._stats['misses'] += 1
+        if not self.pool:
+            return None
+        profile = self._fetch(user_id)
+        self._cache_put(user_id, profile)
+        return profile
+
+    def _fetch(self, user_id):
+        with metrics.span('db.user_profile'), self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT name, attributes FROM user_profiles WHERE user_id = %s;", (user_id,))
+            row = cur.fetchone()
+        return {'name': row[0], 'attributes': row[1] or {}} if row else None
+
+    def get_name(self, user_id):
+        profile = self.get_profile(user_id)
+        return profile['name'] if profile else None
+
+    def upsert(self, user_id, name=None, attributes=None):
+        """寫入名稱或屬性（屬性會與既有內容合併），回傳最新的 profile"""
+        profile = self._write(user_id, name, attributes or {})
+        self._cache_put(user_id, profile)
+        with self._lock:
+            self._stats['writes'] += 1
+        return profile
+
+    def _write(self, user_id, name, attributes):
+        with metrics.span('db.user_profile_upsert'), self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO user_profiles (user_id, name, attributes, updated_at)
+                VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    name = COALESCE(EXCLUDED.name, user_profiles.name),
+                    attributes = user_profiles.attributes || EXCLUDED.attributes,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING name, attributes;
+            """, (user_id, name, Json(attributes)))
+            row = cur.fetchone()
+        return {'name': row[0], 'attributes': row[1] or {}}
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
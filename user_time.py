@@ -0,0 +1,45 @@
+"""
+用戶時區與查詢用的時間範圍
+
+所有依日期查詢的條件都寫成半開區間 `timestamp >= 開始 AND timestamp < 結束`，
+開始 / 結束是用戶時區的午夜換算成的絕對時間，可以直接使用 (user_id, timestamp) 索引。
+用戶時區取自 user_profiles.attributes 的 timezone，沒有設定時使用 USER_TIMEZONE。
+"""
+import logging
+import os
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = os.getenv('USER_TIMEZONE', 'Asia/Taipei')
+
+
+def get_zone(name=None):
+    """時區名稱 → ZoneInfo；名稱無效時退回 DEFAULT_TIMEZONE"""
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning("無效的時區 %r，改用 %s", name, DEFAULT_TIMEZONE)
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def local_today(tz, now=None):
+    """用戶時區的今天（YYYY-MM-DD）"""
+    return (now or datetime.now(tz)).astimezone(tz).date().isoformat()
+
+
+def _midnight(day, tz):
+    return datetime.combine(day, time.min, tzinfo=tz)
+
+
+def day_range(date_str, tz):
+    """用戶時區某一天的 [開始, 結束)"""
+    day = date.fromisoformat(date_str)
+    return _midnight(day, tz), _midnight(day + timedelta(days=1), tz)
+
+
+def recent_days_range(days, tz, now=None):
+    """包含今天在內最近 days 天的 [開始, 結束)，以用戶時區的午夜為界"""
+    today = (now or datetime.now(tz)).astimezone(tz).date()
+    return _midnight(today - timedelta(days=max(1, int(days)) - 1), tz), _midnight(today + timedelta(days=1), tz)
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def as_float_array(value, dtype=np.float32):
+    """把 pgvector 讀回的值（Vector 物件、numpy 陣列或 list）轉成 numpy 陣列"""
+    if value is None:
+        return None
+    if hasattr(value, 'to_numpy'):
+        value = value.to_numpy()
+    return np.asarray(value, dtype=dtype)
+
+
+def quantize_int8(vectors):
+    """float 向量 → (int8 陣列, 每個向量的 scale)；對稱量化，v ≈ q * scale
+
+    一維輸入回傳單一向量與 float scale，二維輸入逐列量化。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    peak = np.abs(vectors).max(axis=-1, keepdims=True)
+    scale = np.where(peak == 0, 1.0, peak / 127.0).astype(np.float32)
+    quantized = np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+    if vectors.ndim == 1:
+        return quantized, float(scale[0])
+    return quantized, scale[:, 0]
+
+
+def dequantize_int8(data, scale):
+    """quantize_int8 的反向；data 可以是資料庫讀回的 bytes / memoryview"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(data, dtype=np.int8)
+    return np.asarray(data, dtype=np.float32) * np.float32(scale)
+
+
+def binary_signature(vector):
+    """每一維取正負號的位元字串（'0101...'），寫入 / 比對 Postgres 的 bit varying
+
+    兩個向量位元不同的個數（hamming 距離）可以粗略估計夾角，用來在資料庫中挑候選。
+    """
+    bits = np.asarray(vector, dtype=np.float32) > 0
+    return (bits.astype(np.uint8) + ord('0')).tobytes().decode('ascii')
+
+
+def cosine_distances(query, vectors):
+    """查詢向量與每一列的 cosine 距離（1 - 相似度），與 pgvector 的 <=> 相同"""
+    query = np.asarray(query, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) == 0:
+        return np.zeros(0, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    similarities = vectors @ query / np.where(norms == 0, 1.0, norms)
+    return 1.0 - similarities
+
+
+def stored_embedding(embedding, storage='vector'):
+    """依儲存方式（EMBEDDING_STORAGE）回傳寫入 lumi_memories 的 (embedding, embedding_i8, embedding_scale, embedding_bits)"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    if storage == 'int8':
+        quantized, scale = quantize_int8(vector)
+        return None, quantized.tobytes(), scale, binary_signature(vector)
+    return vector, None, None, None
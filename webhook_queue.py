@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookWorkerPool:
+    """有界佇列 + 背景 worker，讓 /callback 可以立即回覆 200"""
+
+    def __init__(self, process_func, num_workers=4, max_queue_size=100):
+        self.process_func = process_func
+        self.num_workers = max(1, int(num_workers))
+        self.max_queue_size = max(1, int(max_queue_size))
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+
+        # 統計資料（用來調整 worker 數量與佇列大小）
+        self._busy_workers = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._busy_seconds = 0.0
+        self._wait_seconds = 0.0
+        self._max_depth = 0
+        self._started_at = None
+
+    def start(self):
+        """啟動背景 worker（重複呼叫不會重複啟動）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._started_at = time.monotonic()
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._worker_loop, name=f"webhook-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info("✅ webhook worker pool 已啟動: workers=%d, queue=%d", self.num_workers, self.max_queue_size)
+
+    def submit(self, item):
+        """放入佇列，佇列已滿時回傳 False 讓呼叫端自行處理"""
+        try:
+            self._queue.put_nowait((item, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+        depth = self._queue.qsize()
+        with self._lock:
+            if depth > self._max_depth:
+                self._max_depth = depth
+        return True
+
+    def stop(self, timeout=10.0):
+        """處理完佇列中剩餘的事件後停止 worker"""
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+            threads = list(self._threads)
+            self._threads = []
+        deadline = time.monotonic() + timeout
+        for _ in threads:
+            remaining = max(0.0, deadline - time.monotonic())
+            try:
+                self._queue.put(None, timeout=remaining)
+            except queue.Full:
+                break
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        logger.info("🛑 webhook worker pool 已停止")
+
+    def _worker_loop(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                if entry is None:
+                    return
+                item, enqueued_at = entry
+                started = time.monotonic()
+                with self._lock:
+                    self._busy_workers += 1
+                    self._wait_seconds += started - enqueued_at
+                ok = True
+                try:
+                    self.process_func(item)
+                except Exception as e:
+                    ok = False
+                    logger.exception("❌ webhook worker 處理事件失敗: %s", e)
+                elapsed = time.monotonic() - started
+                with self._lock:
+                    self._busy_workers -= 1
+                    self._busy_seconds += elapsed
+                    if ok:
+                        self._processed += 1
+                    else:
+                        self._failed += 1
+            finally:
+                self._queue.task_done()
+
+    def get_stats(self):
+        """佇列深度與 worker 忙碌時間"""
+        with self._lock:
+            done = self._processed + self._failed
+            uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+            capacity = uptime * self.num_workers
+            return {
+                'running': self._started,
+                'workers': self.num_workers,
+                'busy_workers': self._busy_workers,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self._max_depth,
+                'queue_capacity': self.max_queue_size,
+                'processed': self._processed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'busy_seconds_total': round(self._busy_seconds, 3),
+                'avg_busy_ms': round(self._busy_seconds / done * 1000, 2) if done else 0.0,
+                'avg_queue_wait_ms': round(self._wait_seconds / done * 1000, 2) if done else 0.0,
+                'utilization': round(self._busy_seconds / capacity, 4) if capacity else 0.0,
+            }
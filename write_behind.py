@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """非同步寫入緩衝：記錄先放進記憶體，達到筆數或時間門檻時整批交給 flush_func
+
+    - flush_func(records) 拋出例外時整批放回緩衝區等下次重試；回傳記錄清單時只重試那些記錄
+      （例如嵌入失敗的幾筆），其餘視為已寫入
+    - 每筆記錄最多嘗試 max_attempts 次，之後移到 dead_letters 並記錄錯誤，不再阻擋後面的寫入
+    - 緩衝區超過 max_pending 時丟棄最舊的；連續失敗時重試間隔倍增（最多 max_backoff 秒）
+    - pending_for(key) 會回傳尚未寫入（含寫入中）的記錄，讓讀取端做到 read-your-writes
+    """
+
+    def __init__(self, flush_func, batch_size=50, flush_interval=1.0, max_pending=10000,
+                 key_func=None, max_attempts=10, max_backoff=60.0, dead_letter_size=100):
+        self.flush_func = flush_func
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.max_pending = max(self.batch_size, int(max_pending))
+        self.key_func = key_func or (lambda record: record.get('user_id'))
+        self.max_attempts = max(1, int(max_attempts))
+        self.max_backoff = max(self.flush_interval, float(max_backoff))
+
+        # 已失敗的次數，以 id(record) 為 key（記錄留在緩衝區期間 id 不會重複）
+        self._attempts = {}
+        self._failure_streak = 0
+        self.dead_letters = deque(maxlen=dead_letter_size)
+
+        self._pending = deque()
+        self._inflight = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        self._stats = {
+            'enqueued': 0,
+            'flushed': 0,
+            'batches': 0,
+            'flush_failures': 0,
+            'dropped': 0,
+            'retried': 0,
+            'dead_lettered': 0,
+            'flush_seconds_total': 0.0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._thread:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+            self._thread.start()
+
+    def add(self, record):
+        with self._cond:
+            self._pending.append(record)
+            self._stats['enqueued'] += 1
+            while len(self._pending) > self.max_pending:
+                self._attempts.pop(id(self._pending.popleft()), None)
+                self._stats['dropped'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def pending_for(self, key):
+        """尚未寫入資料庫的記錄（依加入順序）"""
+        with self._cond:
+            return [r for r in list(self._inflight) + list(self._pending) if self.key_func(r) == key]
+
+    def flush(self):
+        """立即把目前緩衝區的記錄全部寫出，回傳寫入筆數"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    if not self._pending:
+                        return written
+                    count = min(self.batch_size, len(self._pending))
+                    batch = [self._pending.popleft() for _ in range(count)]
+                    self._inflight = batch
+                started = time.monotonic()
+                try:
+                    failed = list(self.flush_func(batch) or ())
+                except Exception as e:
+                    logger.error("❌ 批次寫入失敗，%d 筆記錄稍後重試: %s", len(batch), e)
+                    with self._cond:
+                        self._inflight = []
+                        self._stats['flush_failures'] += 1
+                        self._failure_streak += 1
+                        self._requeue(batch)
+                    return written
+                elapsed = time.monotonic() - started
+                failed_ids = {id(record) for record in failed}
+                done = len(batch) - len(failed_ids)
+                with self._cond:
+                    self._inflight = []
+                    for record in batch:
+                        if id(record) not in failed_ids:
+                            self._attempts.pop(id(record), None)
+                    self._stats['flushed'] += done
+                    self._stats['batches'] += 1
+                    self._stats['flush_seconds_total'] += elapsed
+                    if failed:
+                        self._stats['flush_failures'] += 1
+                        self._failure_streak += 1
+                        self._requeue(failed)
+                    else:
+                        self._failure_streak = 0
+                written += done
+                if failed:
+                    logger.warning("⚠️ 批次中有 %d 筆記錄寫入失敗，稍後重試", len(failed))
+                    return written
+
+    def _requeue(self, records):
+        """失敗的記錄放回緩衝區最前面；超過 max_attempts 的移到 dead_letters（呼叫端持有 _cond）"""
+        retry = []
+        for record in records:
+            attempts = self._attempts.get(id(record), 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(id(record), None)
+                self.dead_letters.append(record)
+                self._stats['dead_lettered'] += 1
+                logger.error("❌ 記錄寫入失敗 %d 次，放棄重試", attempts)
+                continue
+            self._attempts[id(record)] = attempts
+            retry.append(record)
+        self._stats['retried'] += len(retry)
+        self._pending.extendleft(reversed(retry))
+
+    def stop(self, timeout=10.0):
+        """停止背景執行緒並寫出剩餘記錄（程式結束時呼叫）"""
+        with self._cond:
+            thread = self._thread
+            self._thread = None
+            self._stopping = True
+            self._cond.notify()
+        if thread:
+            thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+                has_pending = bool(self._pending)
+            if has_pending:
+                self.flush()
+                # 連續失敗時避免空轉，等待時間隨失敗次數倍增
+                with self._cond:
+                    if self._failure_streak and self._pending and not self._stopping:
+                        backoff = self.flush_interval * 2 ** min(self._failure_streak - 1, 16)
+                        self._cond.wait(min(backoff, self.max_backoff))
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending) + len(self._inflight)
+            stats['failure_streak'] = self._failure_streak
+        batches = stats['batches']
+        stats['avg_batch_size'] = round(stats['flushed'] / batches, 2) if batches else 0.0
+        stats['avg_flush_ms'] = round(stats['flush_seconds_total'] / batches * 1000, 2) if batches else 0.0
+        stats['flush_seconds_total'] = round(stats['flush_seconds_total'], 4)
+        return stats